@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import json
 import os
 
 import aws_cdk as cdk
 
 from cdk.langserve_stack import LangServeStack
+from cdk.lookups import lookup_provider
 
 aws_profile = os.getenv('AWS_PROFILE')
 aws_account = os.getenv('CDK_DEFAULT_ACCOUNT')
@@ -20,6 +22,9 @@ vpc_stack = app.node.try_get_context("vpc_stack") # eg: SharedVpcStack
 stage = app.node.try_get_context("stage") # eg: dev
 domain = app.node.try_get_context("domain") # eg: example.com , it must be there in your hosted zone
 subdomain = app.node.try_get_context("subdomain") # eg: chat, if then the domains will look like chat-{stage}.domain ie chat-dev.example.com
+capacity = app.node.try_get_context("capacity") # eg: '{"max_tasks": 20}', on top of the stage's defaults in langserve_stack.py
+if isinstance(capacity, str):
+    capacity = json.loads(capacity)
 
 print("stage:", stage)
 print("subdomain:", subdomain)
@@ -29,6 +34,9 @@ if stage is None:
 
 env = cdk.Environment(account=aws_account, region=aws_region) # if you want some other region, you can set it or pass it similar to stage
 
-LangServeStack(app,  f"LangServeStack-{stage}", vpc_stack, stage, subdomain, domain, env=env)
+# live, cached (default, kept in lookups.context.json) or offline (only reads that file); shared by every stack
+lookups = lookup_provider(app.node.try_get_context("lookups"), aws_account, aws_region)
+
+LangServeStack(app,  f"LangServeStack-{stage}", vpc_stack, stage, subdomain, domain, env=env, capacity=capacity, lookups=lookups)
 
 app.synth()
\ No newline at end of file
@@ -1,4 +1,5 @@
 from aws_cdk import (
+    Duration,
     Stack,
     aws_ec2 as ec2,
     aws_ecs as ecs,
@@ -11,18 +12,59 @@ from aws_cdk import (
 )
 import os
 from constructs import Construct
-import boto3
+
+from .lookups import LookupProvider, lookup_provider
+
+
+# Task size, scaling and routing per stage; any of these can be overridden with the `capacity`
+# context, e.g. cdk deploy -c stage=prod -c capacity='{"max_tasks": 20}'
+DEFAULT_CAPACITY = {
+    "cpu": 256,
+    "memory_limit_mib": 512,
+    "min_tasks": 1,
+    "max_tasks": 2,
+    # ALB requests per task per minute; an agent request holds a task for seconds
+    "requests_per_target": 120,
+    "cpu_target_percent": 60,
+    "scale_out_cooldown_seconds": 60,
+    # Scale in slowly: a task removed during a burst has to be started again
+    "scale_in_cooldown_seconds": 300,
+    # Time a draining task keeps serving the requests and streams it already has
+    "deregistration_delay_seconds": 30,
+    # Time the app then gets after SIGTERM to finish what is left
+    "graceful_shutdown_seconds": 20,
+    # Keep each session on one task, through the app's affinity cookie, so its cached
+    # history is reused; only pays off with more than one task
+    "session_affinity": False,
+    "session_affinity_seconds": 3600,
+}
+
+STAGE_CAPACITY = {
+    "dev": {},
+    "prod": {
+        "cpu": 512,
+        "memory_limit_mib": 1024,
+        "min_tasks": 2,
+        "max_tasks": 10,
+        "session_affinity": True,
+    },
+}
+
+
+def stage_capacity(stage, overrides=None):
+    capacity = {**DEFAULT_CAPACITY, **STAGE_CAPACITY.get(stage, {}), **(overrides or {})}
+    unknown = set(capacity) - set(DEFAULT_CAPACITY)
+    if unknown:
+        raise ValueError(f"Unknown capacity settings: {sorted(unknown)}")
+    if not 1 <= capacity["min_tasks"] <= capacity["max_tasks"]:
+        raise ValueError("Capacity needs 1 <= min_tasks <= max_tasks")
+    return capacity
 
 
 class LangServeStack(Stack):
 
     def get_stack_outputs(self, stack_name):
-        client = boto3.client('cloudformation', region_name=self.region)
-        response = client.describe_stacks(StackName=stack_name)
-        stack = response['Stacks'][0]
-        outputs = stack.get('Outputs', [])
-        return {output['OutputKey']: output['OutputValue'] for output in outputs}
-    
+        return self.lookups.get_stack_outputs(stack_name)
 
     def get_vpc_details(self, vpc_stack, stage):
         shared_vpc_stack = self.get_stack_outputs(vpc_stack)
@@ -52,21 +94,18 @@ class LangServeStack(Stack):
             "azs": public_azs,
         }
 
-    def get_certificate_arn(self, domain_name):
-        client = boto3.client('acm', region_name=self.region)
-        response = client.list_certificates(CertificateStatuses=['ISSUED'])
-        
-        for cert in response['CertificateSummaryList']:
-            if domain_name in cert['DomainName']:
-                return cert['CertificateArn']
-        
-        raise Exception(f'Certificate not found for domain {domain_name}')
+    def get_certificate_arn(self, hostname):
+        return self.lookups.get_certificate_arn(hostname)
 
 
     def __init__(self, scope: Construct, construct_id: str, vpc_stack: str, stage: str, subdomain: str, 
-                 domain_name: str, env=None, **kwargs) -> None:
+                 domain_name: str, env=None, capacity: dict = None, lookups: LookupProvider = None,
+                 **kwargs) -> None:
         super().__init__(scope, construct_id, env=env, **kwargs)
 
+        # Stack outputs and the certificate, cached in lookups.context.json (see lookups.py)
+        self.lookups = lookups or lookup_provider(self.node.try_get_context("lookups"), env.account, env.region)
+
 
 
         # The code that defines your stack goes here
@@ -76,6 +115,8 @@ class LangServeStack(Stack):
 
         endpoint = f"{subdomain}-{stage}.{domain_name}"
         print("Endpoint", endpoint)
+        capacity = stage_capacity(stage, capacity)
+        print("Capacity", capacity)
         vpc_details = self.get_vpc_details(vpc_stack, stage)
 
         print("VPC Subnets", vpc_details)
@@ -122,37 +163,71 @@ class LangServeStack(Stack):
         )
 
         image = ecs.ContainerImage.from_asset(
-            directory="../chatbot",
-        )
-
-        # (v) Create ECS Task Definition
-        task_definition = ecs.FargateTaskDefinition(
-            self,
-            "FastAPITaskDefinition",
-            task_role=task_role
+            directory=os.path.join(os.path.dirname(__file__), "..", "..", "chatbot"),
         )
 
 
         OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-        LANGCHAIN_TRACING_V2 = os.environ["LANGCHAIN_TRACING_V2"]
+        # Sampled, batched tracing instead of LANGCHAIN_TRACING_V2 tracing every run in full
+        TRACING_MODE = os.environ.get("TRACING_MODE", "sampled")
+        TRACING_SAMPLE_RATE = os.environ.get("TRACING_SAMPLE_RATE", "0.05")
         LANGCHAIN_API_KEY = os.environ["LANGCHAIN_API_KEY"]
         LANGCHAIN_PROJECT = os.environ["LANGCHAIN_PROJECT"]
         MONGO_CONNECTION_STRING = os.environ["MONGO_CONNECTION_STRING"]
         MONGO_DATABASE = os.environ["MONGO_DATABASE"]
         MONGO_COLLECTION = os.environ["MONGO_COLLECTION"]
+        AFFINITY_COOKIE = "chatbot_affinity"
+        # The admin profiling endpoints are only served when a token is set at deploy time
+        PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+        # /website-bot/stream holds a connection open while the agent works; the ALB's
+        # default 60s idle timeout would cut slow answers off
+        ALB_IDLE_TIMEOUT_SECONDS = int(os.environ.get("ALB_IDLE_TIMEOUT_SECONDS", "300"))
+
+        # (v) Create ECS Task Definition
+        task_definition = ecs.FargateTaskDefinition(
+            self,
+            "FastAPITaskDefinition",
+            task_role=task_role,
+            cpu=capacity["cpu"],
+            memory_limit_mib=capacity["memory_limit_mib"],
+        )
 
         container = task_definition.add_container(
             "fastapi-container",
             image=image,
             logging=ecs.LogDrivers.aws_logs(stream_prefix="fastapi"),
+            # slim image, no curl
+            health_check=ecs.HealthCheck(
+                command=[
+                    "CMD-SHELL",
+                    "python -c \"import urllib.request; urllib.request.urlopen('http://localhost:8080/', timeout=3)\" || exit 1",
+                ],
+                interval=Duration.seconds(15),
+                timeout=Duration.seconds(5),
+                retries=3,
+                # Import, agent build and Mongo warm up
+                start_period=Duration.seconds(60),
+            ),
+            # SIGKILL only after the app's own graceful shutdown had its chance
+            stop_timeout=Duration.seconds(capacity["graceful_shutdown_seconds"] + 10),
             environment={
                 "OPENAI_API_KEY": OPENAI_API_KEY,
-                "LANGCHAIN_TRACING_V2": LANGCHAIN_TRACING_V2,
+                "TRACING_MODE": TRACING_MODE,
+                "TRACING_SAMPLE_RATE": TRACING_SAMPLE_RATE,
                 "LANGCHAIN_API_KEY": LANGCHAIN_API_KEY,
                 "LANGCHAIN_PROJECT": LANGCHAIN_PROJECT,
                 "MONGO_CONNECTION_STRING": MONGO_CONNECTION_STRING,
                 "MONGO_DATABASE": MONGO_DATABASE,
-                "MONGO_COLLECTION": MONGO_COLLECTION
+                "MONGO_COLLECTION": MONGO_COLLECTION,
+                # The app must keep idle connections open longer than the ALB does
+                "KEEP_ALIVE_SECONDS": str(ALB_IDLE_TIMEOUT_SECONDS + 5),
+                "GRACEFUL_SHUTDOWN_SECONDS": str(capacity["graceful_shutdown_seconds"]),
+                "SESSION_AFFINITY": str(capacity["session_affinity"]).lower(),
+                "AFFINITY_COOKIE": AFFINITY_COOKIE,
+                "AFFINITY_COOKIE_MAX_AGE_SECONDS": str(capacity["session_affinity_seconds"]),
+                # Clients reach the app over HTTPS only
+                "AFFINITY_COOKIE_SECURE": "true",
+                **({"PROFILING": "true", "PROFILING_TOKEN": PROFILING_TOKEN} if PROFILING_TOKEN else {}),
             }
         )
 
@@ -165,18 +240,61 @@ class LangServeStack(Stack):
             self,
             "FastAPIService",
             cluster=self.ecs_cluster,
-            cpu=256,
-            memory_limit_mib=512,
-            desired_count=1,
+            desired_count=capacity["min_tasks"],
+            idle_timeout=Duration.seconds(ALB_IDLE_TIMEOUT_SECONDS),
             task_definition=task_definition,
             task_subnets=ec2.SubnetSelection(
                 subnets=[ec2.Subnet.from_subnet_id(self, f"subnet-{i + 1}", subnet) for i, subnet in enumerate(vpc_details["private_subnets"])]
             ),
         )
 
+        # A task busy with long streams gets fewer new requests than one that is idle,
+        # which round robin ignores
+        self.ecs_service.target_group.set_attribute(
+            "load_balancing.algorithm.type", "least_outstanding_requests"
+        )
+        self.ecs_service.target_group.set_attribute(
+            "deregistration_delay.timeout_seconds", str(capacity["deregistration_delay_seconds"])
+        )
+        self.ecs_service.target_group.configure_health_check(
+            path="/",
+            interval=Duration.seconds(15),
+            timeout=Duration.seconds(5),
+            healthy_threshold_count=2,
+            unhealthy_threshold_count=3,
+        )
+
+        if capacity["session_affinity"]:
+            # The ALB pins a client to the task that set the app's cookie, with a cookie
+            # of its own, for as long as the app keeps setting it
+            self.ecs_service.target_group.enable_cookie_stickiness(
+                Duration.seconds(capacity["session_affinity_seconds"]),
+                cookie_name=AFFINITY_COOKIE,
+            )
+
+        # Scale on whichever asks for more tasks: request rate, or CPU for the requests
+        # that are expensive to serve
+        scaling = self.ecs_service.service.auto_scale_task_count(
+            min_capacity=capacity["min_tasks"],
+            max_capacity=capacity["max_tasks"],
+        )
+        scaling.scale_on_request_count(
+            "RequestScaling",
+            requests_per_target=capacity["requests_per_target"],
+            target_group=self.ecs_service.target_group,
+            scale_in_cooldown=Duration.seconds(capacity["scale_in_cooldown_seconds"]),
+            scale_out_cooldown=Duration.seconds(capacity["scale_out_cooldown_seconds"]),
+        )
+        scaling.scale_on_cpu_utilization(
+            "CpuScaling",
+            target_utilization_percent=capacity["cpu_target_percent"],
+            scale_in_cooldown=Duration.seconds(capacity["scale_in_cooldown_seconds"]),
+            scale_out_cooldown=Duration.seconds(capacity["scale_out_cooldown_seconds"]),
+        )
+
         # (vii) Import existing certificate
         
-        certificate_arn = self.get_certificate_arn(domain_name)
+        certificate_arn = self.get_certificate_arn(endpoint)
         print("Certificate ARN", certificate_arn)
         certificate = certificatemanager.Certificate.from_certificate_arn(
             self,
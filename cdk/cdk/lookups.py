@@ -0,0 +1,143 @@
+import json
+import os
+
+import boto3
+
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.dirname(__file__), "..", "lookups.context.json")
+
+
+class LookupNotFoundError(Exception):
+    pass
+
+
+def certificate_covers(certificate_name, hostname):
+    """Whether a certificate issued for `certificate_name` is valid for `hostname`
+
+    A wildcard covers exactly one label: *.example.com covers chat-dev.example.com but
+    not example.com or a.b.example.com.
+    """
+    certificate_name = certificate_name.lower().rstrip(".")
+    hostname = hostname.lower().rstrip(".")
+    if certificate_name == hostname:
+        return True
+    if certificate_name.startswith("*."):
+        label, _, parent = hostname.partition(".")
+        return bool(label) and parent == certificate_name[2:]
+    return False
+
+
+def match_certificate(certificates, hostname):
+    """ARN of the certificate for `hostname` among ACM certificate summaries, preferring
+    one issued for the exact name over a wildcard"""
+    wildcard = None
+    for cert in certificates:
+        names = [cert["DomainName"], *cert.get("SubjectAlternativeNameSummaries", [])]
+        if any(name.lower().rstrip(".") == hostname.lower().rstrip(".") for name in names):
+            return cert["CertificateArn"]
+        if wildcard is None and any(certificate_covers(name, hostname) for name in names):
+            wildcard = cert["CertificateArn"]
+    return wildcard
+
+
+class LookupProvider:
+    """What the stack needs to know about the account at synth time"""
+
+    def get_stack_outputs(self, stack_name):
+        raise NotImplementedError
+
+    def get_certificate_arn(self, hostname):
+        raise NotImplementedError
+
+
+class AwsLookupProvider(LookupProvider):
+    """Asks CloudFormation and ACM on every call"""
+
+    def __init__(self, region, client_factory=boto3.client):
+        self.region = region
+        self.client_factory = client_factory
+
+    def get_stack_outputs(self, stack_name):
+        client = self.client_factory('cloudformation', region_name=self.region)
+        response = client.describe_stacks(StackName=stack_name)
+        stack = response['Stacks'][0]
+        outputs = stack.get('Outputs', [])
+        return {output['OutputKey']: output['OutputValue'] for output in outputs}
+
+    def get_certificate_arn(self, hostname):
+        client = self.client_factory('acm', region_name=self.region)
+        # One page holds at most a few hundred certificates; the one we need can be on any
+        certificates = (
+            cert
+            for page in client.get_paginator('list_certificates').paginate(CertificateStatuses=['ISSUED'])
+            for cert in page['CertificateSummaryList']
+        )
+        arn = match_certificate(certificates, hostname)
+        if arn is None:
+            raise LookupNotFoundError(f'No issued certificate covers {hostname}')
+        return arn
+
+
+class CachedLookupProvider(LookupProvider):
+    """Lookups answered from a JSON file, asking `provider` only for what is not in it
+
+    The file works like cdk.context.json: each answer is stored under a key naming the
+    account, region and what was looked up, and is reused on every later synth. With
+    `provider=None` (offline) a missing answer is an error instead of an AWS call.
+    Delete an entry, or the file, to look it up again.
+    """
+
+    def __init__(self, provider, account, region, path=DEFAULT_CACHE_FILE):
+        self.provider = provider
+        self.account = account
+        self.region = region
+        self.path = path
+        self._values = None
+
+    def _load(self):
+        if self._values is None:
+            try:
+                with open(self.path) as f:
+                    self._values = json.load(f)
+            except FileNotFoundError:
+                self._values = {}
+        return self._values
+
+    def _save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._values, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.replace(tmp, self.path)
+
+    def _get(self, kind, field, name, method):
+        key = f"{kind}:account={self.account}:{field}={name}:region={self.region}"
+        values = self._load()
+        if key in values:
+            return values[key]
+        if self.provider is None:
+            raise LookupNotFoundError(
+                f"{key} is not in {os.path.normpath(self.path)}; synth once with -c lookups=cached to fill it"
+            )
+        values[key] = getattr(self.provider, method)(name)
+        self._save()
+        return values[key]
+
+    def get_stack_outputs(self, stack_name):
+        return self._get("stack-outputs", "stackName", stack_name, "get_stack_outputs")
+
+    def get_certificate_arn(self, hostname):
+        return self._get("certificate", "domainName", hostname, "get_certificate_arn")
+
+
+def lookup_provider(mode, account, region, path=DEFAULT_CACHE_FILE):
+    """`live` asks AWS every time, `cached` (the default) asks once and keeps the answer
+    in `path`, `offline` only reads `path`"""
+    mode = mode or "cached"
+    if mode == "live":
+        return AwsLookupProvider(region)
+    if mode == "cached":
+        return CachedLookupProvider(AwsLookupProvider(region), account, region, path)
+    if mode == "offline":
+        return CachedLookupProvider(None, account, region, path)
+    raise ValueError(f"Unknown lookups mode {mode!r}, expected live, cached or offline")
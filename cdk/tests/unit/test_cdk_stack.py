@@ -1,15 +1,237 @@
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
+
+from cdk.langserve_stack import LangServeStack, stage_capacity
+from cdk.lookups import CachedLookupProvider, LookupProvider
+
+ENV = core.Environment(account="123456789012", region="ap-south-1")
+
+VPC_OUTPUTS = {
+    "VpcId": "vpc-12345678",
+    **{f"SharedVpcStackPublicSubnet{i}": f"subnet-public{i}" for i in (1, 2)},
+    **{f"SharedVpcStackAZPublicSubnet{i}": f"ap-south-1{'ab'[i - 1]}" for i in (1, 2)},
+    **{f"SharedVpcStackROUTETBPublicSubnet{i}": f"rtb-public{i}" for i in (1, 2)},
+    **{f"SharedVpcStackPrivateDevSubnet{i}": f"subnet-dev{i}" for i in (1, 2)},
+    **{f"SharedVpcStackROUTETBPrivateDevSubnet{i}": f"rtb-dev{i}" for i in (1, 2)},
+    **{f"SharedVpcStackPrivateProdSubnet{i}": f"subnet-prod{i}" for i in (1, 2)},
+    **{f"SharedVpcStackROUTETBPrivateProdSubnet{i}": f"rtb-prod{i}" for i in (1, 2)},
+}
+
+
+CERTIFICATE_ARN = "arn:aws:acm:ap-south-1:123456789012:certificate/test"
+
+
+class FixedLookups(LookupProvider):
+    """AWS lookups answered from fixed values"""
+
+    def get_stack_outputs(self, stack_name):
+        return VPC_OUTPUTS
+
+    def get_certificate_arn(self, hostname):
+        return CERTIFICATE_ARN
 
-from cdk.cdk.langserve_stack import LangServeStack
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in cdk/cdk_stack.py
-def test_sqs_queue_created():
+# Read by the stack and passed to the container
+STACK_ENV = ("OPENAI_API_KEY", "LANGCHAIN_API_KEY", "LANGCHAIN_PROJECT", "MONGO_CONNECTION_STRING",
+             "MONGO_DATABASE", "MONGO_COLLECTION")
+
+
+def _set_stack_env(monkeypatch):
+    for name in STACK_ENV:
+        monkeypatch.setenv(name, "test")
+
+
+@pytest.fixture(autouse=True)
+def stack_env(monkeypatch):
+    _set_stack_env(monkeypatch)
+
+
+def synth(stage="dev", capacity=None, lookups=None):
     app = core.App()
-    stack = LangServeStack(app, "cdk")
-    template = assertions.Template.from_stack(stack)
+    stack = LangServeStack(
+        app, f"LangServeStack-{stage}", "SharedVpcStack", stage, "chat", "example.com", env=ENV,
+        capacity=capacity, lookups=lookups or FixedLookups(),
+    )
+    return assertions.Template.from_stack(stack)
+
+
+@pytest.fixture(scope="module")
+def dev():
+    # Synthesized once for the tests that only read it
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        _set_stack_env(monkeypatch)
+        return synth("dev")
+
+
+def test_task_size_and_scaling_bounds_per_stage(dev):
+    dev.has_resource_properties("AWS::ECS::TaskDefinition", {"Cpu": "256", "Memory": "512"})
+    dev.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {"MinCapacity": 1, "MaxCapacity": 2})
+
+    prod = synth("prod")
+    prod.has_resource_properties("AWS::ECS::TaskDefinition", {"Cpu": "512", "Memory": "1024"})
+    prod.has_resource_properties("AWS::ECS::Service", {"DesiredCount": 2})
+    prod.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {"MinCapacity": 2, "MaxCapacity": 10})
+
+
+def test_capacity_overrides():
+    template = synth("prod", {"max_tasks": 20, "requests_per_target": 60})
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {"MinCapacity": 2, "MaxCapacity": 20})
+    template.has_resource_properties(
+        "AWS::ApplicationAutoScaling::ScalingPolicy",
+        {"TargetTrackingScalingPolicyConfiguration": assertions.Match.object_like({"TargetValue": 60})},
+    )
+
+
+def test_capacity_validation():
+    with pytest.raises(ValueError):
+        stage_capacity("dev", {"min_tasks": 3, "max_tasks": 2})
+    with pytest.raises(ValueError):
+        stage_capacity("dev", {"max_task": 3})
+
+
+def test_target_tracking_on_requests_and_cpu(dev):
+    dev.resource_count_is("AWS::ApplicationAutoScaling::ScalingPolicy", 2)
+    dev.has_resource_properties(
+        "AWS::ApplicationAutoScaling::ScalingPolicy",
+        {
+            "PolicyType": "TargetTrackingScaling",
+            "TargetTrackingScalingPolicyConfiguration": {
+                "PredefinedMetricSpecification": assertions.Match.object_like(
+                    {"PredefinedMetricType": "ALBRequestCountPerTarget"}
+                ),
+                "TargetValue": 120,
+                "ScaleInCooldown": 300,
+                "ScaleOutCooldown": 60,
+            },
+        },
+    )
+    dev.has_resource_properties(
+        "AWS::ApplicationAutoScaling::ScalingPolicy",
+        {
+            "PolicyType": "TargetTrackingScaling",
+            "TargetTrackingScalingPolicyConfiguration": {
+                "PredefinedMetricSpecification": {"PredefinedMetricType": "ECSServiceAverageCPUUtilization"},
+                "TargetValue": 60,
+                "ScaleInCooldown": 300,
+                "ScaleOutCooldown": 60,
+            },
+        },
+    )
+
+
+def test_container_health_check_and_graceful_shutdown(dev):
+    dev.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {
+            "ContainerDefinitions": [
+                assertions.Match.object_like(
+                    {
+                        "HealthCheck": assertions.Match.object_like(
+                            {"Command": ["CMD-SHELL", assertions.Match.string_like_regexp("localhost:8080/")]}
+                        ),
+                        "StopTimeout": 30,
+                        "Environment": assertions.Match.array_with(
+                            [{"Name": "GRACEFUL_SHUTDOWN_SECONDS", "Value": "20"}]
+                        ),
+                    }
+                )
+            ]
+        },
+    )
+
+
+def test_target_group_drains_quickly_and_routes_to_least_busy(dev):
+    dev.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::TargetGroup",
+        {
+            "HealthCheckPath": "/",
+            "TargetGroupAttributes": assertions.Match.array_with(
+                [
+                    {"Key": "load_balancing.algorithm.type", "Value": "least_outstanding_requests"},
+                    {"Key": "deregistration_delay.timeout_seconds", "Value": "30"},
+                ]
+            ),
+        },
+    )
+
+
+def test_session_affinity_per_stage(dev):
+    dev.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::TargetGroup",
+        {"TargetGroupAttributes": assertions.Match.not_(
+            assertions.Match.array_with([{"Key": "stickiness.enabled", "Value": "true"}])
+        )},
+    )
+    dev.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {"ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([{"Name": "SESSION_AFFINITY", "Value": "false"}]),
+        })]},
+    )
+
+    prod = synth("prod")
+    prod.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::TargetGroup",
+        {"TargetGroupAttributes": assertions.Match.array_with([
+            {"Key": "stickiness.enabled", "Value": "true"},
+            {"Key": "stickiness.type", "Value": "app_cookie"},
+            {"Key": "stickiness.app_cookie.cookie_name", "Value": "chatbot_affinity"},
+            {"Key": "stickiness.app_cookie.duration_seconds", "Value": "3600"},
+        ])},
+    )
+    prod.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {"ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "SESSION_AFFINITY", "Value": "true"},
+                {"Name": "AFFINITY_COOKIE", "Value": "chatbot_affinity"},
+            ]),
+        })]},
+    )
+
+
+def test_profiling_only_with_a_token(dev, monkeypatch):
+    dev.has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {"ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.not_(assertions.Match.array_with([{"Name": "PROFILING", "Value": "true"}])),
+        })]},
+    )
+
+    monkeypatch.setenv("PROFILING_TOKEN", "admin-token")
+    synth("dev").has_resource_properties(
+        "AWS::ECS::TaskDefinition",
+        {"ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "PROFILING", "Value": "true"},
+                {"Name": "PROFILING_TOKEN", "Value": "admin-token"},
+            ]),
+        })]},
+    )
+
+
+def test_load_balancer_idle_timeout_covers_streams(dev):
+    dev.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::LoadBalancer",
+        {
+            "LoadBalancerAttributes": assertions.Match.array_with(
+                [{"Key": "idle_timeout.timeout_seconds", "Value": "300"}]
+            )
+        },
+    )
+
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+def test_synth_offline_from_lookups_file(tmp_path):
+    path = tmp_path / "lookups.context.json"
+    path.write_text(json.dumps({
+        "stack-outputs:account=123456789012:stackName=SharedVpcStack:region=ap-south-1": VPC_OUTPUTS,
+        "certificate:account=123456789012:domainName=chat-dev.example.com:region=ap-south-1": CERTIFICATE_ARN,
+    }))
+    template = synth("dev", lookups=CachedLookupProvider(None, ENV.account, ENV.region, str(path)))
+    template.has_resource_properties(
+        "AWS::ElasticLoadBalancingV2::Listener",
+        {"Port": 443, "Certificates": [{"CertificateArn": CERTIFICATE_ARN}]},
+    )
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from cdk.lookups import (
+    AwsLookupProvider,
+    CachedLookupProvider,
+    LookupNotFoundError,
+    LookupProvider,
+    certificate_covers,
+    lookup_provider,
+    match_certificate,
+)
+
+
+def cert(arn, name, *alternative_names):
+    return {"CertificateArn": arn, "DomainName": name, "SubjectAlternativeNameSummaries": list(alternative_names)}
+
+
+class FakeAcm:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def get_paginator(self, operation):
+        assert operation == "list_certificates"
+        return self
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return ({"CertificateSummaryList": page} for page in self.pages)
+
+
+class CountingLookups(LookupProvider):
+    def __init__(self):
+        self.calls = 0
+
+    def get_stack_outputs(self, stack_name):
+        self.calls += 1
+        return {"VpcId": f"vpc-of-{stack_name}"}
+
+    def get_certificate_arn(self, hostname):
+        self.calls += 1
+        return f"arn-for-{hostname}"
+
+
+def test_certificate_covers():
+    assert certificate_covers("chat-dev.example.com", "chat-dev.example.com")
+    assert certificate_covers("*.example.com", "chat-dev.example.com")
+    assert certificate_covers("*.Example.com.", "CHAT-dev.example.com")
+    assert not certificate_covers("*.example.com", "example.com")
+    assert not certificate_covers("*.example.com", "a.chat-dev.example.com")
+    # What the substring match used to accept
+    assert not certificate_covers("example.com.evil.org", "chat-dev.example.com")
+    assert not certificate_covers("notexample.com", "chat-dev.example.com")
+
+
+def test_exact_certificate_preferred_over_wildcard():
+    certificates = [
+        cert("wildcard", "*.example.com"),
+        cert("other", "other.org"),
+        cert("exact", "example.com", "chat-dev.example.com"),
+    ]
+    assert match_certificate(certificates, "chat-dev.example.com") == "exact"
+    assert match_certificate(certificates[:2], "chat-dev.example.com") == "wildcard"
+    assert match_certificate(certificates[1:2], "chat-dev.example.com") is None
+
+
+def test_certificate_search_reads_every_page():
+    acm = FakeAcm([[cert(f"arn-{i}", f"site{i}.org") for i in range(1000)], [cert("ours", "*.example.com")]])
+    provider = AwsLookupProvider("ap-south-1", client_factory=lambda service, region_name: acm)
+    assert provider.get_certificate_arn("chat-dev.example.com") == "ours"
+    assert acm.calls == [{"CertificateStatuses": ["ISSUED"]}]
+    with pytest.raises(LookupNotFoundError):
+        provider.get_certificate_arn("chat-dev.example.org")
+
+
+def test_cached_lookups_ask_once_and_persist(tmp_path):
+    path = str(tmp_path / "lookups.context.json")
+    inner = CountingLookups()
+    cached = CachedLookupProvider(inner, "123456789012", "ap-south-1", path)
+    for _ in range(3):
+        assert cached.get_stack_outputs("SharedVpcStack") == {"VpcId": "vpc-of-SharedVpcStack"}
+        assert cached.get_certificate_arn("chat-dev.example.com") == "arn-for-chat-dev.example.com"
+    assert inner.calls == 2
+
+    with open(path) as f:
+        assert json.load(f) == {
+            "certificate:account=123456789012:domainName=chat-dev.example.com:region=ap-south-1":
+                "arn-for-chat-dev.example.com",
+            "stack-outputs:account=123456789012:stackName=SharedVpcStack:region=ap-south-1":
+                {"VpcId": "vpc-of-SharedVpcStack"},
+        }
+
+    # A later synth reads the file, and offline never asks
+    offline = CachedLookupProvider(None, "123456789012", "ap-south-1", path)
+    assert offline.get_certificate_arn("chat-dev.example.com") == "arn-for-chat-dev.example.com"
+    with pytest.raises(LookupNotFoundError):
+        offline.get_certificate_arn("chat-prod.example.com")
+    # Another account or region is another entry
+    with pytest.raises(LookupNotFoundError):
+        CachedLookupProvider(None, "123456789012", "us-east-1", path).get_stack_outputs("SharedVpcStack")
+
+
+def test_lookup_modes(tmp_path):
+    path = str(tmp_path / "lookups.context.json")
+    assert isinstance(lookup_provider("live", "1", "ap-south-1"), AwsLookupProvider)
+    cached = lookup_provider(None, "1", "ap-south-1", path)
+    assert isinstance(cached, CachedLookupProvider) and isinstance(cached.provider, AwsLookupProvider)
+    assert lookup_provider("offline", "1", "ap-south-1", path).provider is None
+    with pytest.raises(ValueError):
+        lookup_provider("sometimes", "1", "ap-south-1", path)
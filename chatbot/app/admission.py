@@ -0,0 +1,202 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+from .metrics import admission_limit, admission_queued, admission_rejections, admission_wait_seconds
+
+
+class AdmissionController:
+    """Caps concurrent agent requests and queues a bounded number of the rest
+
+    The cap follows LLM latency the way a gradient concurrency limiter does: while
+    calls are as fast as the best recently seen and the slots are in use, it grows by
+    about sqrt(limit); when they slow down it shrinks in proportion, so a slow OpenAI
+    does not pile up work.
+    The queue only holds as many requests as can start before their deadline: by
+    Little's law, `limit` slots each freeing every `W` seconds (the mean request time)
+    serve `limit * deadline / W` waiters in time. Everyone beyond that is rejected at
+    once instead of timing out later.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 16,
+        min_limit: int = 2,
+        max_limit: int = 64,
+        max_queue: int = 100,
+        queue_timeout: float = 10.0,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "timeout": 0}
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Smoothed request duration, for Little's law and Retry-After
+        self._request_seconds: Optional[float] = None
+        # Smoothed LLM latency and the best seen lately (decays upwards so it can recover)
+        self._llm_seconds: Optional[float] = None
+        self._llm_best: Optional[float] = None
+        admission_limit.labels().set(self.limit)
+        admission_queued.labels().set(0)
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls(
+            initial_limit=int(os.environ.get("ADMISSION_INITIAL_LIMIT", "16")),
+            min_limit=int(os.environ.get("ADMISSION_MIN_LIMIT", "2")),
+            max_limit=int(os.environ.get("ADMISSION_MAX_LIMIT", "64")),
+            max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "100")),
+            queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10")),
+        )
+
+    @property
+    def slots(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def queue_capacity(self) -> int:
+        if self._request_seconds is None:
+            return self.max_queue
+        servable = self.slots * self.queue_timeout / self._request_seconds
+        return max(0, min(self.max_queue, math.floor(servable)))
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free for a new request"""
+        if self._request_seconds is None:
+            return 1
+        return max(1, math.ceil(self._request_seconds * (len(self._waiters) + 1) / self.slots))
+
+    async def acquire(self) -> Optional[str]:
+        """Take a slot, waiting if needed; returns the rejection reason instead if there is none"""
+        if self.in_flight < self.slots and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return None
+        if len(self._waiters) >= self.queue_capacity():
+            return self._reject("queue_full")
+        loop = asyncio.get_running_loop()
+        # Resolves True when a slot is handed over, False when the deadline passes first
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        admission_queued.labels().set(len(self._waiters))
+        start = time.perf_counter()
+        # Not asyncio.wait_for: it swallows a cancellation that arrives after the grant
+        deadline = loop.call_later(self.queue_timeout, _expire, waiter)
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            # The client went away; give back the slot if it was granted meanwhile
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.release()
+            else:
+                self._forget(waiter)
+            raise
+        finally:
+            deadline.cancel()
+        if not granted:
+            self._forget(waiter)
+            return self._reject("timeout")
+        admission_wait_seconds.labels().observe(time.perf_counter() - start)
+        self.admitted += 1
+        return None
+
+    def release(self, duration: Optional[float] = None) -> None:
+        self.in_flight -= 1
+        if duration is not None:
+            self._request_seconds = _ewma(self._request_seconds, duration, 0.1)
+        self._wake()
+
+    def observe_llm(self, seconds: float) -> None:
+        """Adjust the limit to one LLM call's latency"""
+        self._llm_seconds = _ewma(self._llm_seconds, seconds, 0.2)
+        self._llm_best = seconds if self._llm_best is None else min(self._llm_best * 1.01, seconds)
+        gradient = max(0.5, min(1.0, self._llm_best / self._llm_seconds))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        if self.in_flight < self.slots / 2:
+            # Latency under light load says nothing about a higher limit
+            target = min(target, self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, 0.8 * self.limit + 0.2 * target))
+        admission_limit.labels().set(self.limit)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < self.slots:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+        admission_queued.labels().set(len(self._waiters))
+
+    def _forget(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        admission_queued.labels().set(len(self._waiters))
+
+    def _reject(self, reason: str) -> str:
+        self.rejected[reason] += 1
+        admission_rejections.labels(reason).inc()
+        return reason
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "queue_capacity": self.queue_capacity(),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "request_seconds": self._request_seconds,
+            "llm_seconds": self._llm_seconds,
+        }
+
+
+def _expire(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(False)
+
+
+def _ewma(current: Optional[float], sample: float, alpha: float) -> float:
+    return sample if current is None else (1 - alpha) * current + alpha * sample
+
+
+class AdmissionControlMiddleware:
+    """Runs POST requests under `prefix` (the agent routes) through the AdmissionController
+
+    Everything else, including the health check at `/`, bypasses it. A full queue is
+    answered 429 and a request whose wait ran past the deadline 503, both with
+    Retry-After, before the body is read.
+    """
+
+    def __init__(self, app, controller: AdmissionController, prefix: str = "/website-bot"):
+        self.app = app
+        self.controller = controller
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        rejection = await self.controller.acquire()
+        if rejection is not None:
+            response = JSONResponse(
+                {"detail": "Too many requests, try again later" if rejection == "queue_full" else "Server busy"},
+                status_code=429 if rejection == "queue_full" else 503,
+                headers={"Retry-After": str(self.controller.retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(time.perf_counter() - start)
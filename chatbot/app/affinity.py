@@ -0,0 +1,132 @@
+import hashlib
+import os
+import socket
+from typing import Any, Callable, Dict, Optional
+
+from .metrics import session_affinity
+from .request_body import read_agent_calls
+
+
+def session_key(session_id: str) -> str:
+    # The cookie names the session without carrying its id
+    return hashlib.sha256(session_id.encode()).hexdigest()[:16]
+
+
+def task_id() -> str:
+    # Every Fargate task has its own hostname
+    return os.environ.get("TASK_ID") or socket.gethostname()
+
+
+class SessionAffinity:
+    """The affinity cookie of this task, and how often sessions arrive from another one
+
+    The cookie is `<session key>.<task>`. The ALB's app-cookie stickiness sees it and
+    sends the client's next requests to the task that set it. A request that comes back
+    with the cookie of the same session but another task means the session moved (a
+    scale-in, a failed task, or a client that dropped the ALB's cookie). It is counted,
+    and `on_migrate` is called with the session_id so that state this task kept from an
+    earlier visit is dropped rather than used stale.
+    """
+
+    def __init__(
+        self,
+        cookie_name: str = "chatbot_affinity",
+        max_age: int = 3600,
+        same_site: str = "lax",
+        secure: bool = False,
+        on_migrate: Optional[Callable[[str], None]] = None,
+        task: Optional[str] = None,
+    ):
+        self.cookie_name = cookie_name
+        self.on_migrate = on_migrate
+        self.task = task or task_id()
+        self.counts = {"same": 0, "migrated": 0, "new": 0}
+        self._cookie_prefix = cookie_name.encode() + b"="
+        self._attributes = f"; Path=/; Max-Age={max_age}; HttpOnly; SameSite={same_site.capitalize()}"
+        if secure or same_site.lower() == "none":
+            # Browsers drop SameSite=None cookies that are not Secure
+            self._attributes += "; Secure"
+
+    @classmethod
+    def from_env(cls, on_migrate: Optional[Callable[[str], None]] = None) -> "SessionAffinity":
+        return cls(
+            cookie_name=os.environ.get("AFFINITY_COOKIE", "chatbot_affinity"),
+            max_age=int(os.environ.get("AFFINITY_COOKIE_MAX_AGE_SECONDS", "3600")),
+            same_site=os.environ.get("AFFINITY_COOKIE_SAMESITE", "lax"),
+            secure=os.environ.get("AFFINITY_COOKIE_SECURE", "false").lower() == "true",
+            on_migrate=on_migrate,
+        )
+
+    def cookie(self, session_id: str) -> bytes:
+        return f"{self.cookie_name}={session_key(session_id)}.{self.task}{self._attributes}".encode("latin-1")
+
+    def read_cookie(self, headers) -> Optional[str]:
+        for name, value in headers:
+            if name != b"cookie":
+                continue
+            for part in value.split(b";"):
+                part = part.strip()
+                if part.startswith(self._cookie_prefix):
+                    return part[len(self._cookie_prefix):].decode("latin-1")
+        return None
+
+    def check(self, session_id: str, cookie: Optional[str]) -> str:
+        """'same', 'migrated' or 'new' (no cookie, or one of another session)"""
+        cookie_key, _, cookie_task = (cookie or "").partition(".")
+        if cookie_key != session_key(session_id):
+            result = "new"
+        elif cookie_task == self.task:
+            result = "same"
+        else:
+            result = "migrated"
+            if self.on_migrate is not None:
+                self.on_migrate(session_id)
+        self.counts[result] += 1
+        session_affinity.labels(result).inc()
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        returning = self.counts["same"] + self.counts["migrated"]
+        return {
+            "task": self.task,
+            "cookie": self.cookie_name,
+            **self.counts,
+            # Of the requests that came back with this session's cookie
+            "migration_rate": round(self.counts["migrated"] / returning, 4) if returning else None,
+        }
+
+
+class SessionAffinityMiddleware:
+    """Checks the affinity cookie of POST requests under `prefix` and sets it on the response
+
+    Requests without a session_id, and batches over several sessions, are left alone.
+    """
+
+    def __init__(self, app, affinity: SessionAffinity, prefix: str = "/website-bot"):
+        self.app = app
+        self.affinity = affinity
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        calls, receive = await read_agent_calls(scope, receive)
+        if calls is None:
+            await self.app(scope, receive, send)
+            return
+
+        sessions = {session_id for session_id, _ in calls}
+        if len(sessions) != 1 or None in sessions:
+            await self.app(scope, receive, send)
+            return
+        session_id = sessions.pop()
+        self.affinity.check(session_id, self.affinity.read_cookie(scope["headers"]))
+        cookie = self.affinity.cookie(session_id)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie)]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
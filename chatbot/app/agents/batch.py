@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Type, Union
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import get_config_list
+from langchain_core.runnables.utils import ConfigurableFieldSpec
+
+from ..history.batch import BatchHistories
+from ..history.cache import HistoryFactory, SessionHistoryCache, WriteBehindWriter
+from ..metrics import batch_items
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRunner(Runnable[Dict[str, Any], Any]):
+    """Runs /batch items concurrently around one bulk history read and one bulk write
+
+    The default abatch runs every item through the whole chain on its own: a history
+    read before it and a write after it, and the first failure fails the batch. Here
+    the sessions of all items are read up front (see BatchHistories), at most
+    `max_concurrency` items run at a time against those histories, and what they add is
+    written in one go once the last item finished. An item that fails gets
+    `{"output": None, "error": <exception type>}` in its place and writes nothing; the
+    others are answered and saved as usual. If the bulk read fails, the items read
+    their own histories as they would outside a batch.
+
+    Everything but abatch is passed through.
+    """
+
+    def __init__(
+        self,
+        runnable: Runnable,
+        history_factory: HistoryFactory,
+        cache: Optional[SessionHistoryCache] = None,
+        writer: Optional[WriteBehindWriter] = None,
+        max_concurrency: int = 8,
+    ):
+        self.runnable = runnable
+        self.history_factory = history_factory
+        self.cache = cache
+        self.writer = writer
+        self.max_concurrency = max_concurrency
+        self.batches = 0
+        self.items = 0
+        self.failed_items = 0
+        self.failed_writes = 0
+
+    @property
+    def InputType(self) -> Type:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Type:
+        return self.runnable.OutputType
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_output_schema(config)
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return self.runnable.config_specs
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.runnable.stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async for chunk in self.runnable.astream(input, config, **kwargs):
+            yield chunk
+
+    async def abatch(
+        self,
+        inputs: List[Dict[str, Any]],
+        config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> List[Any]:
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        self.batches += 1
+        self.items += len(inputs)
+
+        batch = BatchHistories(self.history_factory, self.cache, self.writer)
+        session_ids = [c.get("configurable", {}).get("session_id") for c in configs]
+        try:
+            await batch.aload(session_id for session_id in session_ids if session_id is not None)
+        except Exception:
+            logger.warning("batch history read failed, items read their own", exc_info=True)
+            batch = None
+
+        limit = min(self.max_concurrency, configs[0].get("max_concurrency") or self.max_concurrency)
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(input: Dict[str, Any], config: RunnableConfig) -> Any:
+            async with semaphore:
+                try:
+                    output = await self.runnable.ainvoke(input, config, **kwargs)
+                except Exception as e:
+                    logger.warning(
+                        "batch item failed",
+                        extra={"session_id": config.get("configurable", {}).get("session_id")},
+                        exc_info=True,
+                    )
+                    self.failed_items += 1
+                    batch_items.labels("error").inc()
+                    return e
+                batch_items.labels("ok").inc()
+                return output
+
+        # The items' tasks copy the context, and with it the batch, when they are created
+        token = batch.activate() if batch is not None else None
+        try:
+            results = await asyncio.gather(*(run(input, config) for input, config in zip(inputs, configs)))
+        finally:
+            if token is not None:
+                BatchHistories.deactivate(token)
+        if batch is not None:
+            self.failed_writes += (await batch.aflush())["failed"]
+
+        if return_exceptions:
+            return results
+        return [{"output": None, "error": type(r).__name__} if isinstance(r, Exception) else r for r in results]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "batches": self.batches,
+            "items": self.items,
+            "failed_items": self.failed_items,
+            "failed_writes": self.failed_writes,
+        }
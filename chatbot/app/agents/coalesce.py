@@ -0,0 +1,146 @@
+import asyncio
+import copy
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from langchain_core.runnables import RunnableConfig, ensure_config
+
+from .routing import PreRouter
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Flight:
+    """One in-flight execution and everything it produced so far"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        # Late joiners get everything already produced before the live items
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self.items:
+            queue.put_nowait(item)
+        self.subscribers.append(queue)
+        return queue
+
+    def publish(self, item: Any) -> None:
+        self.items.append(item)
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+
+def normalize_input(text: str) -> str:
+    return " ".join(text.lower().strip(" ?!.").split())
+
+
+class SingleFlight(PreRouter):
+    """Shares one execution between identical concurrent first questions
+
+    Async requests whose input normalizes to the same text and whose session has no
+    history yet join the execution already in flight instead of starting their own.
+    The execution runs in its own task, so a caller disconnecting does not cancel it
+    for the others. Streaming callers each receive copies of every chunk, including
+    those produced before they joined. Only the first caller's session is written by
+    the agent; every other caller writes its own human/AI turn once the answer is in.
+    Sync calls are passed straight through.
+    """
+
+    def __init__(self, runnable, get_session_history, input_key: str = "input"):
+        super().__init__(runnable, get_session_history, input_key=input_key)
+        self._flights: Dict[Tuple[str, str], _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.skipped = 0
+
+    def route(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        return None
+
+    async def _key(self, mode: str, input: Dict[str, Any], config: RunnableConfig) -> Optional[Tuple[str, str]]:
+        question = input.get(self.input_key)
+        if not isinstance(question, str) or not self._has_session(config):
+            self.skipped += 1
+            return None
+        if not await self._afirst_turn(config):
+            self.skipped += 1
+            return None
+        return mode, normalize_input(question)
+
+    async def _run(self, key: Tuple[str, str], flight: _Flight, input: Dict[str, Any], config: RunnableConfig, kwargs):
+        try:
+            if key[0] == "stream":
+                async for chunk in self.runnable.astream(input, config, **kwargs):
+                    flight.publish(chunk)
+            else:
+                flight.publish(await self.runnable.ainvoke(input, config, **kwargs))
+            flight.publish(_DONE)
+        except BaseException as e:
+            flight.publish(_Failure(e))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    async def _join(self, key: Tuple[str, str], input: Dict[str, Any], config: RunnableConfig, kwargs) -> AsyncIterator[Any]:
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            self.leaders += 1
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, input, config, kwargs))
+        else:
+            self.followers += 1
+        queue = flight.subscribe()
+        final = None
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            final = self._final(item, final)
+            if not leader:
+                item = copy.copy(item)
+                if isinstance(item, dict) and self.input_key in item:
+                    item[self.input_key] = input[self.input_key]
+            yield item
+        if not leader and final is not None:
+            await self._session_history(config).aadd_messages(self._turn(input, final["output"]))
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        key = await self._key("invoke", input, config)
+        if key is None:
+            return await self.runnable.ainvoke(input, config, **kwargs)
+        output = None
+        async for output in self._join(key, input, config, kwargs):
+            pass
+        return output
+
+    async def astream(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        config = ensure_config(config)
+        key = await self._key("stream", input, config)
+        if key is None:
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                yield chunk
+            return
+        async for chunk in self._join(key, input, config, kwargs):
+            yield chunk
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "skipped": self.skipped,
+        }
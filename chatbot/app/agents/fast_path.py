@@ -0,0 +1,122 @@
+import re
+import threading
+from typing import Any, Dict, Optional
+
+from langchain_core.runnables import RunnableConfig
+
+from ..tools.catalog import TreatmentCatalog
+from ..tools.rag import format_price
+from .routing import PreRouter
+
+# Plain "how much is X" questions. Anything else, including questions about more than
+# one treatment, goes to the agent
+PRICE_QUESTIONS = [
+    re.compile(p)
+    for p in (
+        r"^(?:what is |whats |tell me )?(?:the )?(?:price|cost|charges?|fees?|rate) (?:of|for) (?:a |an |the )?(?P<treatment>.+)$",
+        r"^how much (?:is|are|does|do|for|will) (?:a |an |the |my )?(?P<treatment>.+?)(?: cost| charge| be)?$",
+        r"^(?P<treatment>.+?) (?:price|cost|charges?|fees?|rate)$",
+    )
+]
+MULTIPLE_ITEMS = re.compile(r"\b(?:and|or|vs|versus|with|plus)\b|,|&")
+_PUNCTUATION = re.compile(r"[?!.]+")
+_POLITE = re.compile(r"^(?:hi|hello|hey|please|pls|sir|madam|mam)\b[\s,]*|[\s,]*\b(?:please|pls)$")
+
+DEFAULT_TEMPLATE = "The price of {name} is {price}."
+
+
+class FastPathStats:
+    def __init__(self):
+        self.hits = 0
+        self.fallthroughs = 0
+        self._lock = threading.Lock()
+
+    def hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def fallthrough(self) -> None:
+        with self._lock:
+            self.fallthroughs += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        total = self.hits + self.fallthroughs
+        return {
+            "hits": self.hits,
+            "fallthroughs": self.fallthroughs,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def extract_treatment(question: str, max_words: int = 10) -> Optional[str]:
+    """The treatment asked about in a plain price question, or None"""
+    text = " ".join(_PUNCTUATION.sub(" ", question.lower().replace("'", "")).split())
+    text = _POLITE.sub("", text).strip()
+    if not text or len(text.split()) > max_words or MULTIPLE_ITEMS.search(text):
+        return None
+    for pattern in PRICE_QUESTIONS:
+        match = pattern.match(text)
+        if match:
+            return match.group("treatment").strip()
+    return None
+
+
+class PriceFastPath(PreRouter):
+    """Answers plain price questions from the catalog without calling the LLM
+
+    A question is answered here only when it matches one of PRICE_QUESTIONS, the
+    best catalog match scores at least `min_score` and beats the runner-up by `min_margin`,
+    and it opens the session: later in a conversation "how much is a crown" may mean the
+    crown just discussed, so the agent answers it. Everything else falls through to the
+    agent. Hits and fallthroughs are counted in `stats`.
+    """
+
+    def __init__(
+        self,
+        runnable,
+        get_session_history,
+        catalog: TreatmentCatalog,
+        min_score: float = 0.9,
+        min_margin: float = 0.1,
+        template: str = DEFAULT_TEMPLATE,
+        input_key: str = "input",
+    ):
+        super().__init__(runnable, get_session_history, input_key=input_key)
+        self.catalog = catalog
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.template = template
+        self.stats = FastPathStats()
+
+    def route(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        reply = self._reply(input.get(self.input_key))
+        # Only a question that would be answered costs the history query
+        if reply is not None and not self._first_turn(config):
+            reply = None
+        return self._count(reply)
+
+    async def aroute(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        reply = self._reply(input.get(self.input_key))
+        if reply is not None and not await self._afirst_turn(config):
+            reply = None
+        return self._count(reply)
+
+    def _count(self, reply: Optional[str]) -> Optional[str]:
+        if reply is None:
+            self.stats.fallthrough()
+        else:
+            self.stats.hit()
+        return reply
+
+    def _reply(self, question: Any) -> Optional[str]:
+        if not isinstance(question, str):
+            return None
+        treatment = extract_treatment(question)
+        if treatment is None:
+            return None
+        matches = self.catalog.search(treatment, k=2)
+        if not matches or matches[0].score < self.min_score:
+            return None
+        if len(matches) > 1 and matches[0].score - matches[1].score < self.min_margin:
+            return None
+        return self.template.format(name=matches[0].name, price=format_price(matches[0].price))
@@ -0,0 +1,322 @@
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableConfig
+
+from ..tools.catalog import SYNONYMS, TreatmentCatalog, normalize
+from .routing import PreRouter
+
+# Words that carry nothing: articles, greetings, politeness
+FILLER_WORDS = {
+    "a", "an", "the", "of", "for", "my", "me", "i", "tell", "please", "pls", "hi", "hello", "hey",
+    "in", "at", "your", "clinic",
+}
+# However a price is asked for, "price of braces", "braces cost?" and "how much are braces"
+# all become "price brace"
+PRICE_WORDS = {"price", "prices", "cost", "costs", "charge", "charges", "fee", "fees", "rate", "rates"}
+# Openers of yes/no questions ("do you do implants", "is rct painful"); they are kept
+YES_NO_WORDS = {"is", "are", "do", "does", "can", "could", "will", "would", "should", "did", "have", "has"}
+# Openers of other questions ("what is rct", "why do gums bleed"); kept too
+OPEN_WORDS = {"what", "whats", "how", "which", "when", "where", "why", "who"}
+INTENTS = ("price", "yes_no", "open")
+# "3 teeth" and "three teeth" are the same question, "2 teeth" is not
+NUMBER_WORDS = {
+    "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
+    "six": "6", "seven": "7", "eight": "8", "nine": "9", "ten": "10",
+}
+
+
+def _stem(word: str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def _question_words(text: str) -> List[str]:
+    text = f" {normalize(text)} ".replace(" how much ", " price ")
+    return [w for w in text.split() if w not in FILLER_WORDS]
+
+
+def question_intent(text: str) -> str:
+    """What kind of answer a question wants: a price, a yes or no, or anything else"""
+    words = _question_words(text)
+    if any(w in PRICE_WORDS for w in words):
+        return "price"
+    if words and words[0] in YES_NO_WORDS:
+        return "yes_no"
+    return "open"
+
+
+def normalize_question(text: str) -> str:
+    words = _question_words(text)
+    if any(w in PRICE_WORDS for w in words):
+        # For a price, how the question is put does not matter
+        asking = PRICE_WORDS | YES_NO_WORDS | OPEN_WORDS | {"you"}
+        words = ["price"] + [w for w in words if w not in asking]
+    return " ".join(_stem(w) for w in " ".join(SYNONYMS.get(w, w) for w in words).split())
+
+
+def question_numbers(text: str) -> List[str]:
+    """Every number in a question, as digits, in order"""
+    words = normalize(text).split()
+    return [NUMBER_WORDS.get(w, w) for w in words if w.isdigit() or w in NUMBER_WORDS]
+
+
+class HashingEmbeddings(Embeddings):
+    """Local, deterministic embeddings: hashed word unigrams and character trigrams
+
+    No model and no network, so the response cache can run (and be tested) offline.
+    Near-identical phrasings of the same short question land close together.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        normalized = normalize_question(text)
+        features = normalized.split()
+        padded = f" {normalized} "
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feature in features:
+            h = zlib.crc32(feature.encode())
+            vector[h % self.dimensions] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class SemanticResponseCache:
+    """Answers keyed by question embedding, matched by cosine similarity
+
+    Vectors live in one preallocated matrix, so a lookup is a single matrix-vector
+    product. Only questions of the same intent (see question_intent) are compared, so
+    "do you do implants" never gets the answer to "how much is an implant" however
+    close the embeddings are. Entries expire after `ttl_seconds`; when full, the least
+    recently used entry is replaced.
+
+    Price questions are not matched by similarity: "re root canal" is one word away from
+    "root canal" and "3 teeth" one character from "2 teeth". Their key is the treatment
+    `catalog` resolves plus the numbers in the question, and only an exact key hits. A
+    price question the catalog cannot resolve to one treatment is not cached. Without a
+    catalog the key is the normalized question.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = 0.9,
+        ttl_seconds: float = 3600,
+        max_entries: int = 2000,
+        catalog: Optional[TreatmentCatalog] = None,
+    ):
+        self.embeddings = embeddings
+        self.catalog = catalog
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.unresolved = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._intents = np.full(max_entries, -1, dtype=np.int8)
+        self._replies: List[Optional[str]] = [None] * max_entries
+        self._keys: List[Optional[str]] = [None] * max_entries
+        # question -> slot, in LRU order
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        # Price key -> (expiry, reply), in LRU order
+        self._prices: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # Embeddings (or price keys) of recent misses, so storing the answer does not
+        # embed the question again
+        self._pending: "OrderedDict[str, Union[np.ndarray, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def price_key(self, question: str) -> Optional[str]:
+        """The exact key of a price question, or None if it names no single treatment"""
+        if self.catalog is None:
+            subject = normalize_question(question)
+        else:
+            match = self.catalog.resolve(question)
+            if match is None:
+                return None
+            subject = match.name
+        return " ".join([subject, *question_numbers(question)])
+
+    def _miss(self, question: str, pending: Union[np.ndarray, str]) -> None:
+        self.misses += 1
+        self._pending[question] = pending
+        if len(self._pending) > 256:
+            self._pending.popitem(last=False)
+
+    def _match_price(self, question: str) -> Optional[str]:
+        key = self.price_key(question)
+        with self._lock:
+            if key is None:
+                self.misses += 1
+                self.unresolved += 1
+                return None
+            entry = self._prices.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.hits += 1
+                self._prices.move_to_end(key)
+                return entry[1]
+            self._miss(question, key)
+            return None
+
+    def _match(self, question: str, vector: np.ndarray) -> Optional[str]:
+        with self._lock:
+            if self._vectors is not None and self._slots:
+                similarities = self._vectors @ vector
+                similarities[self._expires < time.monotonic()] = -1.0
+                similarities[self._intents != INTENTS.index(question_intent(question))] = -1.0
+                slot = int(np.argmax(similarities))
+                if similarities[slot] >= self.threshold:
+                    self.hits += 1
+                    self._slots.move_to_end(self._keys[slot])
+                    return self._replies[slot]
+            self._miss(question, vector)
+            return None
+
+    def lookup(self, question: str) -> Optional[str]:
+        if question_intent(question) == "price":
+            return self._match_price(question)
+        return self._match(question, np.asarray(self.embeddings.embed_query(question), dtype=np.float32))
+
+    async def alookup(self, question: str) -> Optional[str]:
+        if question_intent(question) == "price":
+            return self._match_price(question)
+        vector = await self.embeddings.aembed_query(question)
+        return self._match(question, np.asarray(vector, dtype=np.float32))
+
+    def store(self, question: str, reply: str) -> None:
+        """Remember the answer to a question that just missed"""
+        with self._lock:
+            # Not pending means the cache was invalidated while the answer was being
+            # produced (it may quote an old price), or the miss is too old to matter
+            vector = self._pending.pop(question, None)
+            if vector is None:
+                return
+            if isinstance(vector, str):
+                self._prices[vector] = (time.monotonic() + self.ttl_seconds, reply)
+                self._prices.move_to_end(vector)
+                if len(self._prices) > self.max_entries:
+                    self._prices.popitem(last=False)
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if question in self._slots:
+                slot = self._slots.pop(question)
+            elif len(self._slots) < self.max_entries:
+                slot = len(self._slots)
+            else:
+                _, slot = self._slots.popitem(last=False)
+            self._slots[question] = slot
+            self._keys[slot] = question
+            self._vectors[slot] = vector
+            self._intents[slot] = INTENTS.index(question_intent(question))
+            self._replies[slot] = reply
+            self._expires[slot] = time.monotonic() + self.ttl_seconds
+
+    def invalidate(self) -> None:
+        """Drop every entry, e.g. because the prices they quote changed"""
+        with self._lock:
+            self._slots.clear()
+            self._prices.clear()
+            self._pending.clear()
+            self._expires[:] = 0
+            self._intents[:] = -1
+            self._replies = [None] * self.max_entries
+            self._keys = [None] * self.max_entries
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._slots) + len(self._prices),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+            "unresolved": self.unresolved,
+        }
+
+
+def embeddings_from_env() -> Embeddings:
+    if os.environ.get("RESPONSE_CACHE_EMBEDDINGS", "hashing") == "openai":
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(model=os.environ.get("RESPONSE_CACHE_EMBEDDING_MODEL", "text-embedding-3-small"))
+    return HashingEmbeddings()
+
+
+class ResponseCacheRouter(PreRouter):
+    """Replays the agent's earlier answer to a near-identical first question
+
+    Only first turns (empty session history) are looked up and stored, since later
+    answers depend on the conversation. The cache is cleared whenever the catalog
+    reloads, so no stale price is replayed.
+    """
+
+    def __init__(
+        self,
+        runnable,
+        get_session_history,
+        cache: SemanticResponseCache,
+        catalog: Optional[TreatmentCatalog] = None,
+        input_key: str = "input",
+    ):
+        super().__init__(runnable, get_session_history, input_key=input_key)
+        self.cache = cache
+        self.catalog = catalog
+        self.skipped = 0
+        if catalog is not None:
+            catalog.add_reload_listener(cache.invalidate)
+
+    def _eligible(self, input: Dict[str, Any], config: RunnableConfig, history_empty: bool) -> bool:
+        if self.catalog is not None:
+            # Hits never touch the catalog, so check for a new file here
+            self.catalog.maybe_reload()
+        if not isinstance(input.get(self.input_key), str) or not history_empty:
+            self.skipped += 1
+            return False
+        return True
+
+    def _mark_miss(self, config: RunnableConfig) -> None:
+        # Tells on_output to store the answer; also shows up on the trace
+        config["metadata"] = {**config.get("metadata", {}), "response_cache": "miss"}
+
+    def route(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        if not self._eligible(input, config, self._first_turn(config)):
+            return None
+        reply = self.cache.lookup(input[self.input_key])
+        if reply is None:
+            self._mark_miss(config)
+        return reply
+
+    async def aroute(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        if not self._eligible(input, config, await self._afirst_turn(config)):
+            return None
+        reply = await self.cache.alookup(input[self.input_key])
+        if reply is None:
+            self._mark_miss(config)
+        return reply
+
+    def on_output(self, input: Dict[str, Any], config: RunnableConfig, output: Any) -> None:
+        if config.get("metadata", {}).get("response_cache") != "miss":
+            return
+        if isinstance(output, dict) and isinstance(output.get("output"), str):
+            self.cache.store(input[self.input_key], output["output"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.cache.stats(), "skipped": self.skipped}
@@ -0,0 +1,140 @@
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Type
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import Runnable, RunnableConfig, ensure_config
+from langchain_core.runnables.utils import ConfigurableFieldSpec
+
+from ..history import ahas_messages, has_messages
+
+
+class PreRouter(Runnable[Dict[str, Any], Any]):
+    """Base for stages in front of the agent that can answer a request on their own
+
+    Subclasses implement `route` (and optionally `aroute`), returning a reply string to
+    answer directly or None to fall through to the wrapped runnable. A direct answer is
+    written to the session history as a human/AI turn, exactly as the agent would have,
+    and returned in the agent's output shape. Schemas and configurable fields (the
+    session_id) are those of the wrapped runnable, so langserve sees no difference.
+    """
+
+    def __init__(
+        self,
+        runnable: Runnable,
+        get_session_history: Callable[[str], BaseChatMessageHistory],
+        input_key: str = "input",
+    ):
+        self.runnable = runnable
+        self.get_session_history = get_session_history
+        self.input_key = input_key
+
+    @property
+    def InputType(self) -> Type:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Type:
+        return self.runnable.OutputType
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_output_schema(config)
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return self.runnable.config_specs
+
+    def route(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        raise NotImplementedError
+
+    async def aroute(self, input: Dict[str, Any], config: RunnableConfig) -> Optional[str]:
+        return self.route(input, config)
+
+    def on_output(self, input: Dict[str, Any], config: RunnableConfig, output: Any) -> None:
+        """Called with the wrapped runnable's final output after a fallthrough"""
+
+    def _output(self, input: Dict[str, Any], reply: str) -> Dict[str, Any]:
+        return {self.input_key: input[self.input_key], "output": reply}
+
+    def _turn(self, input: Dict[str, Any], reply: str):
+        return [HumanMessage(content=input[self.input_key]), AIMessage(content=reply)]
+
+    @staticmethod
+    def _final(chunk: Any, final: Any) -> Any:
+        # The agent streams actions and steps first and the answer in the chunk with "output"
+        return chunk if isinstance(chunk, dict) and "output" in chunk else final
+
+    @staticmethod
+    def _has_session(config: RunnableConfig) -> bool:
+        # Without a session_id let the wrapped runnable raise its usual error
+        return "session_id" in config.get("configurable", {})
+
+    def _session_history(self, config: RunnableConfig) -> BaseChatMessageHistory:
+        return self.get_session_history(config["configurable"]["session_id"])
+
+    def _first_turn(self, config: RunnableConfig) -> bool:
+        # One limit-1 query, not a second load in front of the agent's
+        return not has_messages(self._session_history(config))
+
+    async def _afirst_turn(self, config: RunnableConfig) -> bool:
+        return not await ahas_messages(self._session_history(config))
+
+    def _answer(self, input: Dict[str, Any], config: RunnableConfig, reply: str) -> Dict[str, Any]:
+        def answer(input: Dict[str, Any]) -> Dict[str, Any]:
+            self._session_history(config).add_messages(self._turn(input, reply))
+            return self._output(input, reply)
+
+        return self._call_with_config(answer, input, config)
+
+    async def _aanswer(self, input: Dict[str, Any], config: RunnableConfig, reply: str) -> Dict[str, Any]:
+        async def answer(input: Dict[str, Any]) -> Dict[str, Any]:
+            await self._session_history(config).aadd_messages(self._turn(input, reply))
+            return self._output(input, reply)
+
+        return await self._acall_with_config(answer, input, config)
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        reply = self.route(input, config) if self._has_session(config) else None
+        if reply is None:
+            output = self.runnable.invoke(input, config, **kwargs)
+            self.on_output(input, config, output)
+            return output
+        return self._answer(input, config, reply)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        reply = await self.aroute(input, config) if self._has_session(config) else None
+        if reply is None:
+            output = await self.runnable.ainvoke(input, config, **kwargs)
+            self.on_output(input, config, output)
+            return output
+        return await self._aanswer(input, config, reply)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        config = ensure_config(config)
+        reply = self.route(input, config) if self._has_session(config) else None
+        if reply is None:
+            final = None
+            for chunk in self.runnable.stream(input, config, **kwargs):
+                final = self._final(chunk, final)
+                yield chunk
+            self.on_output(input, config, final)
+        else:
+            yield self._answer(input, config, reply)
+
+    async def astream(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        config = ensure_config(config)
+        reply = await self.aroute(input, config) if self._has_session(config) else None
+        if reply is None:
+            final = None
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                final = self._final(chunk, final)
+                yield chunk
+            self.on_output(input, config, final)
+        else:
+            yield await self._aanswer(input, config, reply)
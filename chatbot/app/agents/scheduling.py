@@ -0,0 +1,56 @@
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Type
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.utils import ConfigurableFieldSpec
+
+from ..scheduler import PriorityScheduler
+
+
+class ScheduledStep(Runnable[Dict[str, Any], Any]):
+    """Runs each step of the agent (prompt, one LLM call, output parser) in a slot of
+    the PriorityScheduler, in the class of the request it serves
+
+    The AgentExecutor calls this once per LLM call and runs the tools in between, so
+    the slot is given back at every LLM-call boundary and the next call queues again
+    in its class. The sync methods are passed through.
+    """
+
+    def __init__(self, runnable: Runnable, scheduler: PriorityScheduler):
+        self.runnable = runnable
+        self.scheduler = scheduler
+
+    @property
+    def InputType(self) -> Type:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Type:
+        # The AgentExecutor tells single from multi-action agents by it
+        return self.runnable.OutputType
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_output_schema(config)
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return self.runnable.config_specs
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        async with self.scheduler.slot():
+            return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.runnable.stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async with self.scheduler.slot():
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                yield chunk
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Type
+
+from langchain_core.callbacks import BaseCallbackHandler, BaseCallbackManager
+from langchain_core.runnables import Runnable, RunnableConfig, ensure_config
+from langchain_core.runnables.utils import ConfigurableFieldSpec
+
+from ..metrics import stream_first_token_seconds
+
+# Tag of the chat model whose text is the agent's answer; other models (the history
+# summarizer) are never forwarded
+AGENT_LLM_TAG = "agent_llm"
+
+_DONE = object()
+
+
+class _TokenQueue(BaseCallbackHandler):
+    """Puts the text tokens of the tagged chat model on the request's stream queue"""
+
+    run_inline = True
+
+    def __init__(self, queue: asyncio.Queue, tag: str):
+        self.queue = queue
+        self.tag = tag
+
+    def on_llm_new_token(self, token: str, *, chunk=None, tags: Optional[List[str]] = None, **kwargs):
+        if not token or self.tag not in (tags or ()):
+            return
+        message = getattr(chunk, "message", None)
+        if getattr(message, "tool_call_chunks", None):
+            # A tool call being planned, not the answer
+            return
+        self.queue.put_nowait(("token", token))
+
+
+def _with_handler(config: RunnableConfig, handler: BaseCallbackHandler) -> RunnableConfig:
+    callbacks = config.get("callbacks")
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        callbacks.add_handler(handler, inherit=True)
+    else:
+        callbacks = [*(callbacks or []), handler]
+    return {**config, "callbacks": callbacks}
+
+
+class TokenStreamer(Runnable[Dict[str, Any], Any]):
+    """Streams the agent's answer token by token instead of in one final chunk
+
+    The agent only yields at step boundaries (actions, tool results, then the whole
+    answer). Here the wrapped runnable runs in a task while a callback forwards each
+    text token of the agent's chat model as an `{"output": token}` chunk, the same
+    shape the langserve /stream route already sends, so clients adding up the chunks
+    get the same output. Action and step chunks pass through unchanged; the final
+    chunk is dropped when its answer was already streamed. Answers that never went
+    through the model (fast path, response cache, coalesced followers) arrive whole.
+
+    The history is still written by the wrapped runnable when its run ends, i.e.
+    after the last token went out. invoke and the sync stream are passed through.
+    """
+
+    def __init__(self, runnable: Runnable, tag: str = AGENT_LLM_TAG):
+        self.runnable = runnable
+        self.tag = tag
+        self.streams = 0
+        self.token_streams = 0
+        self.tokens = 0
+
+    @property
+    def InputType(self) -> Type:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Type:
+        return self.runnable.OutputType
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None):
+        return self.runnable.get_output_schema(config)
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return self.runnable.config_specs
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.runnable.stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        start = time.perf_counter()
+        queue: asyncio.Queue = asyncio.Queue()
+        config = _with_handler(ensure_config(config), _TokenQueue(queue, self.tag))
+        self.streams += 1
+
+        async def produce():
+            try:
+                async for chunk in self.runnable.astream(input, config, **kwargs):
+                    queue.put_nowait(("chunk", chunk))
+            except BaseException as e:
+                queue.put_nowait(("error", e))
+                raise
+            finally:
+                queue.put_nowait((_DONE, None))
+
+        task = asyncio.create_task(produce())
+        streamed = False
+        first = True
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind is _DONE:
+                    break
+                if kind == "error":
+                    raise value
+                if kind == "token":
+                    if not streamed:
+                        streamed = True
+                        self.token_streams += 1
+                    self.tokens += 1
+                    chunk = {"output": value}
+                elif streamed and isinstance(value, dict) and "output" in value:
+                    # The whole answer again, already sent token by token
+                    continue
+                else:
+                    chunk = value
+                if first and isinstance(chunk, dict) and "output" in chunk:
+                    first = False
+                    stream_first_token_seconds.labels("token" if kind == "token" else "whole").observe(
+                        time.perf_counter() - start
+                    )
+                yield chunk
+        finally:
+            if not task.done():
+                # The client went away; stop the agent rather than finish for nobody
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"streams": self.streams, "token_streams": self.token_streams, "tokens": self.tokens}
@@ -1,10 +1,23 @@
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import ChatOpenAI
 from langchain.agents import create_tool_calling_agent
 from langchain.agents import AgentExecutor
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
-from ..tools.rag import get_treatment_price
+from langchain_core.chat_history import BaseChatMessageHistory
+from .. import monkey_patch  # noqa: F401  parallel, bounded tool calls
+from ..history.batch import current_batch
+from ..history.buckets import BucketedMongoDBChatMessageHistory
+from ..history.cache import CachedChatMessageHistory, SessionHistoryCache, WriteBehindWriter
+from ..history.mongo import PooledMongoDBChatMessageHistory
+from ..history.window import WindowedMongoDBChatMessageHistory, summarize_messages
+from ..llm import build_chat_model
+from ..log import bind_session
+from ..metrics import TimedChatMessageHistory
+from ..scheduler import PriorityScheduler
+from ..tools.rag import catalog, get_treatment_price
+from .batch import BatchRunner
+from .fast_path import PriceFastPath
+from .scheduling import ScheduledStep
+from .streaming import AGENT_LLM_TAG, TokenStreamer
 import os
 
 
@@ -24,28 +37,159 @@ prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0, streaming=True)
+# include_usage adds a last chunk with the token counts, which the metrics handler records.
+# Shared connection pool, deadlines, hedging and the fallback model: see llm.py.
+# The tag marks its tokens as the answer for token streaming
+llm = build_chat_model(
+    model="gpt-3.5-turbo",
+    temperature=0,
+    streaming=True,
+    model_kwargs={"stream_options": {"include_usage": True}},
+    tags=[AGENT_LLM_TAG],
+)
 
 tools = [get_treatment_price]
 
 agent = create_tool_calling_agent(llm, tools, prompt)
 
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+# Every LLM call of the agent takes a slot of its request's priority class, so chats go
+# ahead of batch items at each call (see scheduler.py)
+scheduler = None
+if os.environ.get("PRIORITY_SCHEDULING", "true") == "true":
+    scheduler = PriorityScheduler.from_env()
+    agent = ScheduledStep(agent, scheduler)
+
+agent_executor = AgentExecutor(agent=agent, tools=tools)
+
+
+# "full" loads the whole session every turn, "window" only the tail plus a rolling summary
+HISTORY_MODE = os.environ.get("HISTORY_MODE", "full")
+# "documents" keeps one document per message, "buckets" a few compact documents per session
+HISTORY_STORE = os.environ.get("HISTORY_STORE", "documents")
+if HISTORY_MODE == "window" and HISTORY_STORE == "buckets":
+    # The window reads the newest message documents, which a bucketed session does not have
+    raise ValueError("HISTORY_MODE=window reads per-message documents, it can not be used with HISTORY_STORE=buckets")
+# Expire bucketed sessions idle for this long; empty keeps them forever
+HISTORY_TTL_SECONDS = float(os.environ.get("HISTORY_TTL_SECONDS") or 0) or None
+# Keep hot sessions in memory and write to Mongo in the background
+HISTORY_CACHE = os.environ.get("HISTORY_CACHE", "false") == "true"
+
+
+def mongo_session_history(session_id: str) -> BaseChatMessageHistory:
+    # Called on every request, so it must not open a new MongoClient; the history
+    # shares one process-wide pool (see history/mongo.py)
+    if HISTORY_MODE == "window":
+        return WindowedMongoDBChatMessageHistory(
+            session_id=session_id,
+            max_messages=int(os.environ.get("HISTORY_WINDOW_MESSAGES", "20")),
+            max_tokens=int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000")),
+            fold_batch=int(os.environ.get("HISTORY_FOLD_BATCH", "10")),
+            summarizer=None if os.environ.get("HISTORY_SUMMARY", "true") == "false" else summarize_messages,
+        )
+    if HISTORY_STORE == "buckets":
+        return BucketedMongoDBChatMessageHistory(
+            session_id=session_id,
+            bucket_size=int(os.environ.get("HISTORY_BUCKET_SIZE", "50")),
+            compress_min_bytes=(
+                int(os.environ.get("HISTORY_COMPRESS_MIN_BYTES", "512"))
+                if os.environ.get("HISTORY_COMPRESS", "false") == "true"
+                else None
+            ),
+            ttl_seconds=HISTORY_TTL_SECONDS,
+        )
+    return PooledMongoDBChatMessageHistory(session_id=session_id)
+
+
+history_writer = WriteBehindWriter(
+    mongo_session_history,
+    flush_interval=float(os.environ.get("HISTORY_FLUSH_INTERVAL_SECONDS", "0.5")),
+    batch_size=int(os.environ.get("HISTORY_FLUSH_BATCH_SIZE", "100")),
+    max_attempts=int(os.environ.get("HISTORY_FLUSH_MAX_ATTEMPTS", "5")),
+)
+
+history_cache = SessionHistoryCache(
+    max_sessions=int(os.environ.get("HISTORY_CACHE_MAX_SESSIONS", "1000")),
+    ttl_seconds=float(os.environ.get("HISTORY_CACHE_TTL_SECONDS", "900")),
+    max_bytes=int(os.environ.get("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    is_pinned=history_writer.is_pending,
+)
+
 
+def get_session_history(session_id: str) -> BaseChatMessageHistory:
+    bind_session(session_id)
+    batch = current_batch()
+    if batch is not None and session_id in batch:
+        # Read with the rest of the batch, written with it when the batch is done
+        return TimedChatMessageHistory(batch.history(session_id))
+    if HISTORY_CACHE:
+        return TimedChatMessageHistory(
+            CachedChatMessageHistory(session_id, mongo_session_history, history_cache, history_writer)
+        )
+    return TimedChatMessageHistory(mongo_session_history(session_id))
 
-# print(os.environ["MONGO_DATABASE"])
-# print(os.environ["MONGO_CONNECTION_STRING"])
 
 website_chat_agent = RunnableWithMessageHistory(
     agent_executor,
-    # This is needed because in most real world scenarios, a session id is needed
-    # It isn't really used here because we are using a simple in memory ChatMessageHistory
-    lambda session_id: MongoDBChatMessageHistory(
-        session_id=session_id,
-        connection_string=os.environ["MONGO_CONNECTION_STRING"],
-        database_name=os.environ["MONGO_DATABASE"],
-        collection_name=os.environ["MONGO_COLLECTION"],
-    ),
+    get_session_history,
     input_messages_key="input",
     history_messages_key="chat_history",
 )
+
+# Identical first questions arriving together share one agent execution
+single_flight = None
+if os.environ.get("COALESCE_REQUESTS", "false") == "true":
+    from .coalesce import SingleFlight
+
+    single_flight = SingleFlight(website_chat_agent, get_session_history)
+    website_chat_agent = single_flight
+
+# Near-identical first questions get the earlier answer back without calling the LLM
+response_cache = None
+if os.environ.get("RESPONSE_CACHE", "false") == "true":
+    # numpy and the embeddings are only loaded when the cache is on
+    from .response_cache import ResponseCacheRouter, SemanticResponseCache, embeddings_from_env
+
+    response_cache = ResponseCacheRouter(
+        website_chat_agent,
+        get_session_history,
+        SemanticResponseCache(
+            embeddings_from_env(),
+            threshold=float(os.environ.get("RESPONSE_CACHE_THRESHOLD", "0.9")),
+            ttl_seconds=float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "2000")),
+            catalog=catalog,
+        ),
+        catalog,
+    )
+    website_chat_agent = response_cache
+
+# Plain price questions are answered from the catalog without the two LLM round trips
+fast_path = None
+if os.environ.get("PRICE_FAST_PATH", "true") == "true":
+    fast_path = PriceFastPath(
+        website_chat_agent,
+        get_session_history,
+        catalog,
+        min_score=float(os.environ.get("PRICE_FAST_PATH_MIN_SCORE", "0.9")),
+    )
+    website_chat_agent = fast_path
+
+# /stream sends the answer token by token rather than whole at the end; outside the
+# stages above, so their answers still arrive (whole) through it
+token_streamer = None
+if os.environ.get("STREAM_TOKENS", "true") == "true":
+    token_streamer = TokenStreamer(website_chat_agent)
+    website_chat_agent = token_streamer
+
+# /batch reads all the items' histories in one query, runs the items concurrently and
+# writes the histories back in one bulk write; outermost, it only changes abatch
+batch_runner = None
+if os.environ.get("BATCH_HISTORY", "true") == "true":
+    batch_runner = BatchRunner(
+        website_chat_agent,
+        mongo_session_history,
+        cache=history_cache if HISTORY_CACHE else None,
+        writer=history_writer if HISTORY_CACHE else None,
+        max_concurrency=int(os.environ.get("BATCH_MAX_CONCURRENCY", "8")),
+    )
+    website_chat_agent = batch_runner
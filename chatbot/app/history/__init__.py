@@ -0,0 +1,12 @@
+from langchain_core.chat_history import BaseChatMessageHistory
+
+
+def has_messages(history: BaseChatMessageHistory) -> bool:
+    """Whether a session has any history yet, without loading it where the store can tell"""
+    check = getattr(history, "has_messages", None)
+    return check() if check is not None else bool(history.messages)
+
+
+async def ahas_messages(history: BaseChatMessageHistory) -> bool:
+    check = getattr(history, "ahas_messages", None)
+    return await check() if check is not None else bool(await history.aget_messages())
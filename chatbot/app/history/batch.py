@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage
+from pymongo.errors import BulkWriteError
+
+from ..metrics import batch_history_seconds
+from .cache import HistoryFactory, SessionHistoryCache, WriteBehindWriter
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["BatchHistories"]] = ContextVar("history_batch", default=None)
+
+
+def current_batch() -> Optional["BatchHistories"]:
+    """The batch the calling task runs in, if any"""
+    return _current.get()
+
+
+class BatchHistories:
+    """Histories of the sessions of one batch, read before its items run and written after
+
+    `aload` reads every session with one query per collection (`$in` on the session id).
+    While the items run, `history(session_id)` serves those messages and collects what
+    the items add in memory. `aflush` then writes all of it with one unordered
+    bulk_write per collection, so one session's failed write does not stop the others.
+
+    With the history cache, cached sessions are not read again, and the cache is kept up
+    to date with what the batch wrote.
+    """
+
+    def __init__(
+        self,
+        history_factory: HistoryFactory,
+        cache: Optional[SessionHistoryCache] = None,
+        writer: Optional[WriteBehindWriter] = None,
+    ):
+        self.history_factory = history_factory
+        self.cache = cache
+        self.writer = writer
+        self.loaded: Dict[str, List[BaseMessage]] = {}
+        self.added: Dict[str, List[BaseMessage]] = {}
+        self._backends: Dict[str, BaseChatMessageHistory] = {}
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.loaded
+
+    def activate(self):
+        """Make this the batch of the calling task and the tasks it starts; returns a reset token"""
+        return _current.set(self)
+
+    @staticmethod
+    def deactivate(token) -> None:
+        _current.reset(token)
+
+    def history(self, session_id: str) -> BaseChatMessageHistory:
+        return _BatchSessionHistory(self, session_id)
+
+    def _backend(self, session_id: str) -> BaseChatMessageHistory:
+        if session_id not in self._backends:
+            self._backends[session_id] = self.history_factory(session_id)
+        return self._backends[session_id]
+
+    async def aload(self, session_ids: Iterable[str]) -> None:
+        start = time.perf_counter()
+        missing = []
+        for session_id in dict.fromkeys(session_ids):
+            cached = self.cache.get(session_id) if self.cache is not None else None
+            if cached is None:
+                missing.append(session_id)
+            else:
+                self.loaded[session_id] = cached
+        groups: Dict[tuple, List[BaseChatMessageHistory]] = {}
+        for session_id in missing:
+            backend = self._backend(session_id)
+            groups.setdefault((type(backend), getattr(backend, "collection_name", None)), []).append(backend)
+        for found in await asyncio.gather(*(self._aload_group(histories) for histories in groups.values())):
+            for session_id, messages in found.items():
+                self.loaded[session_id] = messages
+                if self.cache is not None:
+                    self.cache.put(session_id, messages)
+        batch_history_seconds.labels("load").observe(time.perf_counter() - start)
+
+    @staticmethod
+    async def _aload_group(histories: Sequence[BaseChatMessageHistory]) -> Dict[str, List[BaseMessage]]:
+        aget_many = getattr(type(histories[0]), "aget_many", None)
+        if aget_many is not None:
+            return await aget_many(histories)
+        loaded = await asyncio.gather(*(history.aget_messages() for history in histories))
+        return {history.session_id: messages for history, messages in zip(histories, loaded)}
+
+    def add(self, session_id: str, messages: Sequence[BaseMessage]) -> None:
+        self.added.setdefault(session_id, []).extend(messages)
+        self.loaded[session_id] = self.loaded.get(session_id, []) + list(messages)
+
+    async def aflush(self) -> Dict[str, int]:
+        """Write what the items added; returns the number of sessions written and failed"""
+        if not self.added:
+            return {"written": 0, "failed": 0}
+        start = time.perf_counter()
+        if self.writer is not None and any(self.writer.is_pending(session_id) for session_id in self.added):
+            # Earlier turns of these sessions are still queued; they must land first
+            await asyncio.to_thread(self.writer.flush)
+        # collection name -> (collection, [(session_id, request)])
+        writes: Dict[Optional[str], tuple] = {}
+        direct = []
+        for session_id, messages in self.added.items():
+            backend = self._backend(session_id)
+            write_requests = getattr(backend, "write_requests", None)
+            if write_requests is None:
+                direct.append(session_id)
+                continue
+            collection_name = getattr(backend, "collection_name", None)
+            _, requests = writes.setdefault(collection_name, (backend.async_collection, []))
+            requests.extend((session_id, request) for request in write_requests(messages))
+        failed = set()
+        for found in await asyncio.gather(
+            *(self._awrite(collection, requests) for collection, requests in writes.values()),
+            *(self._awrite_direct(session_id) for session_id in direct),
+        ):
+            failed.update(found)
+        for session_id, messages in self.added.items():
+            backend = self._backend(session_id)
+            if session_id in failed:
+                if self.cache is not None:
+                    # The cached copy has turns that Mongo does not
+                    self.cache.discard(session_id)
+                continue
+            if hasattr(backend, "after_write"):
+                backend.after_write()
+            if self.cache is not None:
+                self.cache.append(session_id, messages, getattr(backend, "trim", None))
+        batch_history_seconds.labels("write").observe(time.perf_counter() - start)
+        return {"written": len(self.added) - len(failed), "failed": len(failed)}
+
+    @staticmethod
+    async def _awrite(collection, requests) -> set:
+        """One unordered bulk_write; returns the sessions whose writes failed"""
+        try:
+            await collection.bulk_write([request for _, request in requests], ordered=False)
+        except BulkWriteError as e:
+            failed = {requests[error["index"]][0] for error in e.details.get("writeErrors", [])}
+            logger.error("batch history write failed", extra={"sessions": len(failed)}, exc_info=True)
+            return failed
+        except Exception:
+            logger.error("batch history write failed", exc_info=True)
+            return {session_id for session_id, _ in requests}
+        return set()
+
+    async def _awrite_direct(self, session_id: str) -> set:
+        try:
+            await self._backend(session_id).aadd_messages(self.added[session_id])
+        except Exception:
+            logger.error("batch history write failed", extra={"session_id": session_id}, exc_info=True)
+            return {session_id}
+        return set()
+
+
+class _BatchSessionHistory(BaseChatMessageHistory):
+    """One session's view of a BatchHistories"""
+
+    def __init__(self, batch: BatchHistories, session_id: str):
+        self.batch = batch
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        return list(self.batch.loaded.get(self.session_id, []))
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return self.messages
+
+    def has_messages(self) -> bool:
+        return bool(self.batch.loaded.get(self.session_id))
+
+    async def ahas_messages(self) -> bool:
+        return self.has_messages()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.batch.add(self.session_id, messages)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.add_messages(messages)
+
+    def clear(self) -> None:
+        raise NotImplementedError("sessions can not be cleared from a batch")
@@ -0,0 +1,158 @@
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from bson import Binary
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from pymongo import UpdateMany, UpdateOne
+
+from .mongo import get_async_collection, get_collection
+
+# Field names are one letter: they are repeated in every bucket and every message
+SESSION = "s"
+COUNT = "c"
+MESSAGES = "m"
+UPDATED = "u"
+
+_TYPE_CODES = {"human": "h", "ai": "a", "system": "s", "tool": "t", "function": "f", "chat": "c"}
+_TYPE_NAMES = {code: name for name, code in _TYPE_CODES.items()}
+
+
+def bucket_collection_name() -> str:
+    return os.environ.get("MONGO_BUCKET_COLLECTION") or f"{os.environ['MONGO_COLLECTION']}_buckets"
+
+
+def encode_message(message: BaseMessage, compress_min_bytes: Optional[int] = None) -> Dict[str, Any]:
+    """A message as a small subdocument: type code, content, and only the fields that are set
+
+    Text content of at least `compress_min_bytes` is stored zlib-compressed.
+    """
+    serialized = message_to_dict(message)
+    data = {
+        key: value
+        for key, value in serialized["data"].items()
+        if key != "type" and value is not None and value != {} and value != [] and value != "" and
+        not (key == "example" and value is False)
+    }
+    content = data.pop("content", "")
+    encoded: Dict[str, Any] = {"t": _TYPE_CODES.get(serialized["type"], serialized["type"])}
+    if isinstance(content, str) and compress_min_bytes is not None and len(content) >= compress_min_bytes:
+        encoded["z"] = Binary(zlib.compress(content.encode(), 6))
+    else:
+        encoded["c"] = content
+    if data:
+        encoded["d"] = data
+    return encoded
+
+
+def decode_messages(encoded: Sequence[Dict[str, Any]]) -> List[BaseMessage]:
+    dicts = []
+    for item in encoded:
+        content = zlib.decompress(item["z"]).decode() if "z" in item else item.get("c", "")
+        dicts.append({"type": _TYPE_NAMES.get(item["t"], item["t"]), "data": {"content": content, **item.get("d", {})}})
+    return messages_from_dict(dicts)
+
+
+class BucketedMongoDBChatMessageHistory(BaseChatMessageHistory):
+    """Chat history kept in a few documents per session instead of one per message
+
+    A session is a series of bucket documents `{s, c, m: [...], u}` holding up to about
+    `bucket_size` compactly encoded messages each (see `encode_message`). A load is one
+    indexed query returning a handful of documents; a turn is one bulk write that pushes
+    its messages onto the open bucket, or starts a new one when it is full.
+
+    With `ttl_seconds`, `u` is kept within that of now on every bucket of an active
+    session (the open bucket on each turn, older ones when they are half way to expiry,
+    in the same round trip), and the TTL index made by `ensure_indexes` removes sessions
+    idle for longer.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        bucket_size: int = 50,
+        compress_min_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        collection_name: Optional[str] = None,
+    ):
+        self.session_id = session_id
+        self.bucket_size = bucket_size
+        self.compress_min_bytes = compress_min_bytes
+        self.ttl_seconds = ttl_seconds
+        self.collection_name = collection_name or bucket_collection_name()
+
+    @property
+    def collection(self):
+        return get_collection(self.collection_name)
+
+    @property
+    def async_collection(self):
+        return get_async_collection(self.collection_name)
+
+    def _query(self, collection):
+        return collection.find({SESSION: self.session_id}, {MESSAGES: 1}).sort("_id", 1)
+
+    @staticmethod
+    def _from_buckets(buckets) -> List[BaseMessage]:
+        return decode_messages([item for bucket in buckets for item in bucket.get(MESSAGES, ())])
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        return self._from_buckets(self._query(self.collection))
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return self._from_buckets(await self._query(self.async_collection).to_list(length=None))
+
+    def has_messages(self) -> bool:
+        return self.collection.find_one({SESSION: self.session_id}, {"_id": 1}) is not None
+
+    async def ahas_messages(self) -> bool:
+        return await self.async_collection.find_one({SESSION: self.session_id}, {"_id": 1}) is not None
+
+    @classmethod
+    async def aget_many(cls, histories: Sequence["BucketedMongoDBChatMessageHistory"]) -> Dict[str, List[BaseMessage]]:
+        """Messages of several sessions kept in the same collection, read with one query"""
+        query = {SESSION: {"$in": [history.session_id for history in histories]}}
+        buckets: Dict[str, list] = {history.session_id: [] for history in histories}
+        cursor = histories[0].async_collection.find(query, {SESSION: 1, MESSAGES: 1}).sort("_id", 1)
+        for bucket in await cursor.to_list(length=None):
+            buckets[bucket[SESSION]].append(bucket)
+        return {session_id: cls._from_buckets(found) for session_id, found in buckets.items()}
+
+    def write_requests(self, messages: Sequence[BaseMessage]) -> list:
+        now = datetime.now(timezone.utc)
+        writes = []
+        if self.ttl_seconds:
+            writes.append(UpdateMany(
+                {SESSION: self.session_id, UPDATED: {"$lt": now - timedelta(seconds=self.ttl_seconds / 2)}},
+                {"$set": {UPDATED: now}},
+            ))
+        writes.append(UpdateOne(
+            {SESSION: self.session_id, COUNT: {"$lt": self.bucket_size}},
+            {
+                "$push": {MESSAGES: {"$each": [encode_message(m, self.compress_min_bytes) for m in messages]}},
+                "$inc": {COUNT: len(messages)},
+                "$set": {UPDATED: now},
+            },
+            upsert=True,
+        ))
+        return writes
+
+    def after_write(self) -> None:
+        pass
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if messages:
+            self.collection.bulk_write(self.write_requests(messages), ordered=True)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if messages:
+            await self.async_collection.bulk_write(self.write_requests(messages), ordered=True)
+
+    def clear(self) -> None:
+        self.collection.delete_many({SESSION: self.session_id})
+
+    async def aclear(self) -> None:
+        await self.async_collection.delete_many({SESSION: self.session_id})
@@ -0,0 +1,360 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage
+
+from ..metrics import history_writes_dropped
+from . import ahas_messages, has_messages
+
+logger = logging.getLogger(__name__)
+
+HistoryFactory = Callable[[str], BaseChatMessageHistory]
+
+# Rough per-message overhead of the message object itself on top of its content
+_MESSAGE_OVERHEAD_BYTES = 400
+
+
+def _message_bytes(messages: Sequence[BaseMessage]) -> int:
+    return sum(
+        len(m.content if isinstance(m.content, str) else str(m.content)) + _MESSAGE_OVERHEAD_BYTES
+        for m in messages
+    )
+
+
+class SessionHistoryCache:
+    """In-process LRU of session histories with a TTL and an approximate memory cap
+
+    Sessions for which `is_pinned` returns True (writes not yet flushed to Mongo)
+    are never evicted, so a reload can not miss messages that are still queued.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl_seconds: float = 900,
+        max_bytes: int = 32 * 1024 * 1024,
+        is_pinned: Callable[[str], bool] = lambda session_id: False,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.is_pinned = is_pinned
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # session_id -> (expires_at, size, messages)
+        self._entries: "OrderedDict[str, Tuple[float, int, List[BaseMessage]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[List[BaseMessage]]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or (entry[0] < time.monotonic() and not self.is_pinned(session_id)):
+                if entry is not None:
+                    self._remove(session_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return list(entry[2])
+
+    def put(self, session_id: str, messages: List[BaseMessage]) -> None:
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+            size = _message_bytes(messages)
+            self._entries[session_id] = (time.monotonic() + self.ttl_seconds, size, list(messages))
+            self.bytes += size
+            self._evict()
+
+    def append(
+        self,
+        session_id: str,
+        messages: Sequence[BaseMessage],
+        trim: Optional[Callable[[List[BaseMessage]], List[BaseMessage]]] = None,
+    ) -> bool:
+        """Append to a cached session, returns False if the session is not cached"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return False
+            updated = entry[2] + list(messages)
+            if trim:
+                updated = trim(updated)
+            size = _message_bytes(updated)
+            self.bytes += size - entry[1]
+            self._entries[session_id] = (time.monotonic() + self.ttl_seconds, size, updated)
+            self._entries.move_to_end(session_id)
+            self._evict()
+            return True
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, session_id: str) -> None:
+        _, size, _ = self._entries.pop(session_id)
+        self.bytes -= size
+
+    def _evict(self) -> None:
+        # Oldest first; pinned sessions are skipped, so the cap may be exceeded briefly
+        # while their writes are in flight
+        if len(self._entries) <= self.max_sessions and self.bytes <= self.max_bytes:
+            return
+        now = time.monotonic()
+        for session_id in list(self._entries):
+            over = len(self._entries) > self.max_sessions or self.bytes > self.max_bytes
+            if not over and self._entries[session_id][0] >= now:
+                continue
+            if self.is_pinned(session_id):
+                continue
+            self._remove(session_id)
+            self.evictions += 1
+
+
+class WriteBehindWriter:
+    """Queues history appends and flushes them to the backend from a background thread
+
+    Appends for the same session are coalesced into one `add_messages` call per flush.
+    A flush runs every `flush_interval` seconds or as soon as `batch_size` messages are
+    queued; if `max_pending` is exceeded the caller flushes inline instead of queueing
+    more. `close` flushes everything that is left, it runs on FastAPI shutdown and at exit.
+
+    A session whose write fails is retried after `flush_interval`, then twice as long
+    each time. After `max_attempts` failures its queued messages are dropped, logged
+    and counted, so it is no longer pinned in the cache and retried forever.
+    """
+
+    def __init__(
+        self,
+        history_factory: HistoryFactory,
+        flush_interval: float = 0.5,
+        batch_size: int = 100,
+        max_pending: int = 10000,
+        max_attempts: int = 5,
+    ):
+        self.history_factory = history_factory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.flushed = 0
+        self.failures = 0
+        self.dropped = 0
+        # session_id -> (failed attempts, monotonic time of the next one)
+        self._retries: Dict[str, Tuple[int, float]] = {}
+        self._pending: List[Tuple[str, List[BaseMessage]]] = []
+        self._pending_count = 0
+        # session_id -> messages queued or being written
+        self._unflushed: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def is_pending(self, session_id: str) -> bool:
+        return session_id in self._unflushed
+
+    def enqueue(self, session_id: str, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        with self._condition:
+            closed = self._closed
+            if not closed:
+                self._pending.append((session_id, list(messages)))
+                self._pending_count += len(messages)
+                self._unflushed[session_id] = self._unflushed.get(session_id, 0) + len(messages)
+                if self._pending_count >= self.batch_size:
+                    self._condition.notify()
+            overflowing = self._pending_count > self.max_pending
+        if closed:
+            # Late writes during shutdown go straight to the backend
+            self.history_factory(session_id).add_messages(messages)
+            return
+        self._start()
+        if overflowing:
+            self.flush()
+
+    def flush(self, retry_now: bool = False) -> None:
+        """Write everything queued so far, in order, one add_messages call per session
+
+        Sessions waiting out a retry backoff stay queued unless `retry_now`.
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending, self._pending_count = self._pending, [], 0
+            if not batch:
+                return
+            by_session: "OrderedDict[str, List[BaseMessage]]" = OrderedDict()
+            for session_id, messages in batch:
+                by_session.setdefault(session_id, []).extend(messages)
+            now = time.monotonic()
+            for session_id, messages in by_session.items():
+                attempts, retry_at = self._retries.get(session_id, (0, 0.0))
+                if retry_at > now and not retry_now:
+                    self._requeue(session_id, messages)
+                    continue
+                try:
+                    self.history_factory(session_id).add_messages(messages)
+                    self.flushed += len(messages)
+                except Exception:
+                    self.failures += 1
+                    attempts += 1
+                    if attempts < self.max_attempts:
+                        # Keep the session pinned and retry it after a backoff
+                        logger.warning("history flush failed", extra={"session_id": session_id}, exc_info=True)
+                        self._retries[session_id] = (attempts, now + self.flush_interval * 2 ** (attempts - 1))
+                        self._requeue(session_id, messages)
+                        continue
+                    logger.error(
+                        "history flush failed, dropping the queued messages",
+                        extra={"session_id": session_id, "messages": len(messages), "attempts": attempts},
+                        exc_info=True,
+                    )
+                    self.dropped += len(messages)
+                    history_writes_dropped.labels().inc(len(messages))
+                self._retries.pop(session_id, None)
+                with self._condition:
+                    remaining = self._unflushed.get(session_id, 0) - len(messages)
+                    if remaining > 0:
+                        self._unflushed[session_id] = remaining
+                    else:
+                        self._unflushed.pop(session_id, None)
+
+    def _requeue(self, session_id: str, messages: List[BaseMessage]) -> None:
+        with self._condition:
+            self._pending.insert(0, (session_id, messages))
+            self._pending_count += len(messages)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush(retry_now=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self._pending_count,
+            "pending_sessions": len(self._unflushed),
+            "flushed": self.flushed,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if not self._closed and self._pending_count < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """Serves a session's history from SessionHistoryCache and writes behind to the backend
+
+    The backend history object is built on a cache miss and on every append, for its
+    `trim` if it has one; building it opens no connection. A repeat turn in a hot
+    session costs no Mongo round trip before the LLM call.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        history_factory: HistoryFactory,
+        cache: SessionHistoryCache,
+        writer: WriteBehindWriter,
+    ):
+        self.session_id = session_id
+        self.history_factory = history_factory
+        self.cache = cache
+        self.writer = writer
+        self._backend: Optional[BaseChatMessageHistory] = None
+
+    @property
+    def backend(self) -> BaseChatMessageHistory:
+        if self._backend is None:
+            self._backend = self.history_factory(self.session_id)
+        return self._backend
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        messages = self.cache.get(self.session_id)
+        if messages is None:
+            messages = self.backend.messages
+            self.cache.put(self.session_id, messages)
+        return messages
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        messages = self.cache.get(self.session_id)
+        if messages is None:
+            messages = await self.backend.aget_messages()
+            self.cache.put(self.session_id, messages)
+        return messages
+
+    def has_messages(self) -> bool:
+        cached = self.cache.get(self.session_id)
+        if cached is not None:
+            return bool(cached)
+        # Queued turns are not in Mongo yet
+        return self.writer.is_pending(self.session_id) or has_messages(self.backend)
+
+    async def ahas_messages(self) -> bool:
+        cached = self.cache.get(self.session_id)
+        if cached is not None:
+            return bool(cached)
+        return self.writer.is_pending(self.session_id) or await ahas_messages(self.backend)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        # Queue first so the session is pinned before the cache entry changes. If the
+        # session dropped out of the cache since it was read, flush right away, otherwise
+        # the next reload from Mongo would miss these messages
+        self.writer.enqueue(self.session_id, messages)
+        if not self.cache.append(self.session_id, messages, getattr(self.backend, "trim", None)):
+            self.writer.flush()
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.writer.enqueue(self.session_id, messages)
+        if not self.cache.append(self.session_id, messages, getattr(self.backend, "trim", None)):
+            await asyncio.to_thread(self.writer.flush)
+
+    def clear(self) -> None:
+        self.writer.flush()
+        self.cache.discard(self.session_id)
+        self.backend.clear()
+
+    async def aclear(self) -> None:
+        await asyncio.to_thread(self.writer.flush)
+        self.cache.discard(self.session_id)
+        await self.backend.aclear()
@@ -0,0 +1,48 @@
+import logging
+import os
+from typing import List, Optional
+
+from pymongo.errors import OperationFailure
+
+from .buckets import SESSION, UPDATED, bucket_collection_name
+from .mongo import SESSION_ID_KEY, get_collection
+
+logger = logging.getLogger(__name__)
+
+# Mongo error codes for an index that exists under the same keys with other options
+_INDEX_CONFLICT = (85, 86)
+
+
+def ensure_ttl_index(collection, field: str, ttl_seconds: float) -> str:
+    """TTL index on `field`; an existing one with another expiry is changed in place"""
+    try:
+        return collection.create_index(field, expireAfterSeconds=int(ttl_seconds))
+    except OperationFailure as e:
+        if e.code not in _INDEX_CONFLICT:
+            raise
+        collection.database.command(
+            "collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": int(ttl_seconds)}
+        )
+        logger.info("changed the TTL of %s.%s to %ss", collection.name, field, int(ttl_seconds))
+        return f"{field}_1"
+
+
+def ensure_indexes(store: str = "documents", ttl_seconds: Optional[float] = None) -> List[str]:
+    """Create the indexes the history queries rely on, if they are missing
+
+    create_index is a no-op for an index that already exists, so every worker runs
+    this at startup. Without them each history load is a collection scan.
+    """
+    collection_name = os.environ["MONGO_COLLECTION"]
+    summary_collection_name = os.environ.get("MONGO_SUMMARY_COLLECTION") or f"{collection_name}_summaries"
+    created = [
+        # Loads are by session in insertion order, window loads the newest first
+        get_collection().create_index([(SESSION_ID_KEY, 1), ("_id", 1)]),
+        get_collection(summary_collection_name).create_index(SESSION_ID_KEY),
+    ]
+    if store == "buckets":
+        buckets = get_collection(bucket_collection_name())
+        created.append(buckets.create_index([(SESSION, 1), ("_id", 1)]))
+        if ttl_seconds:
+            created.append(ensure_ttl_index(buckets, UPDATED, ttl_seconds))
+    return created
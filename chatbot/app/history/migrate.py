@@ -0,0 +1,114 @@
+"""Copy sessions from the one-document-per-message collection into history buckets
+
+    python -m app.history.migrate [--bucket-size 50] [--compress-min-bytes 512]
+                                  [--ttl-seconds N] [--delete-source] [--dry-run]
+
+Reads MONGO_CONNECTION_STRING, MONGO_DATABASE, MONGO_COLLECTION and
+MONGO_BUCKET_COLLECTION like the service. Run it with the service on HISTORY_STORE=
+buckets (or stopped), so no turn lands in the old collection after its session was
+copied. A session that comes back meanwhile gets buckets of its own for its new
+turns; the copied ones go in front of them.
+
+Each bucket written here takes the _id of its first message document, so it sorts
+before every bucket the service made, and is written by that _id, so copying a
+session again writes the same buckets instead of adding more. A session is recorded
+in `<MONGO_BUCKET_COLLECTION>_migrated` once all of it is copied, and skipped from
+then on, so an interrupted run can simply be started again. With --delete-source the
+messages of a session are deleted once its buckets are written.
+"""
+import argparse
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import messages_from_dict
+from pymongo import ReplaceOne
+
+from .buckets import COUNT, MESSAGES, SESSION, UPDATED, bucket_collection_name, encode_message
+from .indexes import ensure_indexes
+from .mongo import HISTORY_KEY, SESSION_ID_KEY, get_collection
+
+logger = logging.getLogger(__name__)
+
+
+def migrated_collection_name() -> str:
+    return f"{bucket_collection_name()}_migrated"
+
+
+def to_buckets(
+    session_id: str, documents: List[Dict[str, Any]], bucket_size: int, compress_min_bytes: Optional[int]
+) -> List[Dict[str, Any]]:
+    """The bucket documents holding a session's message documents, in order"""
+    messages = messages_from_dict([json.loads(document[HISTORY_KEY]) for document in documents])
+    # The last write of the session, so the TTL counts from when it was really used
+    updated = documents[-1]["_id"].generation_time if documents else datetime.now(timezone.utc)
+    return [
+        {
+            # Older than any bucket the service started, so the copied turns load first
+            "_id": documents[i]["_id"],
+            SESSION: session_id,
+            # Full, so the service's next turn starts a bucket after them instead of
+            # pushing onto one of these
+            COUNT: bucket_size,
+            MESSAGES: [encode_message(message, compress_min_bytes) for message in messages[i:i + bucket_size]],
+            UPDATED: updated,
+        }
+        for i in range(0, len(messages), bucket_size)
+    ]
+
+
+def migrate(
+    bucket_size: int = 50,
+    compress_min_bytes: Optional[int] = None,
+    delete_source: bool = False,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    source = get_collection()
+    buckets = get_collection(bucket_collection_name())
+    migrated = get_collection(migrated_collection_name())
+    counts = {"sessions": 0, "skipped": 0, "messages": 0, "buckets": 0}
+    for session_id in source.distinct(SESSION_ID_KEY):
+        if migrated.find_one({"_id": session_id}, {"_id": 1}) is not None:
+            counts["skipped"] += 1
+            continue
+        documents = list(source.find({SESSION_ID_KEY: session_id}).sort("_id", 1))
+        new_buckets = to_buckets(session_id, documents, bucket_size, compress_min_bytes)
+        counts["sessions"] += 1
+        counts["messages"] += len(documents)
+        counts["buckets"] += len(new_buckets)
+        if dry_run:
+            continue
+        if new_buckets:
+            buckets.bulk_write(
+                [ReplaceOne({"_id": bucket["_id"]}, bucket, upsert=True) for bucket in new_buckets], ordered=True
+            )
+            if delete_source:
+                source.delete_many({SESSION_ID_KEY: session_id, "_id": {"$lte": documents[-1]["_id"]}})
+        migrated.update_one(
+            {"_id": session_id}, {"$set": {"messages": len(documents), "at": datetime.now(timezone.utc)}}, upsert=True
+        )
+        if counts["sessions"] % 1000 == 0:
+            logger.info("migrated %s sessions", counts["sessions"])
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket-size", type=int, default=50)
+    parser.add_argument("--compress-min-bytes", type=int, default=None,
+                        help="compress message text of at least this many characters (default: off)")
+    parser.add_argument("--ttl-seconds", type=float, default=None, help="also create the bucket TTL index")
+    parser.add_argument("--delete-source", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not args.dry_run:
+        ensure_indexes("buckets", args.ttl_seconds)
+    counts = migrate(args.bucket_size, args.compress_min_bytes, args.delete_source, args.dry_run)
+    print(json.dumps({"dry_run": args.dry_run, **counts}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from pymongo import InsertOne, MongoClient, monitoring
+
+# Same field names as langchain_mongodb.MongoDBChatMessageHistory, so sessions
+# written before the switch to the pooled client are still readable.
+SESSION_ID_KEY = "SessionId"
+HISTORY_KEY = "History"
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def client_options() -> Dict[str, Any]:
+    """Pool sizes and timeouts for the shared Mongo clients, read from the environment"""
+    return {
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 10),
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 1),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 60000),
+        "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000),
+        "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS", 10000),
+    }
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so pool utilization can be read at runtime"""
+
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.created = 0
+        self.closed = 0
+        self.cleared = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_pool_size": self.max_pool_size,
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "utilization": self.checked_out / self.max_pool_size if self.max_pool_size else 0.0,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "created": self.created,
+                "closed": self.closed,
+                "cleared": self.cleared,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+            self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+
+_lock = threading.Lock()
+_client: Optional[MongoClient] = None
+_async_client = None
+_stats: Dict[str, PoolStats] = {}
+
+
+def get_client() -> MongoClient:
+    """Process-wide pooled MongoClient, created on first use"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                options = client_options()
+                stats = PoolStats(options["maxPoolSize"])
+                _client = MongoClient(
+                    os.environ["MONGO_CONNECTION_STRING"],
+                    event_listeners=[stats],
+                    **options,
+                )
+                _stats["sync"] = stats
+    return _client
+
+
+def get_async_client():
+    """Process-wide pooled motor client, created on first use from inside the event loop"""
+    global _async_client
+    if _async_client is None:
+        # motor is only needed by the async history path, keep it off the import path
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        with _lock:
+            if _async_client is None:
+                options = client_options()
+                stats = PoolStats(options["maxPoolSize"])
+                _async_client = AsyncIOMotorClient(
+                    os.environ["MONGO_CONNECTION_STRING"],
+                    event_listeners=[stats],
+                    **options,
+                )
+                _stats["async"] = stats
+    return _async_client
+
+
+def get_collection(collection_name: Optional[str] = None):
+    database = get_client()[os.environ["MONGO_DATABASE"]]
+    return database[collection_name or os.environ["MONGO_COLLECTION"]]
+
+
+def get_async_collection(collection_name: Optional[str] = None):
+    database = get_async_client()[os.environ["MONGO_DATABASE"]]
+    return database[collection_name or os.environ["MONGO_COLLECTION"]]
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Pool utilization counters for every client opened so far, keyed by "sync"/"async" """
+    return {name: stats.snapshot() for name, stats in _stats.items()}
+
+
+def close_clients() -> None:
+    """Close the shared clients, called on FastAPI shutdown"""
+    global _client, _async_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+        if _async_client is not None:
+            _async_client.close()
+            _async_client = None
+        _stats.clear()
+
+
+class PooledMongoDBChatMessageHistory(BaseChatMessageHistory):
+    """Chat history stored in Mongo through the shared pooled clients
+
+    Uses the same document layout as MongoDBChatMessageHistory (one document per
+    message), but does not open a client per session, so constructing it per
+    request is free. The async methods go through motor instead of a thread.
+    """
+
+    def __init__(self, session_id: str, collection_name: Optional[str] = None):
+        self.session_id = session_id
+        self.collection_name = collection_name
+
+    @property
+    def collection(self):
+        return get_collection(self.collection_name)
+
+    @property
+    def async_collection(self):
+        return get_async_collection(self.collection_name)
+
+    def _to_documents(self, messages: Sequence[BaseMessage]) -> List[Dict[str, Any]]:
+        return [
+            {
+                SESSION_ID_KEY: self.session_id,
+                HISTORY_KEY: json.dumps(message_to_dict(message)),
+            }
+            for message in messages
+        ]
+
+    @staticmethod
+    def _from_documents(documents) -> List[BaseMessage]:
+        return messages_from_dict([json.loads(document[HISTORY_KEY]) for document in documents])
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        cursor = self.collection.find({SESSION_ID_KEY: self.session_id}).sort("_id", 1)
+        return self._from_documents(cursor)
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        cursor = self.async_collection.find({SESSION_ID_KEY: self.session_id}).sort("_id", 1)
+        return self._from_documents(await cursor.to_list(length=None))
+
+    def has_messages(self) -> bool:
+        return self.collection.find_one({SESSION_ID_KEY: self.session_id}, {"_id": 1}) is not None
+
+    async def ahas_messages(self) -> bool:
+        return await self.async_collection.find_one({SESSION_ID_KEY: self.session_id}, {"_id": 1}) is not None
+
+    @classmethod
+    async def aget_many(cls, histories: Sequence["PooledMongoDBChatMessageHistory"]) -> Dict[str, List[BaseMessage]]:
+        """Messages of several sessions kept in the same collection, read with one query"""
+        query = {SESSION_ID_KEY: {"$in": [history.session_id for history in histories]}}
+        documents: Dict[str, List[Dict[str, Any]]] = {history.session_id: [] for history in histories}
+        for document in await histories[0].async_collection.find(query).sort("_id", 1).to_list(length=None):
+            documents[document[SESSION_ID_KEY]].append(document)
+        return {session_id: cls._from_documents(found) for session_id, found in documents.items()}
+
+    def write_requests(self, messages: Sequence[BaseMessage]) -> list:
+        """What add_messages writes, as bulk_write requests for batching with other sessions"""
+        return [InsertOne(document) for document in self._to_documents(messages)]
+
+    def after_write(self) -> None:
+        """Called once the requests from write_requests are written"""
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if messages:
+            self.collection.insert_many(self._to_documents(messages))
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if messages:
+            await self.async_collection.insert_many(self._to_documents(messages))
+
+    def clear(self) -> None:
+        self.collection.delete_many({SESSION_ID_KEY: self.session_id})
+
+    async def aclear(self) -> None:
+        await self.async_collection.delete_many({SESSION_ID_KEY: self.session_id})
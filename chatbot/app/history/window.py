@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from .mongo import SESSION_ID_KEY, PooledMongoDBChatMessageHistory, get_async_collection, get_collection
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "Condense a conversation between a dental clinic assistant and a patient into a short summary. "
+            "Keep the treatments asked about, prices quoted and anything the patient said about themselves. "
+            "Extend the existing summary with the new messages, do not drop facts from it.",
+        ),
+        ("user", "Existing summary:\n{summary}\n\nNew messages:\n{messages}"),
+    ]
+)
+
+_summary_chain = None
+
+
+def summarize_messages(summary: str, messages: List[BaseMessage]) -> str:
+    """Fold messages into the running summary with a small LLM call"""
+    global _summary_chain
+    if _summary_chain is None:
+        from langchain_openai import ChatOpenAI
+
+        llm = ChatOpenAI(model=os.environ.get("HISTORY_SUMMARY_MODEL", "gpt-3.5-turbo"), temperature=0)
+        _summary_chain = summary_prompt | llm | StrOutputParser()
+    return _summary_chain.invoke({"summary": summary or "(none)", "messages": get_buffer_string(messages)})
+
+
+def approximate_tokens(message: BaseMessage) -> int:
+    # ~4 characters per token for English text, plus the per-message overhead of the chat format.
+    # Good enough for a budget and far cheaper than running the tokenizer on every turn
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return len(content) // 4 + 4
+
+
+# Folding calls an LLM, keep it off the request path and run one fold at a time per process
+_fold_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-fold")
+_folding = set()
+_folding_lock = threading.Lock()
+
+
+class WindowedMongoDBChatMessageHistory(PooledMongoDBChatMessageHistory):
+    """Chat history that only loads the tail of a session
+
+    Reads the newest `max_messages` messages with a sorted, limited query and trims
+    them to `max_tokens`. After each write, whatever that trim drops is folded into a
+    summary document kept in a separate collection, together with the oldest messages
+    still in the window up to `fold_batch` in all, so the summary covers the next few
+    turns' drops before they happen; the summary is returned as a leading SystemMessage.
+    Per-turn read size and prompt size therefore stay flat however long the session gets.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        max_messages: int = 20,
+        max_tokens: int = 2000,
+        fold_batch: int = 10,
+        summarizer: Optional[Callable[[str, List[BaseMessage]], str]] = summarize_messages,
+        token_counter: Callable[[BaseMessage], int] = approximate_tokens,
+        collection_name: Optional[str] = None,
+        summary_collection_name: Optional[str] = None,
+    ):
+        super().__init__(session_id=session_id, collection_name=collection_name)
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.fold_batch = fold_batch
+        self.summarizer = summarizer
+        self.token_counter = token_counter
+        self.summary_collection_name = summary_collection_name or (
+            os.environ.get("MONGO_SUMMARY_COLLECTION") or f"{collection_name or os.environ['MONGO_COLLECTION']}_summaries"
+        )
+
+    @property
+    def summary_collection(self):
+        return get_collection(self.summary_collection_name)
+
+    @property
+    def async_summary_collection(self):
+        return get_async_collection(self.summary_collection_name)
+
+    def _recent_query(self, collection):
+        return collection.find({SESSION_ID_KEY: self.session_id}).sort("_id", -1).limit(self.max_messages)
+
+    def trim(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Apply the message window and token budget to a chronological list, keeping a leading summary"""
+        summary = messages[:1] if messages and isinstance(messages[0], SystemMessage) else []
+        # Walk back from the newest message until the token budget is spent,
+        # but always keep the last complete turn
+        budget = self.max_tokens
+        kept = []
+        has_turn = False
+        for message in reversed(messages[len(summary):][-self.max_messages:]):
+            budget -= self.token_counter(message)
+            if budget < 0 and has_turn:
+                break
+            kept.append(message)
+            has_turn = has_turn or isinstance(message, HumanMessage)
+        kept.reverse()
+        # Never start the window in the middle of a turn
+        while kept and not isinstance(kept[0], HumanMessage):
+            kept.pop(0)
+        return summary + kept
+
+    def _window(self, summary_document, recent_documents) -> List[BaseMessage]:
+        # recent_documents come newest first
+        messages = self._from_documents(reversed(list(recent_documents)))
+        if summary_document and summary_document.get("summary"):
+            messages.insert(0, SystemMessage(content=SUMMARY_PREFIX + summary_document["summary"]))
+        return self.trim(messages)
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        summary_document = None
+        if self.summarizer:
+            summary_document = self.summary_collection.find_one({SESSION_ID_KEY: self.session_id})
+        return self._window(summary_document, list(self._recent_query(self.collection)))
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        recent = self._recent_query(self.async_collection).to_list(length=self.max_messages)
+        if not self.summarizer:
+            return self._window(None, await recent)
+        summary_document, recent_documents = await asyncio.gather(
+            self.async_summary_collection.find_one({SESSION_ID_KEY: self.session_id}), recent
+        )
+        return self._window(summary_document, recent_documents)
+
+    @classmethod
+    async def aget_many(cls, histories) -> Dict[str, List[BaseMessage]]:
+        # Each session is limited to its own tail, which one $in query can not express
+        loaded = await asyncio.gather(*(history.aget_messages() for history in histories))
+        return {history.session_id: messages for history, messages in zip(histories, loaded)}
+
+    def after_write(self) -> None:
+        self._schedule_fold()
+
+    def add_messages(self, messages) -> None:
+        super().add_messages(messages)
+        self._schedule_fold()
+
+    async def aadd_messages(self, messages) -> None:
+        await super().aadd_messages(messages)
+        self._schedule_fold()
+
+    def clear(self) -> None:
+        super().clear()
+        self.summary_collection.delete_one({SESSION_ID_KEY: self.session_id})
+
+    async def aclear(self) -> None:
+        await super().aclear()
+        await self.async_summary_collection.delete_one({SESSION_ID_KEY: self.session_id})
+
+    def _schedule_fold(self) -> None:
+        if not self.summarizer:
+            return
+        with _folding_lock:
+            if self.session_id in _folding:
+                return
+            _folding.add(self.session_id)
+        _fold_executor.submit(self._fold_safely)
+
+    def _fold_safely(self) -> None:
+        try:
+            self.fold()
+        except Exception:
+            # A failed fold only leaves the summary one batch behind, the next turn retries it
+            logger.warning("history fold failed", extra={"session_id": self.session_id}, exc_info=True)
+        finally:
+            with _folding_lock:
+                _folding.discard(self.session_id)
+
+    def fold(self) -> bool:
+        """Fold messages that left the window into the summary, returns True if it did"""
+        # The window as the next read trims it: whatever trim drops, by message count or
+        # by token budget, has to be in the summary
+        recent = list(self._recent_query(self.collection))
+        kept = len(self.trim(self._from_documents(reversed(recent))))
+        if kept == len(recent) < self.max_messages:
+            return False
+        summary_document = self.summary_collection.find_one({SESSION_ID_KEY: self.session_id}) or {}
+        query = {SESSION_ID_KEY: self.session_id}
+        if summary_document.get("folded_upto") is not None:
+            query["_id"] = {"$gt": summary_document["folded_upto"]}
+        documents = list(self.collection.find(query).sort("_id", 1).limit(self.fold_batch * 4))
+        # Oldest message the window keeps
+        boundary = recent[kept - 1]["_id"] if kept else None
+        outside = sum(1 for document in documents if boundary is None or document["_id"] < boundary)
+        if not outside:
+            return False
+        # Fold at least fold_batch messages, running ahead into the window, so the next
+        # turns can push messages out of it that are summarized already and folds stay
+        # fold_batch messages apart. The overlap costs a few prompt tokens, not facts
+        documents = documents[: max(outside, self.fold_batch)]
+        summary = self.summarizer(summary_document.get("summary", ""), self._from_documents(documents))
+        self.summary_collection.update_one(
+            {SESSION_ID_KEY: self.session_id},
+            {"$set": {"summary": summary, "folded_upto": documents[-1]["_id"]}},
+            upsert=True,
+        )
+        return True
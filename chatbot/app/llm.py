@@ -0,0 +1,431 @@
+"""The agent's chat model: shared HTTP pools, deadlines, hedging and a fallback model
+
+ResilientChatModel wraps a primary ChatOpenAI and optionally a fallback one:
+
+- both talk through one process-wide httpx pool per sync/async, with keep-alive, so
+  calls reuse warm TLS connections instead of each client growing its own
+- every attempt has a deadline (LLM_DEADLINE_SECONDS) covering the whole stream
+- if the first chunk has not arrived by the p95 of recent times to first chunk, a
+  second attempt is started and whichever streams first wins; hedges are capped at a
+  fraction of calls so an overloaded upstream does not get twice the load
+- consecutive failures open a circuit breaker; while it is open, or when a call fails
+  before anything was streamed, the fallback model answers instead
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Sequence
+
+import httpx
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_openai import ChatOpenAI
+
+from .metrics import (
+    llm_circuit_state,
+    llm_deadline_exceeded,
+    llm_failovers,
+    llm_hedge_delay_seconds,
+    llm_hedges,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+_http_client: Optional[httpx.Client] = None
+_http_async_client: Optional[httpx.AsyncClient] = None
+
+
+def _pool_options() -> Dict[str, Any]:
+    return {
+        "limits": httpx.Limits(
+            max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=_env_float("LLM_KEEPALIVE_SECONDS", 60),
+        ),
+        "timeout": httpx.Timeout(
+            _env_float("LLM_DEADLINE_SECONDS", 30), connect=_env_float("LLM_CONNECT_TIMEOUT_SECONDS", 5)
+        ),
+    }
+
+
+def http_clients():
+    """The process-wide (sync, async) httpx clients every OpenAI client shares
+
+    Creating them opens nothing; connections are made on first use, so they are safe to
+    build before the workers fork.
+    """
+    global _http_client, _http_async_client
+    if _http_client is None:
+        _http_client = httpx.Client(**_pool_options())
+        _http_async_client = httpx.AsyncClient(**_pool_options())
+    return _http_client, _http_async_client
+
+
+async def close_http_clients() -> None:
+    global _http_client, _http_async_client
+    if _http_client is not None:
+        _http_client.close()
+        await _http_async_client.aclose()
+        _http_client = _http_async_client = None
+
+
+class HedgePolicy:
+    """When to start a second attempt: past the p95 time to first chunk, within a budget"""
+
+    def __init__(self, quantile: float = 0.95, min_delay: float = 0.5, max_ratio: float = 0.1,
+                 min_samples: int = 20, window: int = 200):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._first_chunk: Deque[float] = deque(maxlen=window)
+        # Whether each recent call was hedged, for the budget
+        self._hedged: Deque[bool] = deque(maxlen=window)
+        self._delay: Optional[float] = None
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait for the first chunk before hedging, or None to not hedge this call"""
+        if self._delay is None or sum(self._hedged) + 1 > self.max_ratio * len(self._hedged):
+            return None
+        return self._delay
+
+    def record(self, first_chunk_seconds: float, hedged: bool) -> None:
+        self._first_chunk.append(first_chunk_seconds)
+        self._hedged.append(hedged)
+        if len(self._first_chunk) >= self.min_samples and len(self._first_chunk) % 10 == 0:
+            ordered = sorted(self._first_chunk)
+            p = ordered[min(len(ordered) - 1, math.ceil(self.quantile * len(ordered)) - 1)]
+            self._delay = max(self.min_delay, p)
+            llm_hedge_delay_seconds.labels().set(self._delay)
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures; after `reset_seconds` lets one call
+    through to probe, which closes it again on success"""
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failures: int = 5, reset_seconds: float = 30):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        llm_circuit_state.labels(name).set(self.state)
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._set(self.HALF_OPEN)
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self._consecutive = 0
+        if self.state != self.CLOSED:
+            self._set(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self._consecutive += 1
+        if self.state == self.HALF_OPEN or self._consecutive >= self.failures:
+            self._opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                logger.warning("LLM circuit opened", extra={"model": self.name, "failures": self._consecutive})
+            self._set(self.OPEN)
+
+    def _set(self, state: int) -> None:
+        self.state = state
+        llm_circuit_state.labels(self.name).set(state)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+_DONE = object()
+
+
+class _Attempt:
+    """One streaming call, read into a queue by its own task so it can be raced and cancelled"""
+
+    def __init__(self, model: BaseChatModel, messages, stop, kwargs):
+        self.started = time.monotonic()
+        self.first_chunk_at: Optional[float] = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Resolves when the first chunk arrives, or with the error if none does
+        self.first: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run(model, messages, stop, kwargs))
+
+    async def _run(self, model, messages, stop, kwargs):
+        try:
+            async for chunk in model._astream(messages, stop=stop, **kwargs):
+                if not self.first.done():
+                    self.first_chunk_at = time.monotonic()
+                    self.first.set_result(None)
+                self.queue.put_nowait(chunk)
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_exception(e)
+            self.queue.put_nowait(e)
+            return
+        if not self.first.done():
+            self.first_chunk_at = time.monotonic()
+            self.first.set_result(None)
+        self.queue.put_nowait(_DONE)
+
+    def cancel(self) -> None:
+        self.task.cancel()
+        if not self.first.done():
+            self.first.cancel()
+        elif not self.first.cancelled():
+            # Retrieve a lost attempt's error so asyncio does not log it as unhandled
+            self.first.exception()
+
+
+class ResilientChatModel(BaseChatModel):
+    primary: BaseChatModel
+    fallback: Optional[BaseChatModel] = None
+    deadline: float = 30.0
+    hedge: Optional[HedgePolicy] = None
+    breaker: CircuitBreaker
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "resilient-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"primary": self.primary._identifying_params}
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any):
+        return self.primary._get_ls_params(stop=stop, **kwargs)
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        attempt = None
+        reason = "circuit_open"
+        if self.breaker.allow():
+            try:
+                attempt = await self._race(messages, stop, kwargs)
+            except Exception as e:
+                self.breaker.record_failure()
+                if self.fallback is None:
+                    raise
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                logger.warning("LLM call failed, using the fallback model", extra={"reason": reason})
+        elif self.fallback is None:
+            raise CircuitOpenError(f"{self.breaker.name} is unavailable")
+        if attempt is None:
+            llm_failovers.labels(reason).inc()
+            attempt = _Attempt(self.fallback, messages, stop, kwargs)
+            primary = False
+        else:
+            primary = True
+        try:
+            async for chunk in self._drain(attempt):
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+        except Exception:
+            if primary:
+                self.breaker.record_failure()
+            raise
+        finally:
+            attempt.cancel()
+        if primary:
+            self.breaker.record_success()
+
+    async def _race(self, messages, stop, kwargs) -> _Attempt:
+        """Start the primary, hedge it if it is slow to stream, and return the first
+        attempt that produces a chunk"""
+        loop_deadline = time.monotonic() + self.deadline
+        attempts = [_Attempt(self.primary, messages, stop, kwargs)]
+        delay = self.hedge.delay() if self.hedge else None
+        error: Optional[BaseException] = None
+        while True:
+            now = time.monotonic()
+            pending = [a for a in attempts if not a.first.done()]
+            can_hedge = delay is not None and len(attempts) == 1
+            if not pending and not can_hedge:
+                break
+            timeout = loop_deadline - now
+            if can_hedge:
+                timeout = min(timeout, attempts[0].started + delay - now)
+            if pending and timeout > 0:
+                await asyncio.wait([a.first for a in pending], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in attempts:
+                if attempt.first.done() and not attempt.first.cancelled():
+                    if attempt.first.exception() is None:
+                        for other in attempts:
+                            if other is not attempt:
+                                other.cancel()
+                        if self.hedge:
+                            self.hedge.record(attempt.first_chunk_at - attempt.started, len(attempts) > 1)
+                        if len(attempts) > 1:
+                            llm_hedges.labels("won" if attempt is attempts[1] else "lost").inc()
+                        return attempt
+                    error = attempt.first.exception()
+            if time.monotonic() >= loop_deadline:
+                break
+            if can_hedge and (time.monotonic() - attempts[0].started >= delay or attempts[0].first.done()):
+                llm_hedges.labels("started").inc()
+                attempts.append(_Attempt(self.primary, messages, stop, kwargs))
+        for attempt in attempts:
+            attempt.cancel()
+        if error is not None and all(a.first.done() for a in attempts):
+            raise error
+        llm_deadline_exceeded.labels(self.breaker.name).inc()
+        raise asyncio.TimeoutError(f"no response from {self.breaker.name} within {self.deadline}s")
+
+    async def _drain(self, attempt: _Attempt) -> AsyncIterator[ChatGenerationChunk]:
+        deadline = attempt.started + self.deadline
+        while True:
+            try:
+                item = await asyncio.wait_for(attempt.queue.get(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                llm_deadline_exceeded.labels(self.breaker.name).inc()
+                raise
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # The server is async; sync callers get the breaker and fallback, not hedging
+        if self.breaker.allow():
+            try:
+                result = self.primary._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception:
+                self.breaker.record_failure()
+                if self.fallback is None:
+                    raise
+                llm_failovers.labels("error").inc()
+            else:
+                self.breaker.record_success()
+                return result
+        elif self.fallback is None:
+            raise CircuitOpenError(f"{self.breaker.name} is unavailable")
+        else:
+            llm_failovers.labels("circuit_open").inc()
+        return self.fallback._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # Like _generate: the breaker and the fallback, which only takes over while
+        # nothing was streamed yet
+        if self.breaker.allow():
+            streamed = False
+            try:
+                for chunk in self.primary._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    streamed = True
+                    yield chunk
+            except Exception:
+                self.breaker.record_failure()
+                if streamed or self.fallback is None:
+                    raise
+                llm_failovers.labels("error").inc()
+            else:
+                self.breaker.record_success()
+                return
+        elif self.fallback is None:
+            raise CircuitOpenError(f"{self.breaker.name} is unavailable")
+        else:
+            llm_failovers.labels("circuit_open").inc()
+        yield from self.fallback._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def build_chat_model(model: str = "gpt-3.5-turbo", **model_kwargs: Any) -> BaseChatModel:
+    """The agent's chat model with the settings from the environment
+
+    LLM_RESILIENCE=false gives back a plain ChatOpenAI on the shared pools. `tags` go
+    on the model the agent calls, whichever that is.
+    """
+    tags = model_kwargs.pop("tags", None)
+    http_client, http_async_client = http_clients()
+    deadline = _env_float("LLM_DEADLINE_SECONDS", 30)
+    common = {
+        "http_client": http_client,
+        "http_async_client": http_async_client,
+        "request_timeout": deadline,
+        "max_retries": int(os.environ.get("LLM_MAX_RETRIES", "1")),
+        **model_kwargs,
+    }
+    if os.environ.get("LLM_RESILIENCE", "true").lower() != "true":
+        return ChatOpenAI(model=model, tags=tags, **common)
+    primary = ChatOpenAI(model=model, **common)
+
+    fallback = None
+    if os.environ.get("LLM_FALLBACK_MODEL") or os.environ.get("LLM_FALLBACK_BASE_URL"):
+        fallback_options = {}
+        if os.environ.get("LLM_FALLBACK_BASE_URL"):
+            fallback_options["base_url"] = os.environ["LLM_FALLBACK_BASE_URL"]
+        if os.environ.get("LLM_FALLBACK_API_KEY"):
+            fallback_options["api_key"] = os.environ["LLM_FALLBACK_API_KEY"]
+        fallback = ChatOpenAI(model=os.environ.get("LLM_FALLBACK_MODEL", model), **common, **fallback_options)
+
+    hedge = None
+    if os.environ.get("LLM_HEDGE", "true").lower() == "true":
+        hedge = HedgePolicy(
+            quantile=_env_float("LLM_HEDGE_QUANTILE", 0.95),
+            min_delay=_env_float("LLM_HEDGE_MIN_DELAY_SECONDS", 0.5),
+            max_ratio=_env_float("LLM_HEDGE_MAX_RATIO", 0.1),
+        )
+    return ResilientChatModel(
+        tags=tags,
+        primary=primary,
+        fallback=fallback,
+        deadline=deadline,
+        hedge=hedge,
+        breaker=CircuitBreaker(
+            model,
+            failures=int(os.environ.get("LLM_BREAKER_FAILURES", "5")),
+            reset_seconds=_env_float("LLM_BREAKER_RESET_SECONDS", 30),
+        ),
+    )
@@ -0,0 +1,159 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+# Carried into every log record of the request that set them, across awaits and tasks
+session_id_var: ContextVar[Optional[str]] = ContextVar("session_id", default=None)
+run_id_var: ContextVar[Optional[str]] = ContextVar("run_id", default=None)
+# Whether this request's records below WARNING are kept, decided once per request
+sampled_var: ContextVar[Optional[bool]] = ContextVar("log_sampled", default=None)
+
+# Attributes every LogRecord has; anything else was passed in `extra` and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_sample_rate = 1.0
+_listener: Optional[QueueListener] = None
+_handler: Optional["DroppingQueueHandler"] = None
+_registered = False
+
+
+def bind_session(session_id: str) -> None:
+    """Attach `session_id` to this request's records and make its sampling decision"""
+    if session_id_var.get() == session_id:
+        return
+    session_id_var.set(session_id)
+    sampled_var.set(random.random() < _sample_rate)
+
+
+def bind_run(run_id: Any) -> None:
+    run_id_var.set(str(run_id))
+
+
+class ContextFilter(logging.Filter):
+    """Adds the session and run ids and drops records of requests that were not sampled
+
+    Records at WARNING and above are always kept. Below that a whole request is kept or
+    dropped, so a sampled request can be followed from start to end.
+    """
+
+    def __init__(self, sample_rate: float = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and self.sample_rate < 1.0:
+            sampled = sampled_var.get()
+            if sampled is None:
+                sampled = random.random() < self.sample_rate
+            if not sampled:
+                return False
+        # Background work (flushes, folds) passes its session in `extra` instead
+        record.session_id = getattr(record, "session_id", None) or session_id_var.get()
+        record.run_id = getattr(record, "run_id", None) or run_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, which CloudWatch Logs Insights parses on its own"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener thread; drops them instead of blocking when it falls behind"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Format lazily on the listener thread; only resolve the message and traceback here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging() -> None:
+    """Route the app's logs through a bounded queue to a stdout writer thread
+
+    LOG_LEVEL sets the level of the app's loggers and LOG_LIBRARY_LEVEL that of everything
+    else (langchain, httpx, pymongo). LOG_SAMPLE_RATE the share of requests whose records below
+    WARNING are kept, LOG_FORMAT is "json" or "text" and LOG_QUEUE_SIZE bounds the queue.
+    Safe to call more than once.
+    """
+    global _listener, _handler, _sample_rate, _registered
+    if _listener is not None:
+        return
+    _sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+    stream = logging.StreamHandler(sys.stdout)
+    if os.environ.get("LOG_FORMAT", "json") == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(session_id)s %(run_id)s] %(message)s")
+        )
+    _handler = DroppingQueueHandler(queue.Queue(int(os.environ.get("LOG_QUEUE_SIZE", "10000"))))
+    _handler.addFilter(ContextFilter(_sample_rate))
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LIBRARY_LEVEL", "WARNING").upper())
+    root.addHandler(_handler)
+    logging.getLogger("app").setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    _listener = QueueListener(_handler.queue, stream, respect_handler_level=False)
+    _listener.start()
+    if not _registered:
+        _registered = True
+        atexit.register(shutdown_logging)
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def _restart_after_fork() -> None:
+    # The listener thread does not survive fork() and its queue may be mid-put, start over
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _listener = _handler = None
+    configure_logging()
+
+
+def shutdown_logging() -> None:
+    """Write out whatever is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
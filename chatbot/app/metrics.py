@@ -0,0 +1,396 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from .history import ahas_messages, has_messages
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # Per bucket, not cumulative, so an observation touches one slot; the last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """A metric family; `labels(...)` returns the series for one set of label values
+
+    Series are plain objects updated without locks. Updates come from the event loop
+    thread (the callback handler runs inline there), so none are lost in practice.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def _new(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series.setdefault(values, self._new())
+        return series
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in list(self._series.items()):
+            lines.extend(self._render_series(_format_labels(self.labelnames, values), values, series))
+        return lines
+
+    def _render_series(self, labels: str, values, series) -> List[str]:
+        return [f"{self.name}{labels} {_format_value(series.value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new(self):
+        return _CounterValue()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new(self):
+        return _GaugeValue()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        # The +Inf bucket is always rendered; a second one would fail the whole scrape
+        self.buckets = tuple(bound for bound in buckets if bound != float("inf"))
+        super().__init__(name, documentation, labelnames)
+
+    def _new(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_series(self, labels: str, values, series: _HistogramValue) -> List[str]:
+        lines = []
+        cumulative = 0
+        counts = list(series.counts)
+        for bound, count in zip((*self.buckets, float("inf")), counts):
+            cumulative += count
+            le = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format (version 0.0.4)"""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+requests_in_flight = Gauge("chatbot_requests_in_flight", "Agent requests currently running")
+request_seconds = Histogram("chatbot_request_seconds", "Agent request latency", ["status"])
+request_tokens = Histogram("chatbot_request_tokens", "LLM tokens used per agent request", buckets=TOKEN_BUCKETS)
+tokens_total = Counter("chatbot_llm_tokens_total", "LLM tokens used", ["model", "kind"])
+history_seconds = Histogram("chatbot_history_seconds", "Session history load and write latency", ["operation"])
+history_writes_dropped = Counter(
+    "chatbot_history_writes_dropped_total", "Queued history messages given up after repeated flush failures"
+)
+llm_first_token_seconds = Histogram("chatbot_llm_first_token_seconds", "Time to the first streamed token", ["model"])
+llm_seconds = Histogram("chatbot_llm_seconds", "LLM call latency", ["model", "status"])
+tool_seconds = Histogram("chatbot_tool_seconds", "Tool call latency", ["tool", "status"])
+event_loop_lag_seconds = Histogram(
+    "chatbot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task", buckets=LAG_BUCKETS
+)
+admission_limit = Gauge("chatbot_admission_limit", "Current cap on concurrent agent requests")
+admission_queued = Gauge("chatbot_admission_queued", "Agent requests waiting for a slot")
+admission_rejections = Counter("chatbot_admission_rejections_total", "Agent requests turned away", ["reason"])
+admission_wait_seconds = Histogram("chatbot_admission_wait_seconds", "Time agent requests waited for a slot")
+rate_limit_rejections = Counter("chatbot_rate_limit_rejections_total", "Agent requests over their rate limit", ["scope"])
+llm_hedges = Counter("chatbot_llm_hedges_total", "Hedged LLM attempts started and which attempt streamed first", ["result"])
+llm_hedge_delay_seconds = Gauge("chatbot_llm_hedge_delay_seconds", "Wait for the first chunk before hedging")
+llm_failovers = Counter("chatbot_llm_failovers_total", "LLM calls answered by the fallback model", ["reason"])
+llm_deadline_exceeded = Counter("chatbot_llm_deadline_exceeded_total", "LLM attempts cut off at their deadline", ["model"])
+llm_circuit_state = Gauge("chatbot_llm_circuit_state", "LLM circuit breaker: 0 closed, 1 open, 2 half-open", ["model"])
+traces_exported = Counter("chatbot_traces_exported_total", "Traces sent to LangSmith")
+traces_dropped = Counter("chatbot_traces_dropped_total", "Traces dropped because the export queue was full")
+stream_first_token_seconds = Histogram(
+    "chatbot_stream_first_token_seconds",
+    "Time from a /stream request to the first answer text sent, streamed token or whole answer",
+    ["source"],
+)
+session_affinity = Counter(
+    "chatbot_session_affinity_total",
+    "Agent requests by where their session was last served: same task, migrated from another, or new",
+    ["result"],
+)
+batch_items = Counter("chatbot_batch_items_total", "Items of /batch requests by outcome", ["result"])
+batch_history_seconds = Histogram(
+    "chatbot_batch_history_seconds", "Bulk history read before and write after a /batch request", ["operation"]
+)
+request_allocated_blocks = Histogram(
+    "chatbot_request_allocated_blocks",
+    "Net memory blocks allocated during sampled requests (process-wide, see profiling.py)",
+    ["route"],
+    buckets=(100, 1000, 10000, 50000, 100000, 500000, 1000000),
+)
+scheduler_wait_seconds = Histogram(
+    "chatbot_scheduler_wait_seconds", "Time agent LLM calls waited for a slot, by priority class", ["priority"]
+)
+scheduler_queued = Gauge("chatbot_scheduler_queued", "Agent LLM calls waiting for a slot", ["priority"])
+scheduler_running = Gauge("chatbot_scheduler_running", "Agent LLM calls holding a slot", ["priority"])
+requests_in_flight.labels().set(0)
+
+
+class _Run:
+    __slots__ = ("root", "start", "name", "first_token", "streamed", "tokens")
+
+    def __init__(self, root: Optional[UUID], name: str = ""):
+        self.root = root
+        self.start = time.perf_counter()
+        self.name = name
+        self.first_token = False
+        self.streamed = 0
+        self.tokens = 0
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Feeds the request, LLM, tool and token metrics from LangChain callbacks
+
+    Runs inline (no executor hop) and only keeps a small record per open run.
+    `on_llm_latency`, if given, is called with the duration of every finished LLM call.
+    """
+
+    run_inline = True
+
+    def __init__(self, on_llm_latency: Optional[Callable[[float], None]] = None):
+        self._runs: Dict[UUID, _Run] = {}
+        self._on_llm_latency = on_llm_latency
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str = "") -> _Run:
+        parent = self._runs.get(parent_run_id) if parent_run_id else None
+        run = _Run(parent.root if parent else parent_run_id or run_id, name)
+        self._runs[run_id] = run
+        return run
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        self._start(run_id, parent_run_id)
+        if parent_run_id is None:
+            requests_in_flight.labels().inc()
+
+    def _end_chain(self, run_id: UUID, status: str) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None or run.root != run_id:
+            return
+        requests_in_flight.labels().dec()
+        request_seconds.labels(status).observe(time.perf_counter() - run.start)
+        if run.tokens:
+            request_tokens.labels().observe(run.tokens)
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs):
+        self._end_chain(run_id, "ok")
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs):
+        self._end_chain(run_id, "error")
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id: UUID, parent_run_id: Optional[UUID] = None, metadata=None, **kwargs
+    ):
+        self._start(run_id, parent_run_id, (metadata or {}).get("ls_model_name") or "unknown")
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, parent_run_id: Optional[UUID] = None, metadata=None, **kwargs):
+        self._start(run_id, parent_run_id, (metadata or {}).get("ls_model_name") or "unknown")
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        run = self._runs.get(run_id)
+        if run is None:
+            return
+        if not run.first_token:
+            run.first_token = True
+            llm_first_token_seconds.labels(run.name).observe(time.perf_counter() - run.start)
+        run.streamed += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        elapsed = time.perf_counter() - run.start
+        llm_seconds.labels(run.name, "ok").observe(elapsed)
+        if self._on_llm_latency is not None:
+            self._on_llm_latency(elapsed)
+        prompt, completion = _token_usage(response)
+        if prompt is None:
+            # Streamed without usage: each new-token callback is about one token
+            prompt, completion = 0, run.streamed
+        if prompt:
+            tokens_total.labels(run.name, "prompt").inc(prompt)
+        if completion:
+            tokens_total.labels(run.name, "completion").inc(completion)
+        root = self._runs.get(run.root)
+        if root is not None:
+            root.tokens += prompt + completion
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            elapsed = time.perf_counter() - run.start
+            llm_seconds.labels(run.name, "error").observe(elapsed)
+            if self._on_llm_latency is not None:
+                self._on_llm_latency(elapsed)
+
+    def on_tool_start(self, serialized, input_str, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        self._start(run_id, parent_run_id, (serialized or {}).get("name") or "unknown")
+
+    def _end_tool(self, run_id: UUID, status: str) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            tool_seconds.labels(run.name, status).observe(time.perf_counter() - run.start)
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs):
+        self._end_tool(run_id, "ok")
+
+    def on_tool_error(self, error, *, run_id: UUID, **kwargs):
+        self._end_tool(run_id, "error")
+
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        self._start(run_id, parent_run_id)
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs):
+        self._runs.pop(run_id, None)
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+def _token_usage(response: LLMResult) -> Tuple[Optional[int], int]:
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("token_usage")
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return None, 0
+
+
+class TimedChatMessageHistory(BaseChatMessageHistory):
+    """Records how long loading and writing a session's history takes"""
+
+    def __init__(self, history: BaseChatMessageHistory):
+        self.history = history
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        start = time.perf_counter()
+        try:
+            return self.history.messages
+        finally:
+            history_seconds.labels("load").observe(time.perf_counter() - start)
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        start = time.perf_counter()
+        try:
+            return await self.history.aget_messages()
+        finally:
+            history_seconds.labels("load").observe(time.perf_counter() - start)
+
+    def has_messages(self) -> bool:
+        return has_messages(self.history)
+
+    async def ahas_messages(self) -> bool:
+        return await ahas_messages(self.history)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        start = time.perf_counter()
+        try:
+            self.history.add_messages(messages)
+        finally:
+            history_seconds.labels("write").observe(time.perf_counter() - start)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        start = time.perf_counter()
+        try:
+            await self.history.aadd_messages(messages)
+        finally:
+            history_seconds.labels("write").observe(time.perf_counter() - start)
+
+    def clear(self) -> None:
+        self.history.clear()
+
+    async def aclear(self) -> None:
+        await self.history.aclear()
+
+
+async def monitor_event_loop_lag(interval: float = 0.25) -> None:
+    """Sleeps `interval` in a loop and records how much later than asked it woke up"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.labels().observe(max(0.0, loop.time() - start - interval))
@@ -1,3 +1,6 @@
+import logging
+import time
+
 from langchain.agents import AgentExecutor
 from langchain_core.tools import BaseTool
 
@@ -13,7 +16,7 @@ from typing import (
     Tuple,
     Union,
 )
-from langchain_core.tools import BaseTool
+from langchain_core.tools import BaseTool, StructuredTool, Tool
 from langchain_core.agents import AgentAction, AgentFinish, AgentStep
 
 from langchain_core.callbacks import (
@@ -26,6 +29,10 @@ from langchain_core.callbacks import (
 )
 from langchain.agents.tools import InvalidTool
 
+from .log import bind_run
+
+logger = logging.getLogger(__name__)
+
 
 async def _aperform_agent_action(
     self,
@@ -39,8 +46,7 @@ async def _aperform_agent_action(
             agent_action, verbose=self.verbose, color="green"
         )
     # Otherwise we lookup the tool
-    # print(run_manager)
-    print(run_manager.metadata["session_id"])
+    bind_run(run_manager.run_id)
     if agent_action.tool in name_to_tool_map:
         tool = name_to_tool_map[agent_action.tool]
         return_direct = tool.return_direct
@@ -50,7 +56,7 @@ async def _aperform_agent_action(
             tool_run_kwargs["llm_prefix"] = ""
         # We then call the tool on the tool input to get an observation
         agent_action.tool_input["session_id"] = run_manager.metadata["session_id"]
-        print("inside aperform agent action", agent_action.tool_input)
+        start = time.perf_counter()
         observation = await tool.arun(
             agent_action.tool_input,
             verbose=self.verbose,
@@ -58,7 +64,15 @@ async def _aperform_agent_action(
             callbacks=run_manager.get_child() if run_manager else None,
             **tool_run_kwargs,
         )
-        print("observation", observation)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "tool call",
+                extra={
+                    "tool": agent_action.tool,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "observation_chars": len(str(observation)),
+                },
+            )
     else:
         tool_run_kwargs = self.agent.tool_run_logging_kwargs()
         observation = await InvalidTool().arun(
@@ -79,6 +93,72 @@ async def _aperform_agent_action(
 AgentExecutor._aperform_agent_action = _aperform_agent_action
 
 
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+# At most this many tool calls from one LLM step run at the same time
+TOOL_MAX_CONCURRENCY = int(os.environ.get("TOOL_MAX_CONCURRENCY", "4"))
+# A tool call still running after this long is answered with a timeout observation
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("TOOL_TIMEOUT_SECONDS", "10"))
+# Sync tools run here instead of the event loop's shared default executor. A thread can
+# not be cancelled: a sync tool that times out keeps its thread until it returns, so the
+# pool size also bounds the work left running by timed-out calls
+TOOL_THREAD_POOL_SIZE = int(os.environ.get("TOOL_THREAD_POOL_SIZE", "8"))
+
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_THREAD_POOL_SIZE, thread_name_prefix="tool")
+
+
+# AgentExecutor gathers the tool calls of a step, so a run's calls in flight are one
+# step's; the semaphore of each run lives while any of its calls do
+_run_semaphores: Dict[Any, List[Any]] = {}
+
+
+@asynccontextmanager
+async def _run_slot(run_manager: Optional[AsyncCallbackManagerForChainRun]):
+    key = run_manager.run_id if run_manager else None
+    entry = _run_semaphores.setdefault(key, [asyncio.Semaphore(TOOL_MAX_CONCURRENCY), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _run_semaphores[key]
+
+
+async def _aperform_with_limits(
+    self,
+    name_to_tool_map: Dict[str, BaseTool],
+    color_mapping: Dict[str, str],
+    agent_action: AgentAction,
+    run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+) -> AgentStep:
+    """_aperform_agent_action under TOOL_MAX_CONCURRENCY and TOOL_TIMEOUT_SECONDS"""
+    async with _run_slot(run_manager):
+        try:
+            return await asyncio.wait_for(
+                _aperform_agent_action(
+                    self, name_to_tool_map, color_mapping, agent_action, run_manager
+                ),
+                TOOL_TIMEOUT_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            # The tool run was cancelled and ended with an error (see arun below).
+            # Let the agent answer with what the other tools returned
+            observation = f"{agent_action.tool} did not answer within {TOOL_TIMEOUT_SECONDS:g} seconds"
+            logger.warning(
+                "tool timed out", extra={"tool": agent_action.tool, "timeout_seconds": TOOL_TIMEOUT_SECONDS}
+            )
+            return AgentStep(action=agent_action, observation=observation)
+
+
+AgentExecutor._aperform_agent_action = _aperform_with_limits
+
+
 
 import uuid
 from langchain_core.runnables import (
@@ -128,6 +208,19 @@ class ToolException(Exception):
 
     pass
 
+def _is_sync_tool(tool: BaseTool) -> bool:
+    # Tools built from a plain function without a coroutine only have _run
+    if isinstance(tool, (StructuredTool, Tool)):
+        return tool.coroutine is None and tool.func is not None
+    return type(tool)._arun is BaseTool._arun
+
+
+async def _await_in_context(context, coro):
+    if accepts_context(asyncio.create_task):
+        return await asyncio.create_task(coro, context=context)  # type: ignore
+    return await coro
+
+
 async def arun(
     self,
     tool_input: Union[str, Dict],
@@ -168,7 +261,6 @@ async def arun(
         **kwargs,
     )
     try:
-        print("tool_input", tool_input)
         parsed_input = self._parse_input(tool_input)
         if ("session_id" in tool_input):
             parsed_input["session_id"] = tool_input["session_id"]
@@ -180,17 +272,23 @@ async def arun(
         )
         context = copy_context()
         context.run(_set_config_context, child_config)
-        coro = (
-            context.run(
-                self._arun, *tool_args, run_manager=run_manager, **tool_kwargs
+        if _is_sync_tool(self):
+            # Same as BaseTool._arun, but on the bounded tool pool
+            sync_kwargs = dict(tool_kwargs)
+            if signature(self._run).parameters.get("run_manager"):
+                sync_kwargs["run_manager"] = run_manager.get_sync()
+            observation = await asyncio.get_running_loop().run_in_executor(
+                tool_executor, partial(context.run, self._run, *tool_args, **sync_kwargs)
+            )
+        elif new_arg_supported:
+            observation = await _await_in_context(
+                context,
+                context.run(self._arun, *tool_args, run_manager=run_manager, **tool_kwargs),
             )
-            if new_arg_supported
-            else context.run(self._arun, *tool_args, **tool_kwargs)
-        )
-        if accepts_context(asyncio.create_task):
-            observation = await asyncio.create_task(coro, context=context)  # type: ignore
         else:
-            observation = await coro
+            observation = await _await_in_context(
+                context, context.run(self._arun, *tool_args, **tool_kwargs)
+            )
 
     except ValidationError as e:
         if not self.handle_validation_error:
@@ -232,6 +330,11 @@ async def arun(
     except (Exception, KeyboardInterrupt) as e:
         await run_manager.on_tool_error(e)
         raise e
+    except asyncio.CancelledError as e:
+        # Timed out (see _aperform_with_limits) or the request went away: end the tool run
+        # instead of leaving it open in the callbacks and traces
+        await run_manager.on_tool_error(e)
+        raise
     else:
         await run_manager.on_tool_end(
             observation, color=color, name=self.name, **kwargs
@@ -0,0 +1,263 @@
+import gc
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .metrics import request_allocated_blocks
+
+# Leaf frames of threads that are waiting rather than working (event loop idle in select,
+# executor and writer threads blocked on their queues)
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _short_path(filename: str) -> str:
+    for marker in ("site-packages/", "/lib/python"):
+        index = filename.rfind(marker)
+        if index != -1:
+            return filename[index + len(marker):].lstrip("0123456789./")
+    return os.path.relpath(filename) if filename.startswith(os.getcwd()) else filename
+
+
+def _frame_label(code) -> str:
+    # One frame per function, not per line, so a flame graph merges its samples
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def authorized(header: Optional[str], token: str) -> bool:
+    """Whether an Authorization header carries the admin token"""
+    scheme, _, value = (header or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(value.strip().encode(), token.encode())
+
+
+class StackSampler:
+    """Sampling CPU profiler over every thread of the process
+
+    A thread wakes up every `interval` seconds and records the Python stack of each
+    other thread, one profile at a time. The result is in the collapsed format
+    (`frame;frame;frame count` per line, root first) that flamegraph.pl, speedscope and
+    inferno read. Nothing runs between profiles.
+    """
+
+    def __init__(self, interval: float = 0.01, max_seconds: float = 60):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.profiles = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, idle: bool = False) -> Tuple[Counter, int]:
+        """Stacks seen in `seconds` with how often, and the number of sampling rounds;
+        raises RuntimeError while another profile runs"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("a profile is already running")
+        try:
+            self.profiles += 1
+            return self._sample(min(seconds, self.max_seconds), idle)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds: float, idle: bool) -> Tuple[Counter, int]:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        labels: Dict[Any, str] = {}
+        rounds = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if not idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(stack))] += 1
+            rounds += 1
+            time.sleep(self.interval)
+        return stacks, rounds
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval_ms": self.interval * 1000,
+            "max_seconds": self.max_seconds,
+            "profiles": self.profiles,
+            "running": self.running,
+        }
+
+
+class MemorySnapshots:
+    """tracemalloc snapshots kept by id, and the difference between two of them
+
+    Tracing starts with the first snapshot and stops with `stop`. While it is on,
+    every allocation pays for recording its traceback, so turn it off when done.
+
+    Snapshots live in the worker that took them, and an admin request may reach any
+    worker of the task. Ids are `<pid>-<n>`, so a diff that reaches another worker is
+    refused instead of comparing unrelated snapshots.
+    """
+
+    def __init__(self, frames: int = 10, max_snapshots: int = 4):
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[str, Tuple[float, tracemalloc.Snapshot]]" = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def take(self) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        # Objects that are only waiting for the cycle collector would show up as growth
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+        ))
+        with self._lock:
+            snapshot_id = f"{os.getpid()}-{self._next_id}"
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        current, peak = tracemalloc.get_traced_memory()
+        return {"id": snapshot_id, "pid": os.getpid(), "traced_bytes": current, "peak_traced_bytes": peak}
+
+    def diff(self, base: str, target: str, group_by: str = "lineno", limit: int = 25) -> Dict[str, Any]:
+        """Where memory grew (or shrank) from snapshot `base` to `target`, largest first;
+        raises ValueError for an id of another worker and KeyError for an unknown or
+        evicted one"""
+        for snapshot_id in (base, target):
+            pid = snapshot_id.partition("-")[0]
+            if pid != str(os.getpid()):
+                raise ValueError(f"snapshot {snapshot_id} is not from worker {os.getpid()}, retry until this worker answers")
+        with self._lock:
+            base_time, base_snapshot = self._snapshots[base]
+            target_time, target_snapshot = self._snapshots[target]
+        differences = target_snapshot.compare_to(base_snapshot, group_by)
+        return {
+            "base": base,
+            "target": target,
+            "seconds": round(target_time - base_time, 3),
+            "size_diff_bytes": sum(d.size_diff for d in differences),
+            "count_diff": sum(d.count_diff for d in differences),
+            "top": [
+                {
+                    "size_diff_bytes": d.size_diff,
+                    "size_bytes": d.size,
+                    "count_diff": d.count_diff,
+                    "count": d.count,
+                    "traceback": [f"{_short_path(frame.filename)}:{frame.lineno}" for frame in d.traceback],
+                }
+                for d in differences[:limit]
+            ],
+        }
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        with self._lock:
+            self._snapshots.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        with self._lock:
+            snapshots = [{"id": i, "time": t} for i, (t, _) in self._snapshots.items()]
+        return {
+            "pid": os.getpid(),
+            "tracing": tracing,
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "snapshots": snapshots,
+        }
+
+
+class AllocationSampler:
+    """Net memory blocks allocated while a request ran, for a random share of requests
+
+    The count is `sys.getallocatedblocks()` after the response minus before, plus traced
+    bytes when tracemalloc is on. Both are process-wide, so requests running at the same
+    time show up in each other's numbers: read them per route over many samples, or
+    take them with little concurrency.
+    """
+
+    def __init__(self, rate: float = 0.0):
+        self.rate = rate
+        self.samples = 0
+        # route -> [samples, total blocks, max blocks, samples with tracemalloc on, total traced bytes]
+        self._routes: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, blocks: int, traced_bytes: Optional[int]) -> None:
+        request_allocated_blocks.labels(route).observe(max(blocks, 0))
+        with self._lock:
+            self.samples += 1
+            entry = self._routes.setdefault(route, [0, 0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += blocks
+            entry[2] = max(entry[2], blocks)
+            if traced_bytes is not None:
+                entry[3] += 1
+                entry[4] += traced_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routes = {
+                route: {
+                    "samples": samples,
+                    "mean_blocks": round(total / samples),
+                    "max_blocks": largest,
+                    "mean_traced_bytes": round(traced / traced_samples) if traced_samples else None,
+                }
+                for route, (samples, total, largest, traced_samples, traced) in self._routes.items()
+            }
+        return {"rate": self.rate, "samples": self.samples, "routes": routes}
+
+
+class AllocationSamplingMiddleware:
+    """Feeds AllocationSampler; unsampled requests cost one random() call"""
+
+    def __init__(self, app, sampler: AllocationSampler):
+        self.app = app
+        self.sampler = sampler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.sampler.rate or random.random() >= self.sampler.rate:
+            await self.app(scope, receive, send)
+            return
+        tracing = tracemalloc.is_tracing()
+        traced_before = tracemalloc.get_traced_memory()[0] if tracing else None
+        blocks_before = sys.getallocatedblocks()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            blocks = sys.getallocatedblocks() - blocks_before
+            traced = tracemalloc.get_traced_memory()[0] - traced_before if tracing and tracemalloc.is_tracing() else None
+            # The router leaves the matched route in the scope; its path template keeps
+            # the label's cardinality low
+            self.sampler.record(getattr(scope.get("route"), "path", "unmatched"), blocks, traced)
@@ -0,0 +1,311 @@
+import logging
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+from .metrics import rate_limit_rejections
+from .request_body import read_agent_calls
+
+logger = logging.getLogger(__name__)
+
+
+class BucketStore:
+    """Where token buckets live; `take` is the only operation the limiter needs"""
+
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        """Take `cost` tokens from the bucket `key` (refilled at `rate` per second up to
+        `burst`); returns 0 if they were taken, otherwise the seconds until they could be
+
+        A cost above the burst is taken from a full bucket and leaves it in debt, which
+        the refill pays back before anything else is let through."""
+        raise NotImplementedError
+
+    async def refund(self, key: str, cost: float, burst: float) -> None:
+        """Give back `cost` tokens taken from the bucket `key`"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class MemoryBucketStore(BucketStore):
+    """Buckets in a dict of this process; a take costs a few microseconds
+
+    An idle bucket refills, which is the same as having none, so when the dict reaches
+    `max_keys` the buckets idle for an hour are dropped, then the oldest.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> [tokens, monotonic time of the last update]
+        self._buckets: Dict[str, List[float]] = {}
+
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        return self.take_now(key, cost, rate, burst, time.monotonic())
+
+    def take_now(self, key: str, cost: float, rate: float, burst: float, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._evict(now)
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        needed = min(cost, burst)
+        if bucket[0] >= needed:
+            bucket[0] -= cost
+            return 0.0
+        return (needed - bucket[0]) / rate
+
+    async def refund(self, key: str, cost: float, burst: float) -> None:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(burst, bucket[0] + cost)
+
+    def _evict(self, now: float) -> None:
+        # A bucket idle for an hour has refilled for any sane rate, the same as a missing one
+        idle = [key for key, (_, updated) in self._buckets.items() if now - updated > 3600]
+        for key in idle:
+            del self._buckets[key]
+        overflow = len(self._buckets) - self.max_keys + 1
+        for key in list(self._buckets)[: max(0, overflow)]:
+            del self._buckets[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "keys": len(self._buckets)}
+
+
+class MongoBucketStore(BucketStore):
+    """Buckets shared by every task, one document per key in a Mongo collection
+
+    A take is a single find_one_and_update with an update pipeline, so the refill, the
+    check and the charge happen atomically on the server. Documents expire through a
+    TTL index once the bucket would have refilled.
+    """
+
+    def __init__(self, collection_name: str = "rate_limits"):
+        self.collection_name = collection_name
+        self._indexed = False
+        self.errors = 0
+
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        from pymongo import ReturnDocument
+
+        from .history.mongo import get_async_collection
+
+        collection = get_async_collection(self.collection_name)
+        now = time.time()
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated", now]}]}]}
+        refilled = {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [rate, elapsed]}]}]}
+        try:
+            if not self._indexed:
+                await collection.create_index("expireAt", expireAfterSeconds=0)
+                self._indexed = True
+            document = await collection.find_one_and_update(
+                {"_id": key},
+                [
+                    {"$set": {"tokens": refilled, "updated": now}},
+                    {"$set": {"allowed": {"$gte": ["$tokens", min(cost, burst)]}}},
+                    {"$set": {
+                        "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                        # Refilled by then, even from the deepest debt this take can leave
+                        "expireAt": datetime.now(timezone.utc) + timedelta(seconds=(burst + cost) / rate),
+                    }},
+                ],
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception:
+            # Fail open: an unreachable store must not take the chatbot down with it
+            self.errors += 1
+            logger.warning("rate limit store unavailable", exc_info=True)
+            return 0.0
+        if document["allowed"]:
+            return 0.0
+        return (min(cost, burst) - document["tokens"]) / rate
+
+    async def refund(self, key: str, cost: float, burst: float) -> None:
+        from .history.mongo import get_async_collection
+
+        try:
+            await get_async_collection(self.collection_name).update_one(
+                {"_id": key}, [{"$set": {"tokens": {"$min": [burst, {"$add": ["$tokens", cost]}]}}}]
+            )
+        except Exception:
+            # The bucket stays charged; the client only waits longer than it should
+            self.errors += 1
+            logger.warning("rate limit store unavailable", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "mongo", "collection": self.collection_name, "errors": self.errors}
+
+
+def estimate_tokens(text: str) -> int:
+    # About four characters per token for English; exact counts would cost milliseconds
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """Token buckets per session and per client IP, charged in estimated prompt tokens
+
+    Every agent call costs `base_tokens` (system prompt, tool schemas and history) plus
+    the estimated tokens of the input. A request is only charged if every bucket it needs
+    has the tokens: a rejection refunds what earlier buckets were charged. A request
+    costing more than the burst (a large /batch) is let through once the bucket is full
+    and puts it in debt, so its items are paid for at the refill rate. Only a request
+    costing more than the burst plus a minute of refill is refused outright.
+    Rejections are remembered in-process until the bucket could have refilled, so a
+    client looping on 429s never reaches a shared store.
+    """
+
+    def __init__(
+        self,
+        store: BucketStore,
+        session_tokens_per_minute: float = 20_000,
+        session_burst: float = 8_000,
+        ip_tokens_per_minute: float = 60_000,
+        ip_burst: float = 20_000,
+        base_tokens: int = 600,
+    ):
+        self.store = store
+        self.session_rate = session_tokens_per_minute / 60
+        self.session_burst = session_burst
+        self.ip_rate = ip_tokens_per_minute / 60
+        self.ip_burst = ip_burst
+        self.base_tokens = base_tokens
+        self.allowed = 0
+        self.rejected = {"session": 0, "ip": 0}
+        # key -> monotonic time before which it is rejected without asking the store
+        self._blocked: Dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        if os.environ.get("RATE_LIMIT_STORE", "memory") == "mongo":
+            store: BucketStore = MongoBucketStore(os.environ.get("RATE_LIMIT_COLLECTION", "rate_limits"))
+        else:
+            store = MemoryBucketStore(int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000")))
+        return cls(
+            store,
+            session_tokens_per_minute=float(os.environ.get("RATE_LIMIT_SESSION_TOKENS_PER_MINUTE", "20000")),
+            session_burst=float(os.environ.get("RATE_LIMIT_SESSION_BURST", "8000")),
+            ip_tokens_per_minute=float(os.environ.get("RATE_LIMIT_IP_TOKENS_PER_MINUTE", "60000")),
+            ip_burst=float(os.environ.get("RATE_LIMIT_IP_BURST", "20000")),
+            base_tokens=int(os.environ.get("RATE_LIMIT_BASE_TOKENS", "600")),
+        )
+
+    async def check(self, calls: List[Tuple[Optional[str], str]], ip: str) -> Optional[Tuple[str, float]]:
+        """Charge the (session_id, input) calls of one request; returns the scope that ran
+        out and the seconds to wait (inf if the request could never be let through), or
+        None if the request may go ahead"""
+        now = time.monotonic()
+        costs: Dict[str, int] = {}
+        for session_id, text in calls:
+            key = session_id or ""
+            costs[key] = costs.get(key, 0) + self.base_tokens + estimate_tokens(text)
+        # (scope, key, cost, rate, burst) of every bucket the request is charged to
+        charges = [("ip", "ip:" + ip, sum(costs.values()), self.ip_rate, self.ip_burst)]
+        charges += [
+            ("session", "session:" + session_id, cost, self.session_rate, self.session_burst)
+            for session_id, cost in costs.items()
+            if session_id
+        ]
+        for scope, _, cost, rate, burst in charges:
+            if cost > burst + rate * 60:
+                return self._reject(scope, None, now, math.inf)
+        for scope, key, *_ in charges:
+            wait = self._blocked_for(key, now)
+            if wait is not None:
+                return self._reject(scope, key, now, wait)
+        for i, (scope, key, cost, rate, burst) in enumerate(charges):
+            wait = await self.store.take(key, cost, rate, burst)
+            if wait:
+                for _, charged_key, charged_cost, _, charged_burst in charges[:i]:
+                    await self.store.refund(charged_key, charged_cost, charged_burst)
+                return self._reject(scope, key, now, wait)
+        self.allowed += 1
+        return None
+
+    def _blocked_for(self, key: str, now: float) -> Optional[float]:
+        until = self._blocked.get(key)
+        if until is None:
+            return None
+        if until <= now:
+            del self._blocked[key]
+            return None
+        return until - now
+
+    def _reject(self, scope: str, key: Optional[str], now: float, wait: float) -> Tuple[str, float]:
+        if key is not None and key not in self._blocked:
+            if len(self._blocked) >= 10_000:
+                self._blocked = {k: t for k, t in self._blocked.items() if t > now}
+            self._blocked[key] = now + wait
+        self.rejected[scope] += 1
+        rate_limit_rejections.labels(scope).inc()
+        return scope, wait
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+            "blocked_keys": len(self._blocked),
+            "store": self.store.stats(),
+        }
+
+
+def client_ip(scope, trust_forwarded: bool) -> str:
+    if trust_forwarded:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                # The load balancer appends the address it saw; anything before it is
+                # whatever the client chose to send
+                return value.decode("latin-1").rsplit(",", 1)[-1].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class RateLimitMiddleware:
+    """Applies the RateLimiter to POST requests under `prefix`, answering 429 with Retry-After,
+    or 413 for a request that needs more tokens than a burst plus a minute of refill
+
+    The sessions and inputs come from the body, see request_body.py.
+    """
+
+    def __init__(self, app, limiter: RateLimiter, prefix: str = "/website-bot", trust_forwarded: bool = True):
+        self.app = app
+        self.limiter = limiter
+        self.prefix = prefix
+        self.trust_forwarded = trust_forwarded
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        calls, receive = await read_agent_calls(scope, receive)
+        if calls is None:
+            # Disconnected before sending the body; let the app see it
+            await self.app(scope, receive, send)
+            return
+
+        rejection = await self.limiter.check(calls, client_ip(scope, self.trust_forwarded))
+        if rejection is not None:
+            scope_name, wait = rejection
+            if math.isinf(wait):
+                response = JSONResponse(
+                    {"detail": f"Request exceeds the rate limit burst for this {scope_name}, split it up"},
+                    status_code=413,
+                )
+                await response(scope, receive, send)
+                return
+            response = JSONResponse(
+                {"detail": f"Rate limit exceeded for this {scope_name}, try again later"},
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,74 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# Where read_agent_calls keeps the parsed calls for the middlewares after the first
+SCOPE_KEY = "chatbot.agent_calls"
+
+AgentCalls = List[Tuple[Optional[str], str]]
+
+
+async def read_agent_calls(scope, receive) -> Tuple[Optional[AgentCalls], Any]:
+    """The agent calls of a POST request, and the receive to hand on to the app
+
+    The first middleware that asks reads the whole body, parses it and keeps the calls
+    in the scope; the receive it gets back replays the body to the app. Middlewares
+    further in find the calls in the scope and neither read nor parse again. The calls
+    are None if the client disconnected before sending the body.
+    """
+    calls = scope.get(SCOPE_KEY)
+    if calls is not None:
+        return calls, receive
+    chunks = []
+    more = True
+    while more:
+        message = await receive()
+        if message["type"] != "http.request":
+            return None, replay([message], receive)
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    body = b"".join(chunks)
+    calls = scope[SCOPE_KEY] = agent_calls(body)
+    return calls, replay([{"type": "http.request", "body": body, "more_body": False}], receive)
+
+
+def agent_calls(body: bytes) -> AgentCalls:
+    """(session_id, input text) of every agent call in a langserve request body"""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return [(None, body.decode("utf-8", "replace"))]
+    if not isinstance(payload, dict):
+        return [(None, "")]
+    if "inputs" in payload:
+        inputs = payload.get("inputs") or []
+        configs = payload.get("config")
+        if not isinstance(configs, list):
+            configs = [configs] * len(inputs)
+        return [(_session_id(config), _text(item)) for item, config in zip(inputs, configs)]
+    return [(_session_id(payload.get("config")), _text(payload.get("input")))]
+
+
+def _session_id(config: Any) -> Optional[str]:
+    if isinstance(config, dict):
+        configurable = config.get("configurable")
+        if isinstance(configurable, dict) and configurable.get("session_id") is not None:
+            return str(configurable["session_id"])
+    return None
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, dict):
+        value = value.get("input", "")
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def replay(messages: List[Dict[str, Any]], receive):
+    """A receive that hands out `messages` (a body already read) before reading on"""
+    pending = list(messages)
+
+    async def replayed():
+        if pending:
+            return pending.pop(0)
+        return await receive()
+
+    return replayed
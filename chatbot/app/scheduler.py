@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from .metrics import scheduler_queued, scheduler_running, scheduler_wait_seconds
+
+# Highest first: interactive /stream chats, single /invoke calls, /batch items
+PRIORITIES = ("interactive", "invoke", "batch")
+ROUTE_PRIORITIES = {
+    "stream": "interactive",
+    "stream_log": "interactive",
+    "stream_events": "interactive",
+    "invoke": "invoke",
+    "batch": "batch",
+}
+
+_current: ContextVar[str] = ContextVar("priority", default="invoke")
+
+
+def current_priority() -> str:
+    """The priority class of the request the calling task serves"""
+    return _current.get()
+
+
+def request_priority(path: str, header: Optional[str]) -> str:
+    """The class of a request: by route, or the `X-Priority` header if that is lower"""
+    priority = ROUTE_PRIORITIES.get(path.rstrip("/").rsplit("/", 1)[-1], "invoke")
+    requested = (header or "").strip().lower()
+    # A client can give its work up for others, not jump ahead of them
+    if requested in PRIORITIES and PRIORITIES.index(requested) > PRIORITIES.index(priority):
+        return requested
+    return priority
+
+
+class PriorityScheduler:
+    """Hands out LLM call slots to the priority classes by weight
+
+    Agent runs take a slot for each LLM call and give it back when the call is done,
+    so the scheduler decides again at every call: a batch item that just got its tool
+    results queues behind waiting chats for its next call instead of keeping its slot.
+    At most `max_concurrency` calls run at once, and at most `limits[class]` of one
+    class, so a large batch can not take all of them. When slots free up, the classes
+    with waiters share them in proportion to their weights (stride scheduling: each
+    grant moves a class's pass on by 1/weight, and the lowest pass goes next), so lower
+    classes are slowed but never starved. Nobody waits while a slot they may use is
+    free: batch work fills whatever the others leave.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 32,
+        limits: Optional[Dict[str, int]] = None,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.limits = {p: max_concurrency for p in PRIORITIES}
+        self.limits.update(limits or {})
+        self.weights = {"interactive": 8.0, "invoke": 4.0, "batch": 1.0}
+        self.weights.update(weights or {})
+        self.running = {p: 0 for p in PRIORITIES}
+        self.granted = {p: 0 for p in PRIORITIES}
+        self.waited = {p: 0 for p in PRIORITIES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {p: deque() for p in PRIORITIES}
+        self._pass = {p: 0.0 for p in PRIORITIES}
+        self._virtual_time = 0.0
+        for priority in PRIORITIES:
+            scheduler_running.labels(priority).set(0)
+            scheduler_queued.labels(priority).set(0)
+
+    @classmethod
+    def from_env(cls) -> "PriorityScheduler":
+        max_concurrency = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", "32"))
+        # By default batch items get at most half the slots and /invoke three quarters,
+        # so a chat arriving while they are busy finds one free
+        return cls(
+            max_concurrency=max_concurrency,
+            limits={
+                "interactive": int(os.environ.get("SCHEDULER_INTERACTIVE_LIMIT") or max_concurrency),
+                "invoke": int(os.environ.get("SCHEDULER_INVOKE_LIMIT") or max(1, max_concurrency * 3 // 4)),
+                "batch": int(os.environ.get("SCHEDULER_BATCH_LIMIT") or max(1, max_concurrency // 2)),
+            },
+            weights={
+                "interactive": float(os.environ.get("SCHEDULER_INTERACTIVE_WEIGHT", "8")),
+                "invoke": float(os.environ.get("SCHEDULER_INVOKE_WEIGHT", "4")),
+                "batch": float(os.environ.get("SCHEDULER_BATCH_WEIGHT", "1")),
+            },
+        )
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self.running.values())
+
+    def _can_run(self, priority: str) -> bool:
+        return self.in_flight < self.max_concurrency and self.running[priority] < self.limits[priority]
+
+    async def acquire(self, priority: str) -> None:
+        start = time.perf_counter()
+        # After _wake, a free slot means nobody who may use it is waiting
+        if self._can_run(priority) and not self._waiters[priority]:
+            self._grant(priority)
+            scheduler_wait_seconds.labels(priority).observe(0)
+            return
+        waiters = self._waiters[priority]
+        if not waiters:
+            # A class coming back from idle starts at the others' pass instead of
+            # catching up on the turns it did not need
+            self._pass[priority] = max(self._pass[priority], self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        scheduler_queued.labels(priority).set(len(waiters))
+        self.waited[priority] += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(priority)
+            else:
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    pass
+                scheduler_queued.labels(priority).set(len(waiters))
+            raise
+        scheduler_wait_seconds.labels(priority).observe(time.perf_counter() - start)
+
+    def release(self, priority: str) -> None:
+        self.running[priority] -= 1
+        scheduler_running.labels(priority).set(self.running[priority])
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None) -> AsyncIterator[None]:
+        """Hold a slot of `priority` (the current request's class by default)"""
+        priority = priority or current_priority()
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def _grant(self, priority: str) -> None:
+        self.running[priority] += 1
+        self.granted[priority] += 1
+        self._virtual_time = self._pass[priority]
+        self._pass[priority] += 1 / self.weights[priority]
+        scheduler_running.labels(priority).set(self.running[priority])
+
+    def _wake(self) -> None:
+        while self.in_flight < self.max_concurrency:
+            ready = [p for p in PRIORITIES if self._waiters[p] and self.running[p] < self.limits[p]]
+            if not ready:
+                return
+            # Ties go to the higher class
+            priority = min(ready, key=lambda p: self._pass[p])
+            waiter = self._waiters[priority].popleft()
+            scheduler_queued.labels(priority).set(len(self._waiters[priority]))
+            if not waiter.done():
+                self._grant(priority)
+                waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "classes": {
+                p: {
+                    "weight": self.weights[p],
+                    "limit": self.limits[p],
+                    "running": self.running[p],
+                    "queued": len(self._waiters[p]),
+                    "granted": self.granted[p],
+                    "waited": self.waited[p],
+                }
+                for p in PRIORITIES
+            },
+        }
+
+
+class PriorityMiddleware:
+    """Sets the priority class of POST requests under `prefix` for the agent run
+
+    The class comes from the route (see ROUTE_PRIORITIES) and can be lowered with an
+    `X-Priority: invoke|batch` header, e.g. by a back-office job that calls /invoke.
+    """
+
+    def __init__(self, app, prefix: str = "/website-bot"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        header = None
+        for name, value in scope["headers"]:
+            if name == b"x-priority":
+                header = value.decode("latin-1")
+                break
+        token = _current.set(request_priority(scope["path"], header))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
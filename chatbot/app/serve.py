@@ -0,0 +1,130 @@
+"""Production entry point: the app is imported and built once, then forked into workers
+
+    python -m app.serve
+
+WEB_CONCURRENCY sets the number of workers; by default it is the container's CPU
+allowance (cgroup quota, at least 1) times WORKERS_PER_CPU, capped at MAX_WORKERS.
+With HISTORY_CACHE=true there is always one worker: the cache and its write-behind queue
+live in the process, and ALB stickiness pins a session to the task, not to a worker.
+Workers share the listening socket and each runs the FastAPI startup hooks (Mongo pools,
+warm-up) before it accepts connections. A worker that dies is replaced; SIGTERM is
+passed on to every worker for a graceful shutdown.
+"""
+import logging
+import math
+import os
+import signal
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger("app.serve")
+
+
+def _cgroup_cpus() -> Optional[float]:
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_count() -> float:
+    cpus = float(len(os.sched_getaffinity(0)))
+    quota = _cgroup_cpus()
+    return min(cpus, quota) if quota else cpus
+
+
+def worker_count() -> int:
+    if os.environ.get("HISTORY_CACHE", "false") == "true":
+        if int(os.environ.get("WEB_CONCURRENCY") or "1") > 1:
+            logger.warning("HISTORY_CACHE needs a single worker, ignoring WEB_CONCURRENCY")
+        return 1
+    if os.environ.get("WEB_CONCURRENCY"):
+        return max(1, int(os.environ["WEB_CONCURRENCY"]))
+    per_cpu = float(os.environ.get("WORKERS_PER_CPU", "1"))
+    workers = max(1, math.floor(cpu_count() * per_cpu))
+    return min(workers, int(os.environ.get("MAX_WORKERS", "8")))
+
+
+def main() -> None:
+    import uvicorn
+
+    workers = worker_count()
+    # Preload: every import and the agent graph are built here once and shared by the
+    # workers through fork(); nothing in the import opens a connection or a thread
+    # other than the log writer, which restarts itself in the child
+    from .server import app
+
+    config = uvicorn.Config(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8080")),
+        timeout_graceful_shutdown=int(os.environ.get("GRACEFUL_SHUTDOWN_SECONDS", "20")),
+        # Longer than the load balancer's idle timeout, so it is never the app that
+        # closes a connection the load balancer is about to reuse (a 502)
+        timeout_keep_alive=int(os.environ.get("KEEP_ALIVE_SECONDS", "305")),
+    )
+    if workers == 1:
+        uvicorn.Server(config).run()
+        return
+
+    sock = config.bind_socket()
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                uvicorn.Server(config).run(sockets=[sock])
+            finally:
+                from .log import shutdown_logging
+
+                shutdown_logging()
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("starting workers", extra={"workers": workers, "cpus": cpu_count()})
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        logger.warning("worker exited, restarting", extra={"pid": pid, "status": status})
+        # Do not spin if workers die right after starting
+        if time.monotonic() - started < 5:
+            time.sleep(1)
+        spawn()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,340 @@
-from fastapi import FastAPI
+from . import startup
+
+# Per-module import times are reported once the app is ready
+startup.install_import_timer()
+
+import asyncio
+import logging
+import os
+import time
+
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
 from langserve import add_routes
 from langserve.pydantic_v1 import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Any
-from .agents.website_bot import website_chat_agent
+from typing import Any, Optional
+from .log import configure_logging
+from .tracing import configure_tracing
+
+# Before the agent is imported, so the catalog load and patches log through it
+configure_logging()
+# Sampled tracing replaces LangChain's trace-everything tracer, see tracing.py
+tracer = configure_tracing()
 
+with startup.phase("build agent"):
+    from .agents.website_bot import (
+        HISTORY_CACHE,
+        HISTORY_STORE,
+        HISTORY_TTL_SECONDS,
+        batch_runner,
+        fast_path,
+        history_cache,
+        history_writer,
+        response_cache,
+        scheduler,
+        single_flight,
+        token_streamer,
+        website_chat_agent,
+    )
+from .admission import AdmissionController, AdmissionControlMiddleware
+from .affinity import SessionAffinity, SessionAffinityMiddleware
+from .ratelimit import RateLimiter, RateLimitMiddleware
+from .scheduler import PriorityMiddleware
+from .llm import close_http_clients
+from .history.indexes import ensure_indexes
+from .history.mongo import close_clients, get_async_collection, get_collection, pool_stats
+from .metrics import CONTENT_TYPE, MetricsCallbackHandler, monitor_event_loop_lag, render
+from .profiling import AllocationSampler, AllocationSamplingMiddleware, MemorySnapshots, StackSampler, authorized
+
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Caps concurrent agent runs, the limit adapting to LLM latency
+admission = AdmissionController.from_env() if os.environ.get("ADMISSION_CONTROL", "true").lower() == "true" else None
+# Token buckets per session and client IP, charged in estimated prompt tokens
+rate_limiter = RateLimiter.from_env() if os.environ.get("RATE_LIMIT", "true").lower() == "true" else None
+
+
+def forget_session(session_id: str) -> None:
+    # The session was served elsewhere since this task cached it; reload it from Mongo
+    # unless this task still has writes of its own queued for it
+    if HISTORY_CACHE and not history_writer.is_pending(session_id):
+        history_cache.discard(session_id)
+
+
+# Cookie the load balancer keeps each session on one task with (see affinity.py)
+affinity = (
+    SessionAffinity.from_env(on_migrate=forget_session)
+    if os.environ.get("SESSION_AFFINITY", "false").lower() == "true"
+    else None
+)
+
+# Admin-only profiling of the live worker (see profiling.py); without PROFILING=true
+# and a token none of it is registered
+profiling_token = os.environ.get("PROFILING_TOKEN", "")
+profiling = os.environ.get("PROFILING", "false").lower() == "true"
+if profiling and not profiling_token:
+    logger.warning("PROFILING is on but PROFILING_TOKEN is not set, the profiling endpoints are disabled")
+    profiling = False
+
+
 class Input(BaseModel):
     input: str
 
 class Output(BaseModel):
     output: Any
 
-add_routes(
-    app,
-    website_chat_agent.with_types(input_type=Input, output_type=Output).with_config(
-        {"run_name": "agent"}
-    ),
-    path="/website-bot",
-)
+with startup.phase("add routes"):
+    add_routes(
+        app,
+        website_chat_agent.with_types(input_type=Input, output_type=Output).with_config(
+            {
+                "run_name": "agent",
+                "callbacks": [MetricsCallbackHandler(on_llm_latency=admission.observe_llm if admission else None)]
+                + ([tracer] if tracer is not None else []),
+            }
+        ),
+        path="/website-bot",
+    )
 
 # For health check, otherwise this will return 404
 @app.get("/")
 def get_root():
     return {"message": "FastAPI running in a Docker container"}
 
+# Pool utilization of the shared Mongo clients
+@app.get("/mongo/pool")
+def get_mongo_pool():
+    return pool_stats()
+
+
+# Hit rate of the in-process history cache and backlog of the write-behind queue
+@app.get("/history/cache")
+def get_history_cache():
+    return {"cache": history_cache.stats(), "writer": history_writer.stats()}
+
+
+# Price questions answered without the agent versus handed to it
+@app.get("/fast-path")
+def get_fast_path():
+    if fast_path is None:
+        return {"enabled": False}
+    return {"enabled": True, **fast_path.stats.snapshot()}
+
+
+@app.get("/response-cache")
+def get_response_cache():
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.stats()}
+
+
+@app.get("/coalescing")
+def get_coalescing():
+    if single_flight is None:
+        return {"enabled": False}
+    return {"enabled": True, **single_flight.stats()}
+
+
+@app.get("/streaming")
+def get_streaming():
+    if token_streamer is None:
+        return {"enabled": False}
+    return {"enabled": True, **token_streamer.stats()}
+
+
+@app.get("/batching")
+def get_batching():
+    if batch_runner is None:
+        return {"enabled": False}
+    return {"enabled": True, **batch_runner.stats()}
+
+
+@app.get("/scheduler")
+def get_scheduler():
+    if scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **scheduler.stats()}
+
+
+@app.get("/affinity")
+def get_affinity():
+    if affinity is None:
+        return {"enabled": False}
+    return {"enabled": True, **affinity.stats()}
+
+
+@app.get("/admission")
+def get_admission():
+    if admission is None:
+        return {"enabled": False}
+    return {"enabled": True, **admission.stats()}
+
+
+@app.get("/rate-limit")
+def get_rate_limit():
+    if rate_limiter is None:
+        return {"enabled": False}
+    return {"enabled": True, **rate_limiter.stats()}
+
+
+@app.get("/tracing")
+def get_tracing():
+    if tracer is None:
+        return {"enabled": False}
+    return {"enabled": True, **tracer.stats()}
+
+
+# Prometheus scrape target
+@app.get("/metrics")
+def get_metrics():
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
+# Import and initialization time of this worker
+@app.get("/startup")
+def get_startup():
+    return startup.timings()
+
+
+_lag_monitor = None
+
+
+if profiling:
+    cpu_sampler = StackSampler(
+        interval=float(os.environ.get("PROFILING_SAMPLE_INTERVAL_MS", "10")) / 1000,
+        max_seconds=float(os.environ.get("PROFILING_MAX_SECONDS", "60")),
+    )
+    memory_snapshots = MemorySnapshots(
+        frames=int(os.environ.get("PROFILING_TRACEMALLOC_FRAMES", "10")),
+        max_snapshots=int(os.environ.get("PROFILING_MAX_SNAPSHOTS", "3")),
+    )
+    allocation_sampler = AllocationSampler(rate=float(os.environ.get("PROFILING_ALLOCATION_SAMPLE_RATE", "0")))
+
+    def require_admin(authorization: Optional[str] = Header(None)):
+        if not authorized(authorization, profiling_token):
+            raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+    profile_routes = APIRouter(prefix="/admin/profile", dependencies=[Depends(require_admin)])
+
+    @profile_routes.get("")
+    def get_profiling():
+        return {
+            "cpu": cpu_sampler.stats(),
+            "memory": memory_snapshots.stats(),
+            "allocations": allocation_sampler.stats(),
+        }
+
+    # Collapsed stacks of every thread over `seconds`: flamegraph.pl, speedscope or inferno
+    @profile_routes.get("/cpu")
+    async def get_cpu_profile(seconds: float = 10, idle: bool = False):
+        try:
+            stacks, rounds = await asyncio.to_thread(cpu_sampler.sample, seconds, idle)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return PlainTextResponse(
+            cpu_sampler.collapsed(stacks),
+            headers={
+                "Content-Disposition": f'attachment; filename="cpu-{os.getpid()}-{int(time.time())}.collapsed"',
+                "X-Profile-Rounds": str(rounds),
+            },
+        )
+
+    # Starts tracemalloc on the first call
+    @profile_routes.post("/memory/snapshots")
+    async def take_memory_snapshot():
+        return await asyncio.to_thread(memory_snapshots.take)
+
+    @profile_routes.get("/memory/diff")
+    async def get_memory_diff(base: str, target: str, group_by: str = "lineno", limit: int = 25):
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise HTTPException(status_code=400, detail="group_by is lineno, filename or traceback")
+        try:
+            return await asyncio.to_thread(memory_snapshots.diff, base, target, group_by, limit)
+        except ValueError as e:
+            # Taken by another worker of this task
+            raise HTTPException(status_code=409, detail=str(e))
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=f"no snapshot {e.args[0]}")
+
+    # Stops tracemalloc and drops the snapshots
+    @profile_routes.delete("/memory")
+    def stop_memory_tracing():
+        memory_snapshots.stop()
+        return memory_snapshots.stats()
+
+    @profile_routes.put("/allocations")
+    def set_allocation_sample_rate(rate: float):
+        if not 0 <= rate <= 1:
+            raise HTTPException(status_code=400, detail="rate is between 0 and 1")
+        allocation_sampler.rate = rate
+        return allocation_sampler.stats()
+
+    app.include_router(profile_routes)
+
+
+@app.on_event("startup")
+async def warm_up():
+    # Runs in every worker before it accepts requests, so the first ones do not pay
+    # for connecting to Mongo
+    global _lag_monitor
+    with startup.phase("warm up"):
+        try:
+            await asyncio.to_thread(get_collection().find_one, {}, {"_id": 1})
+            await get_async_collection().find_one({}, {"_id": 1})
+        except Exception:
+            logger.warning("warm up could not reach Mongo", exc_info=True)
+    if os.environ.get("HISTORY_ENSURE_INDEXES", "true").lower() == "true":
+        with startup.phase("history indexes"):
+            try:
+                await asyncio.to_thread(ensure_indexes, HISTORY_STORE, HISTORY_TTL_SECONDS)
+            except Exception:
+                # The service works without them, only slower
+                logger.warning("could not create the history indexes", exc_info=True)
+    _lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    startup.report()
+
+
+@app.on_event("shutdown")
+def close_mongo_clients():
+    # Queued history writes need the clients, flush them first
+    history_writer.close()
+    close_clients()
+    if _lag_monitor is not None:
+        _lag_monitor.cancel()
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await close_http_clients()
+    if tracer is not None:
+        # Send what is queued before the task goes away
+        await asyncio.to_thread(tracer.exporter.close)
+
+# Innermost, so only the app's own allocations are counted
+if profiling:
+    app.add_middleware(AllocationSamplingMiddleware, sampler=allocation_sampler)
+# Picks the priority class the agent's LLM calls are scheduled in
+if scheduler is not None:
+    app.add_middleware(PriorityMiddleware, prefix="/website-bot")
+# Only requests that are admitted get a cookie and count
+if affinity is not None:
+    app.add_middleware(SessionAffinityMiddleware, affinity=affinity, prefix="/website-bot")
+# Inside CORS, so rejections still carry the CORS headers
+if admission is not None:
+    app.add_middleware(AdmissionControlMiddleware, controller=admission, prefix="/website-bot")
+# Outside admission control, so over-limit clients never hold a queue position
+if rate_limiter is not None:
+    app.add_middleware(
+        RateLimitMiddleware,
+        limiter=rate_limiter,
+        prefix="/website-bot",
+        trust_forwarded=os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "true").lower() == "true",
+    )
+
 # Set all CORS enabled origins
 app.add_middleware(
     CORSMiddleware,
@@ -0,0 +1,106 @@
+import importlib.abc
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_started = time.perf_counter()
+_ready: Optional[float] = None
+# Initialization phases in the order they ran: (name, seconds)
+_phases: List[Tuple[str, float]] = []
+# Module -> seconds spent executing it, including the modules it imported
+_imports: Dict[str, float] = {}
+
+
+@contextmanager
+def phase(name: str):
+    """Record how long the block took as one startup phase"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def _watched(name: str) -> bool:
+    # Top-level packages (langchain, langserve, openai, ...) and every module of the app
+    return "." not in name or name.startswith("app.")
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader, name: str):
+        self._loader = loader
+        self._name = name
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            _imports[self._name] = time.perf_counter() - start
+            # Leave no trace of the wrapper on the module
+            module.__loader__ = self._loader
+            if getattr(module, "__spec__", None) is not None:
+                module.__spec__.loader = self._loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Times the first import of watched modules by wrapping their loader"""
+
+    def find_spec(self, fullname, path, target=None):
+        if not _watched(fullname):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+_timer: Optional[_ImportTimer] = None
+
+
+def install_import_timer() -> None:
+    """Start timing imports; call before the heavy imports happen"""
+    global _timer
+    if _timer is None:
+        _timer = _ImportTimer()
+        sys.meta_path.insert(0, _timer)
+
+
+def uninstall_import_timer() -> None:
+    global _timer
+    if _timer is not None:
+        sys.meta_path.remove(_timer)
+        _timer = None
+
+
+def timings(top: int = 15) -> Dict[str, object]:
+    """Startup phases, the slowest imports and the time since this module was imported"""
+    slowest = sorted(_imports.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "total_ms": round(((_ready or time.perf_counter()) - _started) * 1000, 1),
+        "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in _phases},
+        "imports_ms": {name: round(seconds * 1000, 1) for name, seconds in slowest},
+    }
+
+
+def report() -> None:
+    """Log the timings once the worker is ready to serve"""
+    global _ready
+    _ready = time.perf_counter()
+    uninstall_import_timer()
+    logger.info("startup", extra=timings())
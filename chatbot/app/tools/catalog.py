@@ -0,0 +1,255 @@
+import csv
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "treatments.csv")
+
+# Abbreviations and colloquial words, expanded word by word before matching. JSON catalogs
+# can add to these with a "synonyms" object; per-treatment alternatives go in "aliases"
+SYNONYMS = {
+    "rct": "root canal treatment",
+    "rcts": "root canal treatment",
+    "ortho": "orthodontic",
+    "xray": "x ray",
+    "teeth": "tooth",
+    "cleanup": "cleaning",
+    "caps": "cap",
+}
+
+# Words that carry no meaning for matching a treatment name
+STOPWORDS = {"a", "an", "the", "of", "for", "my", "price", "cost", "charges", "charge", "fee", "fees", "rate"}
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+
+def normalize(text: str) -> str:
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+
+def _stem(token: str) -> str:
+    # Plurals are the only inflection that shows up in treatment names
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Treatment(NamedTuple):
+    name: str
+    price: str
+
+
+class CatalogMatch(NamedTuple):
+    name: str
+    price: str
+    score: float
+
+
+class _Index:
+    """Immutable lookup structures for one version of the catalog file"""
+
+    def __init__(self, treatments: List[Treatment], names: List[List[str]], synonyms: Dict[str, str]):
+        self.treatments = treatments
+        self.synonyms = synonyms
+        # One entry per name or alias; entry -> treatment position
+        self.entry_treatment: List[int] = []
+        self.entry_tokens: List[Set[str]] = []
+        self.entry_trigram_count: List[int] = []
+        self.exact: Dict[str, int] = {}
+        self.trigram_index: Dict[str, List[int]] = defaultdict(list)
+        # Every word of every name and alias
+        self.words: Set[str] = set()
+        for position, aliases in enumerate(names):
+            for alias in aliases:
+                text = self.expand(alias)
+                if not text or text in self.exact:
+                    continue
+                entry = len(self.entry_treatment)
+                self.exact[text] = entry
+                self.entry_treatment.append(position)
+                self.entry_tokens.append(set(text.split()))
+                self.words.update(text.split())
+                grams = trigrams(text)
+                self.entry_trigram_count.append(len(grams))
+                for gram in grams:
+                    self.trigram_index[gram].append(entry)
+
+    def expand(self, text: str) -> str:
+        words = []
+        for word in normalize(text).split():
+            if word not in STOPWORDS:
+                words.append(self.synonyms.get(word, word))
+        return " ".join(_stem(w) for w in " ".join(words).split())
+
+    def search(self, query: str, k: int) -> List[CatalogMatch]:
+        text = self.expand(query)
+        if not text:
+            return []
+        exact = self.exact.get(text)
+        if exact is not None:
+            treatment = self.treatments[self.entry_treatment[exact]]
+            return [CatalogMatch(treatment.name, treatment.price, 1.0)] + [
+                m for m in self._ranked(text, k + 1) if m.name != treatment.name
+            ][: k - 1]
+        return self._ranked(text, k)
+
+    def resolve(self, query: str, min_score: float, min_margin: float) -> Optional[CatalogMatch]:
+        # Words no name uses ("for my son") only add noise to the scores
+        text = " ".join(w for w in self.expand(query).split() if w in self.words)
+        if not text:
+            return None
+        exact = self.exact.get(text)
+        if exact is not None:
+            treatment = self.treatments[self.entry_treatment[exact]]
+            return CatalogMatch(treatment.name, treatment.price, 1.0)
+        ranked = self._candidates(text)[:2]
+        if not ranked:
+            return None
+        position, (complete, score) = ranked[0]
+        if score < min_score:
+            return None
+        if not complete and len(ranked) > 1 and score - ranked[1][1][1] < min_margin:
+            return None
+        return CatalogMatch(self.treatments[position].name, self.treatments[position].price, round(score, 3))
+
+    def _ranked(self, text: str, k: int) -> List[CatalogMatch]:
+        return [
+            CatalogMatch(self.treatments[position].name, self.treatments[position].price, round(score, 3))
+            for position, (_, score) in self._candidates(text)[:k]
+        ]
+
+    def _candidates(self, text: str) -> List[Tuple[int, Tuple[bool, float]]]:
+        """(treatment position, (has every query word, score)), best first"""
+        # Shared trigram counts for every candidate in one pass over the posting lists
+        grams = trigrams(text)
+        shared: Dict[int, int] = defaultdict(int)
+        for gram in grams:
+            for entry in self.trigram_index.get(gram, ()):
+                shared[entry] += 1
+        query_tokens = set(text.split())
+        best: Dict[int, Tuple[bool, float]] = {}
+        for entry, count in shared.items():
+            dice = 2 * count / (len(grams) + self.entry_trigram_count[entry])
+            entry_tokens = self.entry_tokens[entry]
+            union = len(query_tokens | entry_tokens)
+            overlap = len(query_tokens & entry_tokens) / union if union else 0.0
+            # A name with every word of the query goes first: "re root canal" is the
+            # re-treatment, however close the shorter "root canal" scores
+            key = (query_tokens <= entry_tokens, 0.6 * dice + 0.4 * overlap)
+            position = self.entry_treatment[entry]
+            if key > best.get(position, (False, 0.0)):
+                best[position] = key
+        return sorted(best.items(), key=lambda item: item[1], reverse=True)
+
+
+def _load(path: str):
+    treatments: List[Treatment] = []
+    names: List[List[str]] = []
+    synonyms = dict(SYNONYMS)
+    if path.endswith(".json"):
+        with open(path) as f:
+            data = json.load(f)
+        rows: Iterable[dict] = data["treatments"] if isinstance(data, dict) else data
+        if isinstance(data, dict):
+            synonyms.update({normalize(k): normalize(v) for k, v in data.get("synonyms", {}).items()})
+        for row in rows:
+            treatments.append(_treatment(row.get("name"), row.get("price")))
+            names.append([row["name"], *row.get("aliases", [])])
+    else:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                # A short row has None for the missing columns
+                treatments.append(_treatment(row.get("name"), row.get("price")))
+                aliases = [a for a in (row.get("aliases") or "").split("|") if a.strip()]
+                names.append([row["name"], *aliases])
+    return _Index(treatments, names, synonyms)
+
+
+def _treatment(name, price) -> Treatment:
+    name = str(name or "").strip()
+    price = str(price if price is not None else "").strip()
+    if not name or not price:
+        raise ValueError(f"treatment row without a name or a price: {name!r}, {price!r}")
+    return Treatment(name, price)
+
+
+class TreatmentCatalog:
+    """Treatment prices loaded from a CSV or JSON file into an in-memory fuzzy index
+
+    Lookups match normalized tokens and character trigrams, after expanding synonyms,
+    and return the top-k treatments with a score in [0, 1]. The file's mtime is checked
+    at most every `check_interval` seconds on lookup and the index is rebuilt and swapped
+    in when it changed, so edits are picked up by every worker without a restart.
+    """
+
+    def __init__(self, path: str, check_interval: float = 2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._next_check = time.monotonic() + check_interval
+        self._index = _load(path)
+        self._listeners: List[Callable[[], None]] = []
+
+    @classmethod
+    def from_env(cls) -> "TreatmentCatalog":
+        return cls(
+            os.environ.get("TREATMENT_CATALOG_PATH", DEFAULT_CATALOG_PATH),
+            check_interval=float(os.environ.get("TREATMENT_CATALOG_CHECK_SECONDS", "2")),
+        )
+
+    def add_reload_listener(self, listener: Callable[[], None]) -> None:
+        """Call `listener` after every reload, e.g. to drop answers quoting old prices"""
+        self._listeners.append(listener)
+
+    @property
+    def treatments(self) -> List[Treatment]:
+        return self._index.treatments
+
+    def search(self, query: str, k: int = 3) -> List[CatalogMatch]:
+        self.maybe_reload()
+        return self._index.search(query, k)
+
+    def resolve(self, query: str, min_score: float = 0.6, min_margin: float = 0.1) -> Optional[CatalogMatch]:
+        """The one treatment `query` asks about, or None if it names none or is ambiguous
+
+        Words that are in no treatment name are left out. The best match must hold every
+        remaining word, or score at least `min_score` and beat the runner-up by `min_margin`.
+        """
+        self.maybe_reload()
+        return self._index.resolve(query, min_score, min_margin)
+
+    def maybe_reload(self) -> bool:
+        if time.monotonic() < self._next_check:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_check:
+                return False
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return False
+                index = _load(self.path)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # Keep serving the last good version while the file is being rewritten
+                logger.warning("treatment catalog reload failed", extra={"path": self.path, "error": repr(e)})
+                return False
+            self._index, self._mtime = index, mtime
+            logger.info("treatment catalog reloaded", extra={"path": self.path, "treatments": len(index.treatments)})
+        for listener in self._listeners:
+            listener()
+        return True
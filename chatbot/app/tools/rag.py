@@ -1,18 +1,43 @@
 from typing import Any
 from langchain.agents import tool
 from langserve.pydantic_v1 import BaseModel, Field
+from .catalog import TreatmentCatalog
+import os
+
+# Loaded once per worker at import, reloads itself when the file changes
+catalog = TreatmentCatalog.from_env()
+
+CURRENCY = os.environ.get("TREATMENT_CATALOG_CURRENCY", "rs")
+# Below this the best match is reported as a guess rather than an answer
+MATCH_THRESHOLD = float(os.environ.get("TREATMENT_MATCH_THRESHOLD", "0.6"))
+
 
 class TreatmentInput(BaseModel):
     treatment: str = Field(description="name of the treatment")
 
+
+def format_price(price: str) -> str:
+    return f"{price} {CURRENCY}"
+
+
 @tool("get_treatment_price", args_schema=TreatmentInput)
 def get_treatment_price(
     treatment: str,
     **kwargs: Any,
 ):
     """
-    Return cost of a food
+    Return cost of a dental treatment
     """
-    print("treatment", treatment)
-    print("kwargs", kwargs)
-    return "100 rs"
\ No newline at end of file
+    matches = catalog.search(treatment, k=3)
+    if not matches or matches[0].score < MATCH_THRESHOLD / 2:
+        known = ", ".join(t.name for t in catalog.treatments)
+        return f"No treatment called '{treatment}' in the price list. Known treatments: {known}"
+    best, others = matches[0], matches[1:]
+    if best.score >= MATCH_THRESHOLD:
+        answer = f"{best.name}: {format_price(best.price)}"
+    else:
+        answer = f"No exact match for '{treatment}'. Closest is {best.name}: {format_price(best.price)}"
+    others = [m for m in others if m.score >= MATCH_THRESHOLD * 0.75]
+    if others:
+        answer += ". Other close matches: " + ", ".join(f"{m.name}: {format_price(m.price)}" for m in others)
+    return answer
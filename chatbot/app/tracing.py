@@ -0,0 +1,409 @@
+"""Sampled LangSmith tracing with a bounded background export queue
+
+TRACING_MODE picks how agent runs are traced:
+
+- off: no tracer of ours; a LANGCHAIN_TRACING_V2 set in the environment keeps working
+  as before (every run traced synchronously by LangChain's own tracer)
+- sampled: a request is traced if its session falls in TRACING_SESSION_RATE (decided by
+  hashing the session id, so a sampled conversation is traced turn after turn) or if it
+  draws under TRACING_SAMPLE_RATE; requests that fail are traced regardless
+- full: every request is traced, still through the background queue
+
+The decision is made when the request's root run starts. Unsampled requests only keep a
+small record of the root and of the runs that failed, so tracing costs them next to
+nothing. Finished traces are handed to an export thread through a bounded queue and
+sent in batches; when LangSmith is slow and the queue is full, traces are dropped and
+counted instead of holding up requests. Long strings and message lists are truncated
+before they leave the process.
+"""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.tracers.base import BaseTracer
+from langchain_core.tracers.schemas import Run
+
+from .metrics import traces_dropped, traces_exported
+
+logger = logging.getLogger(__name__)
+
+
+def truncate(value: Any, max_chars: int, max_items: int) -> Any:
+    """A JSON-friendly copy of a run's inputs or outputs with large parts cut down"""
+    if isinstance(value, str):
+        if len(value) <= max_chars:
+            return value
+        return value[:max_chars] + f"... [{len(value) - max_chars} chars truncated]"
+    if isinstance(value, BaseMessage):
+        message = {"type": value.type, "content": truncate(value.content, max_chars, max_items)}
+        tool_calls = getattr(value, "tool_calls", None)
+        if tool_calls:
+            message["tool_calls"] = truncate(tool_calls, max_chars, max_items)
+        return message
+    if isinstance(value, dict):
+        return {str(k): truncate(v, max_chars, max_items) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [truncate(item, max_chars, max_items) for item in value[-max_items:]]
+        if len(value) > max_items:
+            # The most recent messages of a history are the interesting ones
+            items.insert(0, f"[{len(value) - max_items} earlier items truncated]")
+        return items
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return truncate(repr(value), max_chars, max_items)
+
+
+class TraceExporter:
+    """Sends finished traces to LangSmith from a background thread, in batches
+
+    `submit` never blocks: when `max_queue` traces are already waiting, the new one is
+    dropped and counted.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        project_name: Optional[str] = None,
+        max_queue: int = 1000,
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        max_chars: int = 2000,
+        max_items: int = 20,
+    ):
+        self._client = client
+        self.project_name = project_name or os.environ.get("LANGCHAIN_PROJECT", "default")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_chars = max_chars
+        self.max_items = max_items
+        self._queue: "queue.Queue[Run]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            from langsmith import Client
+
+            self._client = Client()
+        return self._client
+
+    def submit(self, run: Run) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(run)
+        except queue.Full:
+            self.dropped += 1
+            traces_dropped.labels().inc()
+
+    def _start(self) -> None:
+        # Started on first use, which is in the worker process, not the preloading master
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._send([run for run in batch if run is not None])
+            for _ in batch:
+                self._queue.task_done()
+            if None in batch:
+                return
+
+    def _send(self, traces: List[Run]) -> None:
+        if not traces:
+            return
+        runs: List[Dict[str, Any]] = []
+        for trace in traces:
+            self._flatten(trace, runs)
+        try:
+            self.client.batch_ingest_runs(create=runs, pre_sampled=True)
+        except Exception:
+            self.failed += len(traces)
+            logger.warning("trace export failed", exc_info=True, extra={"traces": len(traces)})
+            return
+        self.exported += len(traces)
+        traces_exported.labels().inc(len(traces))
+
+    def _flatten(self, run: Run, out: List[Dict[str, Any]]) -> None:
+        record = run.dict(exclude={"child_runs", "inputs", "outputs", "serialized", "events"})
+        record["inputs"] = truncate(run.inputs or {}, self.max_chars, self.max_items)
+        record["outputs"] = truncate(run.outputs, self.max_chars, self.max_items) if run.outputs else None
+        record["session_name"] = self.project_name
+        out.append(record)
+        for child in run.child_runs:
+            self._flatten(child, out)
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Wait (up to `timeout`) for the queued traces to be sent"""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+class _TreeCollector(BaseTracer):
+    """Builds the run trees of the sampled traces and submits each one when it finishes"""
+
+    def __init__(self, exporter: TraceExporter):
+        super().__init__()
+        self.exporter = exporter
+
+    def _persist_run(self, run: Run) -> None:
+        self._forget(run)
+        self.exporter.submit(run)
+
+    def _forget(self, run: Run) -> None:
+        # order_map is otherwise only cleared when the tracer is garbage collected
+        self.order_map.pop(run.id, None)
+        for child in run.child_runs:
+            self._forget(child)
+
+
+class _Unsampled:
+    __slots__ = ("name", "inputs", "start_time", "errors")
+
+    def __init__(self, name: str, inputs: Any):
+        self.name = name
+        self.inputs = inputs
+        self.start_time = datetime.now(timezone.utc)
+        # (run id, run type, name, error) of the runs that failed
+        self.errors: List[tuple] = []
+
+
+class SampledTracer(BaseCallbackHandler):
+    """Head-sampled tracing: decides per request, forwards sampled traces to a full tracer"""
+
+    run_inline = True
+
+    def __init__(self, exporter: TraceExporter, sample_rate: float = 0.05, session_rate: float = 0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.session_rate = session_rate
+        self._collector = _TreeCollector(exporter)
+        # Every open run -> the root run of its request
+        self._root_of: Dict[UUID, UUID] = {}
+        self._sampled: Set[UUID] = set()
+        self._unsampled: Dict[UUID, _Unsampled] = {}
+        self.sampled = 0
+        self.unsampled = 0
+        self.error_traces = 0
+
+    @classmethod
+    def from_env(cls, mode: str) -> "SampledTracer":
+        exporter = TraceExporter(
+            max_queue=int(os.environ.get("TRACING_QUEUE_SIZE", "1000")),
+            batch_size=int(os.environ.get("TRACING_BATCH_SIZE", "50")),
+            flush_interval=float(os.environ.get("TRACING_FLUSH_INTERVAL_SECONDS", "1")),
+            max_chars=int(os.environ.get("TRACING_MAX_FIELD_CHARS", "2000")),
+            max_items=int(os.environ.get("TRACING_MAX_LIST_ITEMS", "20")),
+        )
+        if mode == "full":
+            return cls(exporter, sample_rate=1.0)
+        return cls(
+            exporter,
+            sample_rate=float(os.environ.get("TRACING_SAMPLE_RATE", "0.05")),
+            session_rate=float(os.environ.get("TRACING_SESSION_RATE", "0")),
+        )
+
+    def _decide(self, metadata: Optional[Dict[str, Any]]) -> bool:
+        if self.sample_rate >= 1.0:
+            return True
+        session_id = (metadata or {}).get("session_id")
+        if session_id is not None and self.session_rate > 0:
+            if zlib.crc32(str(session_id).encode()) % 10_000 < self.session_rate * 10_000:
+                return True
+        return random.random() < self.sample_rate
+
+    def _track(self, run_id: UUID, parent_run_id: Optional[UUID]) -> bool:
+        """Remember the run's root; True if its request is sampled"""
+        root = self._root_of.get(parent_run_id, parent_run_id) if parent_run_id else run_id
+        self._root_of[run_id] = root
+        return root in self._sampled
+
+    def _end(self, run_id: UUID) -> bool:
+        root = self._root_of.pop(run_id, None)
+        return root is not None and root in self._sampled
+
+    def _failed(self, run_id: UUID, run_type: str, error: BaseException) -> bool:
+        root = self._root_of.get(run_id)
+        if root in self._sampled:
+            self._root_of.pop(run_id, None)
+            return True
+        record = self._unsampled.get(root)
+        if record is not None:
+            record.errors.append((run_id, run_type, repr(error)))
+        self._root_of.pop(run_id, None)
+        return False
+
+    # Chains; the root chain of a request is where the sampling decision is made
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                       metadata=None, **kwargs):
+        if parent_run_id is None or parent_run_id not in self._root_of:
+            self._root_of[run_id] = run_id
+            if self._decide(metadata):
+                self.sampled += 1
+                self._sampled.add(run_id)
+                self._collector.on_chain_start(serialized, inputs, run_id=run_id, metadata=metadata, **kwargs)
+            else:
+                self.unsampled += 1
+                self._unsampled[run_id] = _Unsampled(kwargs.get("name") or "agent", inputs)
+            return
+        if self._track(run_id, parent_run_id):
+            self._collector.on_chain_start(
+                serialized, inputs, run_id=run_id, parent_run_id=parent_run_id, metadata=metadata, **kwargs
+            )
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs):
+        if self._end(run_id):
+            self._collector.on_chain_end(outputs, run_id=run_id, **kwargs)
+        self._finish(run_id, None)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs):
+        if self._failed(run_id, "chain", error):
+            self._collector.on_chain_error(error, run_id=run_id, **kwargs)
+        self._finish(run_id, error)
+
+    def _finish(self, run_id: UUID, error: Optional[BaseException]) -> None:
+        if run_id in self._sampled:
+            self._sampled.discard(run_id)
+            return
+        record = self._unsampled.pop(run_id, None)
+        if record is None:
+            return
+        if error is not None or record.errors:
+            self.error_traces += 1
+            self.exporter.submit(self._error_trace(run_id, record, error))
+
+    def _error_trace(self, run_id: UUID, record: _Unsampled, error: Optional[BaseException]) -> Run:
+        """The root run and the runs that failed, for a request that was not sampled"""
+        now = datetime.now(timezone.utc)
+        dotted = record.start_time.strftime("%Y%m%dT%H%M%S%fZ") + str(run_id)
+        root = Run(
+            id=run_id, name=record.name, run_type="chain", inputs=record.inputs if isinstance(record.inputs, dict) else {"input": record.inputs},
+            start_time=record.start_time, end_time=now, error=repr(error) if error is not None else None,
+            trace_id=run_id, dotted_order=dotted, extra={"metadata": {"sampled": False}}, serialized={},
+        )
+        for child_id, run_type, message in record.errors:
+            if child_id == run_id:
+                continue
+            root.child_runs.append(Run(
+                id=child_id, name=f"{run_type} error", run_type=run_type, inputs={}, start_time=now, end_time=now,
+                error=message, parent_run_id=run_id, trace_id=run_id,
+                dotted_order=dotted + "." + now.strftime("%Y%m%dT%H%M%S%fZ") + str(child_id), serialized={},
+            ))
+        return root
+
+    # Everything else is only forwarded for sampled requests
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        if self._track(run_id, parent_run_id):
+            self._collector.on_chat_model_start(serialized, messages, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        if self._track(run_id, parent_run_id):
+            self._collector.on_llm_start(serialized, prompts, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_llm_new_token(self, token, *, run_id: UUID, **kwargs):
+        if self._root_of.get(run_id) in self._sampled:
+            self._collector.on_llm_new_token(token, run_id=run_id, **kwargs)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        if self._end(run_id):
+            self._collector.on_llm_end(response, run_id=run_id, **kwargs)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        if self._failed(run_id, "llm", error):
+            self._collector.on_llm_error(error, run_id=run_id, **kwargs)
+
+    def on_tool_start(self, serialized, input_str, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        if self._track(run_id, parent_run_id):
+            self._collector.on_tool_start(serialized, input_str, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs):
+        if self._end(run_id):
+            self._collector.on_tool_end(output, run_id=run_id, **kwargs)
+
+    def on_tool_error(self, error, *, run_id: UUID, **kwargs):
+        if self._failed(run_id, "tool", error):
+            self._collector.on_tool_error(error, run_id=run_id, **kwargs)
+
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        if self._track(run_id, parent_run_id):
+            self._collector.on_retriever_start(serialized, query, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs):
+        if self._end(run_id):
+            self._collector.on_retriever_end(documents, run_id=run_id, **kwargs)
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs):
+        if self._failed(run_id, "retriever", error):
+            self._collector.on_retriever_error(error, run_id=run_id, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "session_rate": self.session_rate,
+            "sampled": self.sampled,
+            "unsampled": self.unsampled,
+            "error_traces": self.error_traces,
+            "open_runs": len(self._root_of),
+            "exporter": self.exporter.stats(),
+        }
+
+
+def configure_tracing() -> Optional[SampledTracer]:
+    """The tracer to attach to agent requests for TRACING_MODE, or None
+
+    With a mode other than off, LangChain's global tracer is switched off so runs are
+    not traced twice.
+    """
+    mode = os.environ.get("TRACING_MODE", "off").lower()
+    if mode == "off":
+        return None
+    if mode not in ("sampled", "full"):
+        raise ValueError(f"TRACING_MODE must be off, sampled or full, not {mode!r}")
+    for name in ("LANGCHAIN_TRACING_V2", "LANGSMITH_TRACING", "LANGSMITH_TRACING_V2"):
+        os.environ.pop(name, None)
+    return SampledTracer.from_env(mode)
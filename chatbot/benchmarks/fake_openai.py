@@ -0,0 +1,153 @@
+"""OpenAI-compatible /v1/chat/completions that answers like the website bot's model would
+
+When the request offers tools and the conversation ends with the user, it calls
+get_treatment_price once per treatment in the question ("cleaning and braces" makes
+two calls); after the tool results it streams an answer built from them. Latency is
+`first_token_ms` before the first chunk and `token_ms` between tokens, so runs are
+comparable without a network or an API key. With `max_concurrency`, at most that many
+completions run at a time and the rest wait their turn, like calls against a saturated
+OpenAI quota.
+
+    python -m benchmarks.fake_openai --port 8090 --first-token-ms 300 --token-ms 20
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+_PREFIX = re.compile(r"^(?:hi|hello|hey)?[\s,]*(?:what is |whats |how much (?:is|are|does|do) |tell me )?(?:the )?(?:price|cost) (?:of|for) ")
+_SPLIT = re.compile(r"\s*(?:,|\band\b|&)\s*")
+
+
+def treatments_in(question: str) -> List[str]:
+    text = " ".join(re.sub(r"[?!.]", " ", question.lower()).split())
+    text = _PREFIX.sub("", text)
+    text = re.sub(r"\s+(?:cost|price|charges?)$", "", text)
+    return [t for t in _SPLIT.split(text) if t] or [text]
+
+
+def _tokens(text: str) -> List[str]:
+    words = text.split(" ")
+    return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+def create_app(first_token_ms: float = 300, token_ms: float = 20, max_concurrency: Optional[int] = None) -> FastAPI:
+    app = FastAPI()
+    slots = asyncio.Semaphore(max_concurrency) if max_concurrency else contextlib.nullcontext()
+
+    def plan(body: Dict[str, Any]):
+        messages = body["messages"]
+        last = messages[-1]
+        if body.get("tools") and last["role"] == "user":
+            calls = [
+                {
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": "get_treatment_price", "arguments": json.dumps({"treatment": t})},
+                }
+                for t in treatments_in(last["content"] if isinstance(last["content"], str) else "")
+            ]
+            return None, calls
+        results = [m["content"] for m in messages if m["role"] == "tool"]
+        if results:
+            return "Here are the prices: " + "; ".join(results) + ".", None
+        return "Thank you for asking, please tell me which treatment you would like to know the price of.", None
+
+    def usage(body: Dict[str, Any], completion: int) -> Dict[str, int]:
+        prompt = sum(len(str(m.get("content") or "")) for m in body["messages"]) // 4
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        content, calls = plan(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "gpt-3.5-turbo")
+        tokens = _tokens(content) if content else [c["function"]["arguments"] for c in calls]
+
+        if not body.get("stream"):
+            async with slots:
+                await asyncio.sleep((first_token_ms + token_ms * (len(tokens) - 1)) / 1000)
+            message: Dict[str, Any] = {"role": "assistant", "content": content}
+            if calls:
+                message["tool_calls"] = calls
+            return JSONResponse(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if calls else "stop"}],
+                    "usage": usage(body, len(tokens)),
+                }
+            )
+
+        def chunk(delta: Dict[str, Any], finish_reason=None) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def events():
+            async with slots:
+                async for event in completion():
+                    yield event
+
+        async def completion():
+            await asyncio.sleep(first_token_ms / 1000)
+            yield chunk({"role": "assistant", "content": "" if content else None})
+            if calls:
+                for index, call in enumerate(calls):
+                    if index:
+                        await asyncio.sleep(token_ms / 1000)
+                    yield chunk({"tool_calls": [{"index": index, **call}]})
+            else:
+                for index, token in enumerate(tokens):
+                    if index:
+                        await asyncio.sleep(token_ms / 1000)
+                    yield chunk({"content": token})
+            yield chunk({}, "tool_calls" if calls else "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage(body, len(tokens)),
+                }
+                yield f"data: {json.dumps(data)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--max-concurrency", type=int, help="completions served at a time, the rest wait")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    uvicorn.run(create_app(args.first_token_ms, args.token_ms, args.max_concurrency), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""History load and append latency, and stored size, against session length
+
+Fills sessions of each length with question/answer turns in every store (one document
+per message, buckets, zlib-compressed buckets), then times loading the whole session
+and appending one more turn, and adds up the BSON size of what is stored.
+
+    python -m benchmarks.history_storage --lengths 10,50,200,1000
+    # against a real server (uses MONGO_DATABASE and scratch collections in it)
+    MONGO_CONNECTION_STRING=mongodb://... python -m benchmarks.history_storage --mongo
+
+Without --mongo the in-process stand-in is used with `--latency-ms` per round trip, so
+the numbers show round trips and decoding, not the server's per-document cost.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import uuid
+
+import bson
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.history.buckets import BucketedMongoDBChatMessageHistory
+from app.history.indexes import ensure_indexes
+from app.history.mongo import PooledMongoDBChatMessageHistory, get_collection
+
+QUESTION = "How much does a root canal cost, and is a crown included in that price?"
+ANSWER = (
+    "A root canal treatment costs between 5,000 and 8,000 rupees depending on the tooth. "
+    "The crown is not included: a metal crown is 3,000 rupees, a ceramic crown 7,000 and a zirconia "
+    "crown 12,000. Most patients need two visits, and we recommend the crown within a month. "
+) * 3
+
+
+def turn():
+    return [HumanMessage(QUESTION), AIMessage(ANSWER)]
+
+
+def stores(prefix: str, bucket_size: int, compress_min_bytes: int):
+    return {
+        "documents": (prefix, lambda s: PooledMongoDBChatMessageHistory(s, collection_name=prefix)),
+        "buckets": (f"{prefix}_buckets", lambda s: BucketedMongoDBChatMessageHistory(
+            s, bucket_size=bucket_size, collection_name=f"{prefix}_buckets")),
+        "buckets_compressed": (f"{prefix}_zbuckets", lambda s: BucketedMongoDBChatMessageHistory(
+            s, bucket_size=bucket_size, compress_min_bytes=compress_min_bytes, collection_name=f"{prefix}_zbuckets")),
+    }
+
+
+def _ms(samples):
+    return round(statistics.median(samples) * 1000, 3)
+
+
+def measure(make, collection_name: str, length: int, repeats: int):
+    session_id = str(uuid.uuid4())
+    history = make(session_id)
+    for _ in range(length // 2):
+        history.add_messages(turn())
+    collection = get_collection(collection_name)
+    documents = [*collection.find({"SessionId": session_id}), *collection.find({"s": session_id})]
+    size = sum(len(bson.encode(document)) for document in documents)
+
+    load, append = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        loaded = make(session_id).messages
+        load.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        make(session_id).add_messages(turn())
+        append.append(time.perf_counter() - start)
+    assert len(loaded) >= length - length % 2
+    return {"documents": len(documents), "bytes": size, "load_ms": _ms(load), "append_ms": _ms(append)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", default="10,50,200,1000")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--bucket-size", type=int, default=50)
+    parser.add_argument("--compress-min-bytes", type=int, default=512)
+    parser.add_argument("--mongo", action="store_true", help="use MONGO_CONNECTION_STRING instead of the stand-in")
+    parser.add_argument("--latency-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    prefix = f"history_bench_{uuid.uuid4().hex[:8]}"
+    os.environ.setdefault("MONGO_DATABASE", "benchmarks")
+    os.environ["MONGO_COLLECTION"] = prefix
+    os.environ["MONGO_BUCKET_COLLECTION"] = f"{prefix}_buckets"
+    if not args.mongo:
+        from benchmarks.memory_mongo import install
+
+        install(args.latency_ms / 1000)
+    ensure_indexes("buckets")
+    get_collection(f"{prefix}_zbuckets").create_index([("s", 1), ("_id", 1)])
+
+    try:
+        for length in (int(n) for n in args.lengths.split(",")):
+            for store, (collection_name, make) in stores(prefix, args.bucket_size, args.compress_min_bytes).items():
+                result = measure(make, collection_name, length, args.repeats)
+                print(json.dumps({"store": store, "messages": length, **result}))
+    finally:
+        if args.mongo:
+            database = get_collection().database
+            for name in (prefix, f"{prefix}_buckets", f"{prefix}_zbuckets", f"{prefix}_summaries"):
+                database.drop_collection(name)
+
+
+if __name__ == "__main__":
+    main()
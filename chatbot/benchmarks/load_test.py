@@ -0,0 +1,245 @@
+"""Load test of /website-bot against a fake OpenAI server and in-memory Mongo
+
+Starts `benchmarks.fake_openai` and `benchmarks.serve` as subprocesses, drives
+/website-bot/invoke, /batch and /stream at each concurrency level and reports latency
+percentiles, time to the first streamed chunk and to the first answer text, and requests
+per second. Results are written
+as a JSON baseline; pass an earlier one with --compare to see the change.
+
+    python -m benchmarks.load_test --concurrency 1,8,32 --requests 200 \\
+        --output benchmarks/results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.load_test --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+QUESTIONS = [
+    "How much is teeth cleaning?",
+    "What is the price of root canal treatment?",
+    "price of braces and teeth whitening",
+    "How much does a dental implant cost?",
+    "cost of tooth extraction, scaling and polishing",
+    "what are the charges for a crown?",
+]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return round(ordered[index] * 1000, 2)
+
+
+def _payload(question: str) -> Dict[str, Any]:
+    return {"input": {"input": question}, "config": {"configurable": {"session_id": f"bench-{uuid.uuid4().hex}"}}}
+
+
+async def _invoke(client: httpx.AsyncClient, question: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    response = await client.post("/website-bot/invoke", json=_payload(question))
+    response.raise_for_status()
+    return {"latency": time.perf_counter() - start}
+
+
+async def _batch(client: httpx.AsyncClient, question: str, size: int) -> Dict[str, float]:
+    payloads = [_payload(random.choice(QUESTIONS)) for _ in range(size - 1)] + [_payload(question)]
+    start = time.perf_counter()
+    response = await client.post(
+        "/website-bot/batch",
+        json={"inputs": [p["input"] for p in payloads], "config": [p["config"] for p in payloads]},
+    )
+    response.raise_for_status()
+    return {"latency": time.perf_counter() - start}
+
+
+async def _stream(client: httpx.AsyncClient, question: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    first = first_output = None
+    async with client.stream("POST", "/website-bot/stream", json=_payload(question)) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:") and event == "data":
+                if first is None:
+                    first = time.perf_counter() - start
+                # Actions and steps come first; the answer is in the chunks with "output"
+                if first_output is None and '"output"' in line:
+                    first_output = time.perf_counter() - start
+            elif event == "error":
+                raise RuntimeError(line)
+    result = {"latency": time.perf_counter() - start}
+    if first is not None:
+        result["first_chunk"] = first
+    if first_output is not None:
+        result["first_output"] = first_output
+    return result
+
+
+async def run_level(base_url: str, mode: str, concurrency: int, requests: int, batch_size: int) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        queue: asyncio.Queue = asyncio.Queue()
+        for i in range(requests):
+            queue.put_nowait(QUESTIONS[i % len(QUESTIONS)])
+        samples: List[Dict[str, float]] = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                question = queue.get_nowait()
+                try:
+                    if mode == "invoke":
+                        samples.append(await _invoke(client, question))
+                    elif mode == "batch":
+                        samples.append(await _batch(client, question, batch_size))
+                    else:
+                        samples.append(await _stream(client, question))
+                except Exception as e:
+                    errors += 1
+                    if errors <= 3:
+                        print(f"  {mode} request failed: {e!r}", file=sys.stderr)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [s["latency"] for s in samples]
+    first_chunks = [s["first_chunk"] for s in samples if "first_chunk" in s]
+    first_outputs = [s["first_output"] for s in samples if "first_output" in s]
+    items = len(samples) * (batch_size if mode == "batch" else 1)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": errors,
+        "rps": round(len(samples) / elapsed, 2),
+        "items_per_second": round(items / elapsed, 2),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "first_chunk_p50_ms": percentile(first_chunks, 50),
+        "first_chunk_p95_ms": percentile(first_chunks, 95),
+        "first_output_p50_ms": percentile(first_outputs, 50),
+        "first_output_p95_ms": percentile(first_outputs, 95),
+    }
+
+
+def _wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    before = {(r["mode"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"vs baseline {baseline.get('commit')} ({baseline.get('timestamp')})")
+    for result in current["results"]:
+        old = before.get((result["mode"], result["concurrency"]))
+        if old is None:
+            continue
+        parts = []
+        for key in ("rps", "p50_ms", "p95_ms", "p99_ms", "first_chunk_p50_ms", "first_output_p50_ms"):
+            if old.get(key) and result.get(key) is not None:
+                parts.append(f"{key} {old[key]} -> {result[key]} ({(result[key] - old[key]) / old[key]:+.1%})")
+        print(f"  {result['mode']:>6} c={result['concurrency']:<3} " + ", ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="invoke,batch,stream")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated levels")
+    parser.add_argument("--requests", type=int, default=100, help="per mode and level")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--mongo-latency-ms", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8180)
+    parser.add_argument("--openai-port", type=int, default=8190)
+    parser.add_argument("--url", help="load an already running server instead of starting one")
+    parser.add_argument("--output", help="write the results here as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    args = parser.parse_args()
+
+    processes: List[subprocess.Popen] = []
+    base_url = args.url
+    try:
+        if base_url is None:
+            openai = subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.fake_openai", "--port", str(args.openai_port),
+                 "--first-token-ms", str(args.first_token_ms), "--token-ms", str(args.token_ms)]
+            )
+            processes.append(openai)
+            openai_url = f"http://127.0.0.1:{args.openai_port}/v1"
+            # The port answers 404 on / once it is listening
+            _wait_until_up(openai_url, openai)
+            env = {**os.environ, "OPENAI_BASE_URL": openai_url, "OPENAI_API_BASE": openai_url, "OPENAI_API_KEY": "sk-bench"}
+            # Every request should reach the agent unless asked otherwise
+            env.setdefault("PRICE_FAST_PATH", "false")
+            # Every client is 127.0.0.1, so the per-IP limit would throttle the whole test
+            env.setdefault("RATE_LIMIT", "false")
+            server = subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.serve", "--port", str(args.port),
+                 "--mongo-latency-ms", str(args.mongo_latency_ms)],
+                env=env,
+            )
+            processes.append(server)
+            base_url = f"http://127.0.0.1:{args.port}"
+            _wait_until_up(base_url + "/", server)
+
+        results = []
+        for mode in args.modes.split(","):
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                result = asyncio.run(run_level(base_url, mode, concurrency, args.requests, args.batch_size))
+                print(json.dumps(result))
+                results.append(result)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "url")},
+        "results": results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
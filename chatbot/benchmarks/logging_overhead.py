@@ -0,0 +1,138 @@
+"""Per-request cost of logging on the agent's tool path
+
+Runs the agent executor with a scripted plan (two get_treatment_price calls, then an
+answer) so no model is called, once per logging setup, each in its own process with
+stdout going into a pipe like the container's log driver:
+
+    before   verbose=True executor and prints of every tool input and observation
+    info     structured logging at the default INFO level
+    debug    structured logging at DEBUG, every request logged
+    sampled  structured logging at DEBUG, 5% of requests logged
+
+    python -m benchmarks.logging_overhead --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+MODES = {
+    "before": {},
+    "info": {"LOG_LEVEL": "INFO"},
+    "debug": {"LOG_LEVEL": "DEBUG", "LOG_SAMPLE_RATE": "1.0"},
+    "sampled": {"LOG_LEVEL": "DEBUG", "LOG_SAMPLE_RATE": "0.05"},
+}
+
+
+def _executor(verbose: bool):
+    from langchain.agents import AgentExecutor
+    from langchain.agents.output_parsers.tools import ToolAgentAction
+    from langchain_core.agents import AgentFinish
+    from langchain_core.runnables import RunnableLambda
+
+    from app.tools.rag import get_treatment_price
+
+    def plan(inputs):
+        if inputs["intermediate_steps"]:
+            return AgentFinish({"output": "; ".join(s[1] for s in inputs["intermediate_steps"])}, "")
+        return [
+            ToolAgentAction(tool="get_treatment_price", tool_input={"treatment": t}, log="", message_log=[], tool_call_id=t)
+            for t in ("cleaning", "braces")
+        ]
+
+    return AgentExecutor(agent=RunnableLambda(plan), tools=[get_treatment_price], verbose=verbose)
+
+
+def _printing_handler():
+    # What the removed print() calls wrote for every tool call
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class PrintingHandler(BaseCallbackHandler):
+        def on_tool_start(self, serialized, input_str, *, metadata=None, **kwargs):
+            print((metadata or {}).get("session_id"))
+            print("inside aperform agent action", input_str)
+            print("tool_input", input_str)
+
+        def on_tool_end(self, output, **kwargs):
+            print("observation", output)
+
+    return PrintingHandler()
+
+
+async def _run(mode: str, requests: int, concurrency: int) -> dict:
+    from app import monkey_patch  # noqa: F401
+    from app.log import bind_session, configure_logging, shutdown_logging
+
+    before = mode == "before"
+    if not before:
+        configure_logging()
+    executor = _executor(verbose=before)
+    callbacks = [_printing_handler()] if before else []
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            session_id = f"bench-{i}"
+            start = time.perf_counter()
+            bind_session(session_id)
+            await executor.ainvoke(
+                {"input": "price of cleaning and braces"},
+                {"metadata": {"session_id": session_id}, "callbacks": callbacks},
+            )
+            latencies.append(time.perf_counter() - start)
+
+    await one(-1)
+    latencies.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(one(i)) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    shutdown_logging()
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mode", choices=MODES, help="run one mode in this process")
+    args = parser.parse_args()
+
+    if args.mode:
+        result = asyncio.run(_run(args.mode, args.requests, args.concurrency))
+        sys.stderr.write(json.dumps(result) + "\n")
+        return
+
+    results = []
+    for mode, env in MODES.items():
+        child = subprocess.run(
+            [sys.executable, "-m", "benchmarks.logging_overhead", "--mode", mode,
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+            env={**os.environ, **env},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        result = json.loads(child.stderr.decode().strip().splitlines()[-1])
+        result["stdout_bytes"] = len(child.stdout)
+        results.append(result)
+        print(json.dumps(result))
+    # Throughput is bound by the one event loop, so 1000 / rps is the loop time per request
+    base = 1000 / results[0]["rps"]
+    for result in results[1:]:
+        cost = 1000 / result["rps"]
+        print(f"{result['mode']}: {cost:.2f} ms of loop time per request, {base - cost:+.2f} ms vs before")
+
+
+if __name__ == "__main__":
+    main()
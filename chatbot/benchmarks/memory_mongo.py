@@ -0,0 +1,256 @@
+"""In-process stand-in for the Mongo clients used by app.history
+
+Implements only what the history classes call (find/sort/skip/limit, find_one,
+distinct, insert_many, update_one/update_many with $set, $inc and $push, bulk_write of
+those and of ReplaceOne, delete_many, create_index) on plain dicts, for both
+the pymongo and the motor API. An optional per-operation latency stands in for the
+network round trip. `install()` swaps it in for the shared clients in app.history.mongo.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import InsertOne, ReplaceOne, UpdateMany
+
+_OPERATORS = {
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$in": lambda value, arg: value in arg,
+    "$ne": lambda value, arg: value != arg,
+}
+
+
+def _matches(document: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if not all(_OPERATORS[op](value, arg) for op, arg in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(document: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return dict(document)
+    keep = {k for k, v in projection.items() if v}
+    return {k: v for k, v in document.items() if k in keep or k == "_id"}
+
+
+def _apply(document: Dict[str, Any], update: Dict[str, Any]) -> None:
+    document.update(update.get("$set", {}))
+    for key, amount in update.get("$inc", {}).items():
+        document[key] = document.get(key, 0) + amount
+    for key, value in update.get("$push", {}).items():
+        values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        document.setdefault(key, []).extend(values)
+
+
+class MemoryCursor:
+    def __init__(self, documents: List[Dict[str, Any]], latency: float):
+        self._documents = documents
+        self._latency = latency
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key: str, direction: int = 1) -> "MemoryCursor":
+        self._documents.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        return self
+
+    def skip(self, count: int) -> "MemoryCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self._limit = count
+        return self
+
+    def _results(self) -> List[Dict[str, Any]]:
+        documents = self._documents[self._skip:]
+        return documents[: self._limit] if self._limit else documents
+
+    def __iter__(self):
+        if self._latency:
+            time.sleep(self._latency)
+        return iter(self._results())
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        documents = self._results()
+        return documents[:length] if length else documents
+
+
+class MemoryCollection:
+    """Documents of one collection; shared by the sync and async views"""
+
+    def __init__(self, latency: float = 0.0):
+        self.documents: List[Dict[str, Any]] = []
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def _find(self, query: Dict[str, Any], projection=None) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [_project(d, projection) for d in self.documents if _matches(d, query)]
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection=None) -> MemoryCursor:
+        return MemoryCursor(self._find(query or {}, projection), self.latency)
+
+    # Operations; __getattr__ serves them under their pymongo names after the simulated round trip
+    def _find_one(self, query: Optional[Dict[str, Any]] = None, projection=None):
+        found = self._find(query or {}, projection)
+        return found[0] if found else None
+
+    def _distinct(self, key: str, query: Optional[Dict[str, Any]] = None) -> List[Any]:
+        return list(dict.fromkeys(d[key] for d in self._find(query or {}) if key in d))
+
+    def _insert_many(self, documents, ordered: bool = True) -> None:
+        with self.lock:
+            for document in documents:
+                document.setdefault("_id", ObjectId())
+                self.documents.append(dict(document))
+
+    def _insert_one(self, document: Dict[str, Any]) -> None:
+        self._insert_many([document])
+
+    def _update_one(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> None:
+        with self.lock:
+            self._update(query, update, upsert, many=False)
+
+    def _update_many(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> None:
+        with self.lock:
+            self._update(query, update, upsert, many=True)
+
+    def _update(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool, many: bool) -> None:
+        matched = False
+        for document in self.documents:
+            if _matches(document, query):
+                _apply(document, update)
+                matched = True
+                if not many:
+                    return
+        if upsert and not matched:
+            document = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            document.update(update.get("$setOnInsert", {}))
+            _apply(document, update)
+            document.setdefault("_id", ObjectId())
+            self.documents.append(document)
+
+    def _replace(self, query: Dict[str, Any], replacement: Dict[str, Any], upsert: bool) -> None:
+        for i, document in enumerate(self.documents):
+            if _matches(document, query):
+                self.documents[i] = {"_id": document["_id"], **replacement}
+                return
+        if upsert:
+            document = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            document.update(replacement)
+            document.setdefault("_id", ObjectId())
+            self.documents.append(document)
+
+    def _bulk_write(self, requests, ordered: bool = True) -> None:
+        # pymongo's UpdateOne/UpdateMany/InsertOne/ReplaceOne, one simulated round trip for all of them
+        with self.lock:
+            for request in requests:
+                if isinstance(request, InsertOne):
+                    document = dict(request._doc)
+                    document.setdefault("_id", ObjectId())
+                    self.documents.append(document)
+                elif isinstance(request, ReplaceOne):
+                    self._replace(request._filter, request._doc, request._upsert)
+                else:
+                    self._update(request._filter, request._doc, request._upsert, many=isinstance(request, UpdateMany))
+
+    def _delete_one(self, query: Dict[str, Any]) -> None:
+        with self.lock:
+            for i, document in enumerate(self.documents):
+                if _matches(document, query):
+                    del self.documents[i]
+                    return
+
+    def _delete_many(self, query: Dict[str, Any]) -> None:
+        with self.lock:
+            self.documents = [d for d in self.documents if not _matches(d, query)]
+
+    def _create_index(self, *args, **kwargs) -> str:
+        return "memory"
+
+    def _create_indexes(self, *args, **kwargs) -> List[str]:
+        return ["memory"]
+
+    def __getattr__(self, name: str):
+        operation = getattr(type(self), "_" + name, None)
+        if operation is None:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            if self.latency:
+                time.sleep(self.latency)
+            return operation(self, *args, **kwargs)
+
+        return call
+
+
+class AsyncMemoryCollection:
+    """motor-style view of a MemoryCollection"""
+
+    def __init__(self, collection: MemoryCollection):
+        self._collection = collection
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection=None) -> MemoryCursor:
+        return self._collection.find(query, projection)
+
+    def __getattr__(self, name: str):
+        operation = getattr(MemoryCollection, "_" + name, None)
+        if operation is None:
+            raise AttributeError(name)
+        collection = self._collection
+
+        async def call(*args, **kwargs):
+            if collection.latency:
+                await asyncio.sleep(collection.latency)
+            return operation(collection, *args, **kwargs)
+
+        return call
+
+
+class _Database:
+    def __init__(self, client: "MemoryMongoClient", name: str):
+        self._client = client
+        self._name = name
+
+    def __getitem__(self, collection_name: str):
+        return self._client._collection(self._name, collection_name)
+
+
+class MemoryMongoClient:
+    def __init__(self, latency: float = 0.0, asynchronous: bool = False, store=None):
+        self.latency = latency
+        self.asynchronous = asynchronous
+        self.store: Dict[tuple, MemoryCollection] = {} if store is None else store
+
+    def _collection(self, database: str, name: str):
+        collection = self.store.get((database, name))
+        if collection is None:
+            collection = self.store.setdefault((database, name), MemoryCollection(self.latency))
+        return AsyncMemoryCollection(collection) if self.asynchronous else collection
+
+    def __getitem__(self, database: str) -> _Database:
+        return _Database(self, database)
+
+    def close(self) -> None:
+        pass
+
+
+def install(latency: float = 0.0) -> MemoryMongoClient:
+    """Point app.history.mongo's shared clients at one in-memory store"""
+    from app.history import mongo
+
+    client = MemoryMongoClient(latency)
+    mongo._client = client
+    mongo._async_client = MemoryMongoClient(latency, asynchronous=True, store=client.store)
+    return client
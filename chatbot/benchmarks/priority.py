@@ -0,0 +1,130 @@
+"""Interactive /stream latency while /batch jobs compete for the same OpenAI quota
+
+Starts `benchmarks.fake_openai` with at most `--quota` completions at a time (the rest
+wait there, as on a saturated account) and `benchmarks.serve`. For each setting of
+PRIORITY_SCHEDULING, it measures /stream chats on their own, then the same chats
+while `--batch-clients` clients keep sending /batch requests, and reports the chats'
+latency percentiles, time to the first answer text, and the batch items finished per
+second.
+
+    python -m benchmarks.priority --quota 8 --interactive 4 --batch-clients 2 --batch-size 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from benchmarks.load_test import QUESTIONS, _batch, _stream, _wait_until_up, percentile
+
+
+async def _interactive(client: httpx.AsyncClient, concurrency: int, requests: int) -> List[Dict[str, float]]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(QUESTIONS[i % len(QUESTIONS)])
+    samples: List[Dict[str, float]] = []
+
+    async def worker():
+        while not queue.empty():
+            samples.append(await _stream(client, queue.get_nowait()))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+async def run(base_url: str, args: argparse.Namespace, with_batch: bool) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.interactive + args.batch_clients)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        done = asyncio.Event()
+        items = 0
+
+        async def batch_client(index: int):
+            nonlocal items
+            while not done.is_set():
+                await _batch(client, QUESTIONS[index % len(QUESTIONS)], args.batch_size)
+                items += args.batch_size
+
+        batches = [asyncio.create_task(batch_client(i)) for i in range(args.batch_clients if with_batch else 0)]
+        if batches:
+            # Let the batches fill the quota first
+            await asyncio.sleep(args.warm_up)
+        start = time.perf_counter()
+        samples = await _interactive(client, args.interactive, args.requests)
+        elapsed = time.perf_counter() - start
+        done.set()
+        # The batches in flight finish on their own, their items are not counted
+        counted = items
+        await asyncio.gather(*batches)
+
+    latencies = [s["latency"] for s in samples]
+    first_outputs = [s["first_output"] for s in samples if "first_output" in s]
+    return {
+        "batch": with_batch,
+        "chats": len(samples),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "first_output_p50_ms": percentile(first_outputs, 50),
+        "first_output_p95_ms": percentile(first_outputs, 95),
+        "batch_items_per_second": round(counted / elapsed, 2) if with_batch else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scheduling", default="false,true", help="PRIORITY_SCHEDULING values to compare")
+    parser.add_argument("--quota", type=int, default=8, help="completions the fake OpenAI serves at a time")
+    parser.add_argument("--interactive", type=int, default=4, help="concurrent /stream clients")
+    parser.add_argument("--requests", type=int, default=40, help="/stream requests per run")
+    parser.add_argument("--batch-clients", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--warm-up", type=float, default=2.0, help="seconds the batches run before the chats")
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8180)
+    parser.add_argument("--openai-port", type=int, default=8190)
+    args = parser.parse_args()
+
+    openai = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_openai", "--port", str(args.openai_port),
+         "--first-token-ms", str(args.first_token_ms), "--token-ms", str(args.token_ms),
+         "--max-concurrency", str(args.quota)]
+    )
+    try:
+        openai_url = f"http://127.0.0.1:{args.openai_port}/v1"
+        _wait_until_up(openai_url, openai)
+        for scheduling in args.scheduling.split(","):
+            env = {
+                **os.environ,
+                "OPENAI_BASE_URL": openai_url,
+                "OPENAI_API_BASE": openai_url,
+                "OPENAI_API_KEY": "sk-bench",
+                "PRIORITY_SCHEDULING": scheduling,
+            }
+            env.setdefault("PRICE_FAST_PATH", "false")
+            env.setdefault("RATE_LIMIT", "false")
+            # Hedges would add calls the quota has no room for
+            env.setdefault("LLM_HEDGE", "false")
+            # The scheduler can only order calls it holds back: no more slots than the quota
+            env.setdefault("SCHEDULER_MAX_CONCURRENCY", str(args.quota))
+            server = subprocess.Popen([sys.executable, "-m", "benchmarks.serve", "--port", str(args.port)], env=env)
+            try:
+                base_url = f"http://127.0.0.1:{args.port}"
+                _wait_until_up(base_url + "/", server)
+                for with_batch in (False, True):
+                    result = asyncio.run(run(base_url, args, with_batch))
+                    print(json.dumps({"scheduling": scheduling, **result}))
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        openai.terminate()
+        openai.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
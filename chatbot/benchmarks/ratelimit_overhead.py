@@ -0,0 +1,73 @@
+"""Per-request cost of the rate limiter middleware with the in-process bucket store
+
+Sends langserve invoke requests through RateLimitMiddleware in front of a trivial ASGI
+app, with and without the limiter, over many sessions and a handful of client IPs, and
+prints the difference in microseconds per request.
+
+    python -m benchmarks.ratelimit_overhead --requests 50000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.ratelimit import MemoryBucketStore, RateLimiter, RateLimitMiddleware
+
+
+async def _app(scope, receive, send):
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def _drive(app, requests: int, sessions: int) -> float:
+    bodies = [
+        json.dumps({
+            "input": {"input": "How much is teeth cleaning and whitening?"},
+            "config": {"configurable": {"session_id": f"session-{i}"}},
+        }).encode()
+        for i in range(sessions)
+    ]
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for i in range(requests):
+        body = bodies[i % sessions]
+
+        async def receive(body=body):
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/website-bot/invoke",
+            "headers": [(b"x-forwarded-for", f"10.0.0.{i % 16}".encode())],
+            "client": ("127.0.0.1", 1234),
+        }
+        await app(scope, receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50000)
+    parser.add_argument("--sessions", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Limits high enough that nothing is rejected: the cost of the allowed path
+    limiter = RateLimiter(MemoryBucketStore(), 1e12, 1e12, 1e12, 1e12)
+    limited = RateLimitMiddleware(_app, limiter)
+    baseline = asyncio.run(_drive(_app, args.requests, args.sessions))
+    with_limiter = asyncio.run(_drive(limited, args.requests, args.sessions))
+    print(json.dumps({
+        "baseline_us": round(baseline * 1e6, 2),
+        "rate_limited_us": round(with_limiter * 1e6, 2),
+        "overhead_us": round((with_limiter - baseline) * 1e6, 2),
+        "buckets": limiter.store.stats()["keys"],
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Runs app.server:app with the in-memory Mongo stand-in instead of a real cluster
+
+    OPENAI_BASE_URL=http://127.0.0.1:8090/v1 python -m benchmarks.serve --port 8080
+"""
+import argparse
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--mongo-latency-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    os.environ.setdefault("MONGO_CONNECTION_STRING", "mongodb://memory")
+    os.environ.setdefault("MONGO_DATABASE", "bench")
+    os.environ.setdefault("MONGO_COLLECTION", "chat_histories")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+    from .memory_mongo import install
+
+    install(args.mongo_latency_ms / 1000)
+
+    import uvicorn
+
+    from app.server import app
+
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
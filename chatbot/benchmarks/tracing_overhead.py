@@ -0,0 +1,148 @@
+"""Per-request cost of tracing the agent, by tracing mode
+
+Runs the agent executor with a scripted plan (two get_treatment_price calls, then an
+answer) and a long chat history in the input, so no model is called, under:
+
+    langchain  LangChain's own tracer on every run (what LANGCHAIN_TRACING_V2=true did)
+    off        no tracing
+    sampled    SampledTracer at TRACING_SAMPLE_RATE (5% by default)
+    full       SampledTracer tracing every request through the export queue
+
+Nothing is sent anywhere: a sink client serializes each payload the way the LangSmith
+client would and waits --export-ms per batch, standing in for the network.
+
+    python -m benchmarks.tracing_overhead --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from langsmith import Client
+
+MODES = ("langchain", "off", "sampled", "full")
+
+
+class SinkClient(Client):
+    """A langsmith.Client that serializes what it is given and sends nothing"""
+
+    def __init__(self, export_seconds: float):
+        super().__init__(api_url="http://127.0.0.1:9", api_key="bench", auto_batch_tracing=False)
+        self.export_seconds = export_seconds
+        self.runs = 0
+
+    def batch_ingest_runs(self, create=None, update=None, pre_sampled=False):
+        json.dumps(create, default=str)
+        self.runs += len(create or ())
+        time.sleep(self.export_seconds)
+
+    def create_run(self, **run):
+        json.dumps(run, default=str)
+        self.runs += 1
+
+    def update_run(self, run_id, **run):
+        json.dumps(run, default=str)
+
+
+def _executor():
+    from langchain.agents import AgentExecutor
+    from langchain.agents.output_parsers.tools import ToolAgentAction
+    from langchain_core.agents import AgentFinish
+    from langchain_core.runnables import RunnableLambda
+
+    from app.tools.rag import get_treatment_price
+
+    def plan(inputs):
+        if inputs["intermediate_steps"]:
+            return AgentFinish({"output": "; ".join(s[1] for s in inputs["intermediate_steps"])}, "")
+        return [
+            ToolAgentAction(tool="get_treatment_price", tool_input={"treatment": t}, log="", message_log=[], tool_call_id=t)
+            for t in ("cleaning", "braces")
+        ]
+
+    return AgentExecutor(agent=RunnableLambda(plan), tools=[get_treatment_price])
+
+
+def _history(turns: int):
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    history = []
+    for i in range(turns):
+        history.append(HumanMessage(f"Question {i}: how much would a root canal and a crown cost? " * 5))
+        history.append(AIMessage(f"Answer {i}: a root canal is 5000 rs and a crown is 7000 rs. " * 5))
+    return history
+
+
+async def _run(mode: str, requests: int, concurrency: int, history_turns: int, sample_rate: float, export_ms: float) -> dict:
+    from langchain_core.tracers.langchain import LangChainTracer
+
+    from app import monkey_patch  # noqa: F401
+    from app.tracing import SampledTracer, TraceExporter
+
+    sink = SinkClient(export_ms / 1000)
+    tracer = None
+    callbacks = []
+    if mode == "langchain":
+        callbacks = [LangChainTracer(client=sink, project_name="bench")]
+    elif mode in ("sampled", "full"):
+        tracer = SampledTracer(TraceExporter(client=sink), sample_rate=1.0 if mode == "full" else sample_rate)
+        callbacks = [tracer]
+
+    executor = _executor()
+    history = _history(history_turns)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await executor.ainvoke(
+                {"input": "price of cleaning and braces", "chat_history": history},
+                {"metadata": {"session_id": f"bench-{i}"}, "callbacks": callbacks},
+            )
+            latencies.append(time.perf_counter() - start)
+
+    await one(-1)
+    latencies.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(one(i)) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    result = {"mode": mode, "requests": requests, "rps": round(requests / elapsed, 1)}
+    latencies.sort()
+    result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 3)
+    result["p99_ms"] = round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3)
+    if tracer is not None:
+        tracer.exporter.close()
+        result.update({k: v for k, v in tracer.exporter.stats().items() if k != "queued"})
+    result["runs_serialized"] = sink.runs
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--history-turns", type=int, default=20)
+    parser.add_argument("--sample-rate", type=float, default=0.05)
+    parser.add_argument("--export-ms", type=float, default=50, help="simulated network time per batch")
+    parser.add_argument("--modes", default=",".join(MODES))
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(","):
+        result = asyncio.run(
+            _run(mode, args.requests, args.concurrency, args.history_turns, args.sample_rate, args.export_ms)
+        )
+        results.append(result)
+        print(json.dumps(result))
+    # Throughput is bound by the one event loop, so 1000 / rps is the loop time per request
+    base = next((r for r in results if r["mode"] == "off"), None)
+    if base:
+        for result in results:
+            if result is not base:
+                delta = 1000 / result["rps"] - 1000 / base["rps"]
+                print(f"{result['mode']}: {delta:+.3f} ms of loop time per request vs off")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import pytest
+
+from app.history import mongo
+from benchmarks.memory_mongo import install
+
+
+@pytest.fixture
+def memory_mongo(monkeypatch):
+    """The shared Mongo clients pointed at the benchmarks' in-process stand-in"""
+    monkeypatch.setenv("MONGO_DATABASE", "tests")
+    monkeypatch.setenv("MONGO_COLLECTION", "history")
+    monkeypatch.delenv("MONGO_BUCKET_COLLECTION", raising=False)
+    # Restored to the real (unopened) clients afterwards
+    monkeypatch.setattr(mongo, "_client", None)
+    monkeypatch.setattr(mongo, "_async_client", None)
+    return install()
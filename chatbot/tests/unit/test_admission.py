@@ -0,0 +1,124 @@
+import asyncio
+
+from app.admission import AdmissionController, AdmissionControlMiddleware
+
+
+def saturated(controller: AdmissionController) -> None:
+    controller.in_flight = controller.slots
+
+
+def test_the_limit_grows_while_latency_holds_and_shrinks_when_it_rises():
+    controller = AdmissionController(initial_limit=16, max_limit=64)
+    saturated(controller)
+    for _ in range(20):
+        controller.observe_llm(1.0)
+    grown = controller.limit
+    assert grown > 16
+    saturated(controller)
+    for _ in range(20):
+        controller.observe_llm(3.0)
+    assert controller.limit < grown / 1.5
+    assert controller.limit >= controller.min_limit
+
+
+def test_the_limit_does_not_grow_under_light_load():
+    controller = AdmissionController(initial_limit=16)
+    for _ in range(20):
+        controller.observe_llm(1.0)
+    assert controller.limit == 16
+
+
+def test_the_queue_holds_what_littles_law_can_serve_in_time():
+    controller = AdmissionController(initial_limit=2, min_limit=2, max_queue=100, queue_timeout=10)
+    assert controller.queue_capacity() == 100
+    controller.in_flight = 1
+    controller.release(duration=5.0)
+    # 2 slots, each free every 5 s, serve 4 waiters within the 10 s deadline
+    assert controller.queue_capacity() == 4
+    assert controller.retry_after() == 3
+
+
+async def hold(controller: AdmissionController):
+    assert await controller.acquire() is None
+
+
+def test_a_waiter_cancelled_before_its_grant_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(initial_limit=1, min_limit=1)
+        await hold(controller)
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert controller.stats()["queued"] == 0
+        assert controller.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_a_waiter_cancelled_after_its_grant_gives_the_slot_back():
+    async def scenario():
+        controller = AdmissionController(initial_limit=1, min_limit=1)
+        await hold(controller)
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed over, then the client goes away before the waiter runs
+        controller.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert controller.in_flight == 0
+        assert await controller.acquire() is None
+
+    asyncio.run(scenario())
+
+
+def run_requests(controller: AdmissionController, requests, hold_seconds: float):
+    """Status and Retry-After of requests started together, the app taking hold_seconds each"""
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(hold_seconds)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    middleware = AdmissionControlMiddleware(app, controller)
+
+    async def request(method, path):
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"{}", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        await middleware({"type": "http", "method": method, "path": path, "headers": []}, receive, send)
+        return sent[0]["status"], dict(sent[0]["headers"]).get(b"retry-after")
+
+    async def scenario():
+        results = []
+        for method, path in requests:
+            results.append(asyncio.create_task(request(method, path)))
+            # Arrive in order
+            await asyncio.sleep(0)
+        return await asyncio.gather(*results)
+
+    return asyncio.run(scenario())
+
+
+def test_a_full_queue_is_answered_429_and_a_missed_deadline_503():
+    controller = AdmissionController(initial_limit=1, min_limit=1, max_queue=1, queue_timeout=0.05)
+    results = run_requests(controller, [("POST", "/website-bot/invoke")] * 3, hold_seconds=0.2)
+    # The first runs, the second waits past its deadline, the third finds the queue full
+    assert [status for status, _ in results] == [200, 503, 429]
+    assert all(retry_after is not None for _, retry_after in results[1:])
+    assert controller.rejected == {"queue_full": 1, "timeout": 1}
+    assert controller.in_flight == 0
+
+
+def test_the_health_check_and_other_routes_bypass_admission():
+    controller = AdmissionController(initial_limit=1, min_limit=1, max_queue=0)
+    requests = [("POST", "/website-bot/invoke"), ("GET", "/"), ("POST", "/website-bot/invoke"), ("GET", "/metrics")]
+    results = run_requests(controller, requests, hold_seconds=0.05)
+    assert [status for status, _ in results] == [200, 200, 429, 200]
+    assert controller.admitted == 1
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from starlette.testclient import TestClient
+
+from app import request_body
+from app.affinity import SessionAffinity, SessionAffinityMiddleware, session_key
+from app.ratelimit import MemoryBucketStore, RateLimiter, RateLimitMiddleware
+
+
+def test_cookie_names_the_session_key_and_the_task():
+    affinity = SessionAffinity(cookie_name="aff", max_age=60, same_site="none", task="task-a")
+    cookie = affinity.cookie("s1").decode()
+    assert cookie == f"aff={session_key('s1')}.task-a; Path=/; Max-Age=60; HttpOnly; SameSite=None; Secure"
+    assert "s1" not in cookie.split(";")[0]
+    headers = [(b"cookie", b"other=1; aff=" + f"{session_key('s1')}.task-a".encode())]
+    assert affinity.read_cookie(headers) == f"{session_key('s1')}.task-a"
+    assert affinity.read_cookie([(b"cookie", b"other=1")]) is None
+
+
+def test_check_counts_and_reports_migrations():
+    migrated = []
+    affinity = SessionAffinity(task="task-a", on_migrate=migrated.append)
+    key = session_key("s1")
+    assert affinity.check("s1", None) == "new"
+    assert affinity.check("s1", f"{session_key('s2')}.task-a") == "new"
+    assert affinity.check("s1", f"{key}.task-a") == "same"
+    assert affinity.check("s1", f"{key}.task-b") == "migrated"
+    assert migrated == ["s1"]
+    stats = affinity.stats()
+    assert (stats["new"], stats["same"], stats["migrated"]) == (2, 1, 1)
+    assert stats["migration_rate"] == 0.5
+
+
+def echo_app():
+    async def app(scope, receive, send):
+        body = (await receive())["body"]
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def test_middleware_sets_the_cookie_of_single_session_requests():
+    affinity = SessionAffinity(task="task-a")
+    client = TestClient(SessionAffinityMiddleware(echo_app(), affinity))
+    payload = {"input": {"input": "hi"}, "config": {"configurable": {"session_id": "s1"}}}
+    response = client.post("/website-bot/invoke", json=payload)
+    assert response.json() == payload
+    assert response.cookies["chatbot_affinity"] == f"{session_key('s1')}.task-a"
+    # The client sends it back
+    client.post("/website-bot/invoke", json=payload)
+    assert affinity.counts == {"same": 1, "migrated": 0, "new": 1}
+    # A batch over two sessions is left alone
+    batch = {"inputs": [{"input": "a"}, {"input": "b"}],
+             "config": [{"configurable": {"session_id": "s1"}}, {"configurable": {"session_id": "s2"}}]}
+    assert "set-cookie" not in TestClient(SessionAffinityMiddleware(echo_app(), affinity)).post(
+        "/website-bot/batch", json=batch
+    ).headers
+
+
+def test_the_body_is_read_and_parsed_once_for_both_middlewares(monkeypatch):
+    parses = []
+    parse = request_body.agent_calls
+    monkeypatch.setattr(request_body, "agent_calls", lambda body: parses.append(body) or parse(body))
+    app = SessionAffinityMiddleware(echo_app(), SessionAffinity(task="task-a"))
+    app = RateLimitMiddleware(app, RateLimiter(MemoryBucketStore()), trust_forwarded=False)
+    body = json.dumps({"input": {"input": "hi"}, "config": {"configurable": {"session_id": "s1"}}}).encode()
+    # Sent in two chunks
+    messages = [
+        {"type": "http.request", "body": body[:10], "more_body": True},
+        {"type": "http.request", "body": body[10:], "more_body": False},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/website-bot/invoke", "headers": [], "client": ("1.2.3.4", 1)}
+    asyncio.run(app(scope, receive, send))
+    assert parses == [body]
+    assert sent[-1]["body"] == body
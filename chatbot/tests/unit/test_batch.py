@@ -0,0 +1,140 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+from pymongo.errors import BulkWriteError
+
+from app.agents.batch import BatchRunner
+from app.history.batch import BatchHistories, current_batch
+from app.history.cache import SessionHistoryCache
+from app.history.mongo import SESSION_ID_KEY, PooledMongoDBChatMessageHistory
+from benchmarks.memory_mongo import MemoryCollection
+
+
+class CountingHistory(PooledMongoDBChatMessageHistory):
+    reads = {"many": 0, "single": 0}
+
+    @classmethod
+    async def aget_many(cls, histories):
+        cls.reads["many"] += 1
+        return await super().aget_many(histories)
+
+    async def aget_messages(self):
+        CountingHistory.reads["single"] += 1
+        return await super().aget_messages()
+
+
+def get_session_history(session_id):
+    # As in website_bot: the batch's view while a batch runs, the store otherwise
+    batch = current_batch()
+    if batch is not None and session_id in batch:
+        return batch.history(session_id)
+    return CountingHistory(session_id)
+
+
+class Agent:
+    """Answers with the length of the history it saw, and fails on "fail" """
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        history = get_session_history(config["configurable"]["session_id"])
+        seen = await history.aget_messages()
+        if input["input"] == "fail":
+            raise ValueError("no answer")
+        await history.aadd_messages([HumanMessage(input["input"]), AIMessage(f"after {len(seen)}")])
+        return {"output": f"after {len(seen)}"}
+
+
+def setup_function():
+    CountingHistory.reads = {"many": 0, "single": 0}
+
+
+def seed(*session_ids):
+    for session_id in session_ids:
+        CountingHistory(session_id).add_messages([HumanMessage("hi"), AIMessage("hello")])
+
+
+def contents(session_id):
+    return [m.content for m in CountingHistory(session_id).messages]
+
+
+def run_batch(runner, items, **kwargs):
+    inputs = [{"input": text} for text, _ in items]
+    configs = [{"configurable": {"session_id": session_id}} for _, session_id in items]
+    return asyncio.run(runner.abatch(inputs, configs, **kwargs))
+
+
+def count_bulk_writes(monkeypatch):
+    writes = []
+    bulk_write = MemoryCollection._bulk_write
+
+    def counted(self, requests, ordered=True):
+        writes.append(len(requests))
+        return bulk_write(self, requests, ordered)
+
+    monkeypatch.setattr(MemoryCollection, "_bulk_write", counted)
+    return writes
+
+
+def test_sessions_are_read_with_one_query_and_written_with_one_bulk_write(memory_mongo, monkeypatch):
+    seed("a", "b")
+    writes = count_bulk_writes(monkeypatch)
+    runner = BatchRunner(Agent(), CountingHistory)
+    results = run_batch(runner, [("q1", "a"), ("q2", "b"), ("q3", "new")])
+    assert results == [{"output": "after 2"}, {"output": "after 2"}, {"output": "after 0"}]
+    assert CountingHistory.reads == {"many": 1, "single": 0}
+    assert writes == [6]
+    assert contents("a") == ["hi", "hello", "q1", "after 2"]
+    assert contents("new") == ["q3", "after 0"]
+
+
+def test_a_failed_item_is_answered_in_place_and_writes_nothing(memory_mongo):
+    seed("a", "b")
+    runner = BatchRunner(Agent(), CountingHistory)
+    results = run_batch(runner, [("q1", "a"), ("fail", "b"), ("q3", "c")])
+    assert results[1] == {"output": None, "error": "ValueError"}
+    assert results[0] == {"output": "after 2"} and results[2] == {"output": "after 0"}
+    assert contents("b") == ["hi", "hello"]
+    assert contents("c") == ["q3", "after 0"]
+    assert runner.stats()["failed_items"] == 1
+    # Callers that ask for the exceptions get them
+    results = run_batch(runner, [("fail", "a")], return_exceptions=True)
+    assert isinstance(results[0], ValueError)
+
+
+def test_a_partly_failed_bulk_write_only_fails_those_sessions(memory_mongo, monkeypatch):
+    seed("a", "b")
+    bulk_write = MemoryCollection._bulk_write
+
+    def failing_for_b(self, requests, ordered=True):
+        failed = [i for i, request in enumerate(requests) if request._doc[SESSION_ID_KEY] == "b"]
+        bulk_write(self, [r for i, r in enumerate(requests) if i not in failed], ordered)
+        raise BulkWriteError({"writeErrors": [{"index": i, "code": 11000, "errmsg": "dup"} for i in failed]})
+
+    monkeypatch.setattr(MemoryCollection, "_bulk_write", failing_for_b)
+    cache = SessionHistoryCache()
+    batch = BatchHistories(CountingHistory, cache=cache)
+
+    async def scenario():
+        await batch.aload(["a", "b"])
+        batch.history("a").add_messages([HumanMessage("q1"), AIMessage("r1")])
+        batch.history("b").add_messages([HumanMessage("q2"), AIMessage("r2")])
+        return await batch.aflush()
+
+    assert asyncio.run(scenario()) == {"written": 1, "failed": 1}
+    assert contents("a") == ["hi", "hello", "q1", "r1"]
+    # The cache does not keep the turn Mongo does not have
+    assert [m.content for m in cache.get("a")] == ["hi", "hello", "q1", "r1"]
+    assert cache.get("b") is None
+
+
+def test_items_read_their_own_histories_when_the_bulk_read_fails(memory_mongo, monkeypatch):
+    seed("a", "b")
+
+    async def unavailable(cls, histories):
+        raise ConnectionError("mongo down")
+
+    monkeypatch.setattr(CountingHistory, "aget_many", classmethod(unavailable))
+    runner = BatchRunner(Agent(), CountingHistory)
+    results = run_batch(runner, [("q1", "a"), ("q2", "b")])
+    assert results == [{"output": "after 2"}, {"output": "after 2"}]
+    assert CountingHistory.reads["single"] == 2
+    assert contents("b") == ["hi", "hello", "q2", "after 2"]
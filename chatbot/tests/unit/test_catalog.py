@@ -0,0 +1,95 @@
+import json
+import os
+
+import pytest
+
+from app.tools.catalog import DEFAULT_CATALOG_PATH, TreatmentCatalog
+
+
+@pytest.fixture
+def catalog():
+    return TreatmentCatalog(DEFAULT_CATALOG_PATH)
+
+
+@pytest.mark.parametrize("query, name", [
+    ("root canal", "Root Canal Treatment"),
+    ("price of rct", "Root Canal Treatment"),
+    ("re root canal", "Re Root Canal Treatment"),
+    ("How much would a re root canal cost me", "Re Root Canal Treatment"),
+    ("re rct", "Re Root Canal Treatment"),
+    ("teeth whitening", "Teeth Whitening"),
+    ("brces", "Metal Braces"),
+    ("wisdom tooth", "Wisdom Tooth Extraction"),
+])
+def test_best_match(catalog, query, name):
+    assert catalog.search(query, k=3)[0].name == name
+
+
+def test_names_with_every_query_word_rank_first(catalog):
+    matches = catalog.search("re root canal", k=2)
+    assert [m.name for m in matches] == ["Re Root Canal Treatment", "Root Canal Treatment"]
+    # Scores stay the plain similarity, so the runner-up may score higher
+    assert matches[0].score < 1.0
+
+
+@pytest.mark.parametrize("question, name", [
+    ("price of root canal for my son", "Root Canal Treatment"),
+    ("price of re root canal for my son", "Re Root Canal Treatment"),
+    ("How much would a re root canal cost me?", "Re Root Canal Treatment"),
+    ("how much are braces", "Metal Braces"),
+    ("how much for crown", None),
+    ("brces price", None),
+])
+def test_resolve_ignores_words_no_name_uses(catalog, question, name):
+    match = catalog.resolve(question)
+    assert (match and match.name) == name
+
+
+def write_catalog(path, data):
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def test_aliases_and_synonyms_of_a_json_catalog(tmp_path):
+    path = write_catalog(tmp_path / "catalog.json", {
+        "synonyms": {"ss": "stainless steel"},
+        "treatments": [
+            {"name": "Stainless Steel Crown", "price": 2500, "aliases": ["kids crown"]},
+            {"name": "Zirconia Crown", "price": 12000},
+        ],
+    })
+    catalog = TreatmentCatalog(path)
+    assert catalog.search("kids crowns", k=1)[0] == ("Stainless Steel Crown", "2500", 1.0)
+    assert catalog.search("ss crown", k=1)[0].name == "Stainless Steel Crown"
+
+
+def rewrite(path, text, catalog):
+    path.write_text(text)
+    stat = os.stat(path)
+    # A different mtime even within the filesystem's timestamp resolution
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    catalog._next_check = 0
+
+
+def test_a_bad_file_keeps_the_last_good_version(tmp_path):
+    path = tmp_path / "catalog.csv"
+    path.write_text("name,price,aliases\nDental Implant,30000,implant\n")
+    catalog = TreatmentCatalog(str(path))
+    reloads = []
+    catalog.add_reload_listener(lambda: reloads.append(True))
+
+    # A short row has no price
+    rewrite(path, "name,price,aliases\nDental Implant\n", catalog)
+    assert catalog.maybe_reload() is False
+    assert catalog.search("implant", k=1)[0].price == "30000"
+
+    rewrite(path, "name,price,aliases\nDental Implant,32000,implant\n", catalog)
+    assert catalog.maybe_reload() is True
+    assert catalog.search("implant", k=1)[0].price == "32000"
+    assert reloads == [True]
+
+
+def test_a_catalog_without_prices_does_not_load(tmp_path):
+    path = write_catalog(tmp_path / "catalog.json", [{"name": "Dental Implant"}])
+    with pytest.raises(ValueError):
+        TreatmentCatalog(path)
@@ -0,0 +1,73 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.agents.coalesce import SingleFlight
+from app.history.mongo import PooledMongoDBChatMessageHistory
+
+
+class CountingHistory(PooledMongoDBChatMessageHistory):
+    loads = 0
+
+    async def aget_messages(self):
+        CountingHistory.loads += 1
+        return await super().aget_messages()
+
+
+class Agent:
+    """Answers slowly and writes its turn, as the history wrapper would"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        history = CountingHistory(config["configurable"]["session_id"])
+        await history.aadd_messages([HumanMessage(input["input"]), AIMessage("Braces cost 45000 rs")])
+        return {"input": input["input"], "output": "Braces cost 45000 rs"}
+
+
+def config(session_id):
+    return {"configurable": {"session_id": session_id}}
+
+
+def test_identical_first_questions_share_one_execution(memory_mongo):
+    CountingHistory.loads = 0
+    agent = Agent()
+    flight = SingleFlight(agent, CountingHistory)
+
+    async def ask():
+        return await asyncio.gather(
+            flight.ainvoke({"input": "Price of braces?"}, config("a")),
+            flight.ainvoke({"input": "price of braces"}, config("b")),
+        )
+
+    first, second = asyncio.run(ask())
+    assert agent.calls == 1
+    assert first == {"input": "Price of braces?", "output": "Braces cost 45000 rs"}
+    # Each caller gets its own input back and its own turn in its session
+    assert second == {"input": "price of braces", "output": "Braces cost 45000 rs"}
+    assert [m.content for m in CountingHistory("b").messages] == ["price of braces", "Braces cost 45000 rs"]
+    # The first-turn check is an existence query, not a load of the session
+    assert CountingHistory.loads == 0
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 1, "skipped": 0}
+
+
+def test_sessions_with_history_run_on_their_own(memory_mongo):
+    CountingHistory.loads = 0
+    CountingHistory("a").add_messages([HumanMessage("hi"), AIMessage("hello")])
+    CountingHistory("b").add_messages([HumanMessage("hi"), AIMessage("hello")])
+    agent = Agent()
+    flight = SingleFlight(agent, CountingHistory)
+
+    async def ask():
+        return await asyncio.gather(
+            flight.ainvoke({"input": "price of braces"}, config("a")),
+            flight.ainvoke({"input": "price of braces"}, config("b")),
+        )
+
+    asyncio.run(ask())
+    assert agent.calls == 2
+    assert flight.skipped == 2
+    assert CountingHistory.loads == 0
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.agents.fast_path import PriceFastPath, extract_treatment
+from app.history.mongo import PooledMongoDBChatMessageHistory
+from app.tools.catalog import DEFAULT_CATALOG_PATH, TreatmentCatalog
+
+
+class Agent:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        return {"input": input["input"], "output": "from the agent"}
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return self.invoke(input, config, **kwargs)
+
+
+def fast_path(catalog=None, **kwargs):
+    catalog = catalog or TreatmentCatalog(DEFAULT_CATALOG_PATH)
+    return PriceFastPath(Agent(), PooledMongoDBChatMessageHistory, catalog, **kwargs)
+
+
+def session(session_id="s1"):
+    return {"configurable": {"session_id": session_id}}
+
+
+@pytest.mark.parametrize("question, treatment", [
+    ("How much is RCT?", "rct"),
+    ("braces price", "braces"),
+    ("Hi, what is the cost of a crown please", "crown"),
+    ("how much does an implant cost", "implant"),
+    ("price of braces and implants", None),
+    ("do you do implants", None),
+    ("is the price of braces negotiable for students who pay upfront in cash", None),
+])
+def test_extract_treatment(question, treatment):
+    assert extract_treatment(question) == treatment
+
+
+def test_unsure_matches_fall_through(memory_mongo, tmp_path):
+    router = fast_path()
+    # The best match for "re root canal" scores below min_score
+    assert router.route({"input": "price of re root canal"}, session()) is None
+    path = tmp_path / "catalog.json"
+    path.write_text(json.dumps({"treatments": [
+        {"name": "Metal Crown", "price": 3000},
+        {"name": "Ceramic Crown", "price": 9000},
+    ]}))
+    # Two crowns score alike, so even without a minimum score the margin refuses
+    router = fast_path(TreatmentCatalog(str(path)), min_score=0.0)
+    assert router.route({"input": "how much is a crown"}, session()) is None
+    assert router.route({"input": "metal crown price"}, session()) == "The price of Metal Crown is 3000 rs."
+    assert router.stats.snapshot()["fallthroughs"] == 1
+
+
+def test_answer_is_written_to_the_history(memory_mongo):
+    router = fast_path()
+    output = asyncio.run(router.ainvoke({"input": "How much is RCT?"}, session()))
+    assert output == {"input": "How much is RCT?", "output": "The price of Root Canal Treatment is 5000 rs."}
+    assert router.runnable.calls == 0
+    messages = PooledMongoDBChatMessageHistory("s1").messages
+    assert [(m.type, m.content) for m in messages] == [("human", "How much is RCT?"), ("ai", output["output"])]
+
+
+def test_later_turns_go_to_the_agent(memory_mongo):
+    PooledMongoDBChatMessageHistory("s1").add_messages([HumanMessage("hi"), AIMessage("hello")])
+    router = fast_path()
+    assert router.invoke({"input": "How much is RCT?"}, session())["output"] == "from the agent"
+    assert asyncio.run(router.ainvoke({"input": "How much is RCT?"}, session()))["output"] == "from the agent"
+    assert router.runnable.calls == 2
+    assert router.stats.snapshot() == {"hits": 0, "fallthroughs": 2, "hit_rate": 0.0}
@@ -0,0 +1,206 @@
+import asyncio
+import time
+from typing import Dict, List
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from app.history.cache import CachedChatMessageHistory, SessionHistoryCache, WriteBehindWriter
+from app.metrics import history_writes_dropped
+
+
+class RecordingHistory(BaseChatMessageHistory):
+    """In-memory backend that records every load and write"""
+
+    stored: Dict[str, List[BaseMessage]] = {}
+    loads: List[str] = []
+    writes: List[tuple] = []
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        RecordingHistory.loads.append(self.session_id)
+        return list(self.stored.get(self.session_id, []))
+
+    def add_messages(self, messages) -> None:
+        RecordingHistory.writes.append((self.session_id, [m.content for m in messages]))
+        self.stored.setdefault(self.session_id, []).extend(messages)
+
+    def clear(self) -> None:
+        self.stored.pop(self.session_id, None)
+
+
+def setup_function():
+    RecordingHistory.stored = {}
+    RecordingHistory.loads = []
+    RecordingHistory.writes = []
+
+
+def turn(i: int) -> List[BaseMessage]:
+    return [HumanMessage(f"q{i}"), AIMessage(f"a{i}")]
+
+
+def idle_writer() -> WriteBehindWriter:
+    # Flushes only when the test asks
+    return WriteBehindWriter(RecordingHistory, flush_interval=60, batch_size=1000)
+
+
+def test_least_recently_used_sessions_are_evicted_first():
+    cache = SessionHistoryCache(max_sessions=2)
+    cache.put("a", turn(0))
+    cache.put("b", turn(1))
+    assert cache.get("a") is not None
+    cache.put("c", turn(2))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.evictions == 1
+
+
+def test_entries_expire_after_the_ttl():
+    cache = SessionHistoryCache(ttl_seconds=0.05)
+    cache.put("a", turn(0))
+    assert cache.get("a") is not None
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["sessions"] == 0
+
+
+def test_the_byte_cap_evicts_and_accounts_sizes():
+    cache = SessionHistoryCache(max_bytes=2000)
+    cache.put("a", [HumanMessage("x" * 500)])
+    cache.put("b", [HumanMessage("x" * 500)])
+    assert cache.bytes == 1800
+    cache.put("c", [HumanMessage("x" * 500)])
+    assert cache.get("a") is None
+    assert cache.bytes == 1800
+    # Growing b goes over the cap, c is now the least recently used
+    cache.append("b", [AIMessage("y" * 100)])
+    assert cache.get("c") is None
+    assert cache.bytes == 900 + 500
+    cache.put("b", [HumanMessage("short")])
+    assert cache.bytes == 405
+
+
+def test_sessions_with_pending_writes_are_pinned():
+    writer = idle_writer()
+    cache = SessionHistoryCache(max_sessions=1, ttl_seconds=0.05, is_pinned=writer.is_pending)
+    cache.put("a", turn(0))
+    writer.enqueue("a", turn(1))
+    # Neither the cap nor the TTL drop a session whose writes are not in the backend yet
+    cache.put("b", turn(2))
+    time.sleep(0.1)
+    assert cache.get("a") is not None
+    writer.flush()
+    assert not writer.is_pending("a")
+    cache.put("c", turn(3))
+    assert cache.get("a") is None
+    writer.close()
+
+
+def test_appends_of_a_session_are_coalesced_into_one_write():
+    writer = idle_writer()
+    writer.enqueue("a", turn(0))
+    writer.enqueue("b", turn(1))
+    writer.enqueue("a", turn(2))
+    assert RecordingHistory.writes == []
+    writer.flush()
+    assert RecordingHistory.writes == [("a", ["q0", "a0", "q2", "a2"]), ("b", ["q1", "a1"])]
+    assert writer.stats() == {"pending": 0, "pending_sessions": 0, "flushed": 6, "failures": 0, "dropped": 0}
+    writer.close()
+
+
+def test_a_failed_flush_keeps_the_session_pinned_and_retries():
+    class Flaky(RecordingHistory):
+        failures = 1
+
+        def add_messages(self, messages) -> None:
+            if Flaky.failures:
+                Flaky.failures -= 1
+                raise ConnectionError("mongo down")
+            super().add_messages(messages)
+
+    writer = WriteBehindWriter(Flaky, flush_interval=60, batch_size=1000)
+    writer.enqueue("a", turn(0))
+    writer.flush()
+    assert writer.is_pending("a") and writer.failures == 1
+    # Not retried before its backoff is over, except when asked to
+    writer.flush()
+    assert writer.is_pending("a") and RecordingHistory.writes == []
+    writer.flush(retry_now=True)
+    assert not writer.is_pending("a")
+    assert RecordingHistory.writes == [("a", ["q0", "a0"])]
+    writer.close()
+
+
+def test_a_session_that_keeps_failing_is_dropped_after_max_attempts():
+    class Broken(RecordingHistory):
+        def add_messages(self, messages) -> None:
+            if self.session_id == "broken":
+                raise ConnectionError("document too large")
+            super().add_messages(messages)
+
+    writer = WriteBehindWriter(Broken, flush_interval=60, batch_size=1000, max_attempts=3)
+    dropped = history_writes_dropped.labels().value
+    writer.enqueue("broken", turn(0))
+    writer.enqueue("fine", turn(1))
+    for _ in range(2):
+        writer.flush(retry_now=True)
+        assert writer.is_pending("broken")
+    writer.flush(retry_now=True)
+    assert not writer.is_pending("broken") and not writer.is_pending("fine")
+    assert writer.stats()["dropped"] == 2 and writer.failures == 3
+    assert history_writes_dropped.labels().value == dropped + 2
+    assert RecordingHistory.writes == [("fine", ["q1", "a1"])]
+    # A later write of the session starts over
+    writer.enqueue("broken", turn(2))
+    writer.flush(retry_now=True)
+    assert writer.is_pending("broken")
+    for _ in range(2):
+        writer.flush(retry_now=True)
+    assert writer.stats()["dropped"] == 4
+    writer.close()
+
+
+def test_cached_history_reads_once_and_writes_behind():
+    writer = idle_writer()
+    cache = SessionHistoryCache(is_pinned=writer.is_pending)
+    RecordingHistory("a").add_messages(turn(0))
+    RecordingHistory.writes = []
+    history = CachedChatMessageHistory("a", RecordingHistory, cache, writer)
+    assert [m.content for m in history.messages] == ["q0", "a0"]
+    history.add_messages(turn(1))
+    again = CachedChatMessageHistory("a", RecordingHistory, cache, writer)
+    assert [m.content for m in again.messages] == ["q0", "a0", "q1", "a1"]
+    assert RecordingHistory.loads == ["a"]
+    assert RecordingHistory.writes == []
+    writer.close()
+    assert RecordingHistory.writes == [("a", ["q1", "a1"])]
+
+
+def test_a_session_that_fell_out_of_the_cache_is_flushed_at_once():
+    writer = idle_writer()
+    cache = SessionHistoryCache(is_pinned=writer.is_pending)
+    history = CachedChatMessageHistory("a", RecordingHistory, cache, writer)
+    assert history.messages == []
+    cache.discard("a")
+    history.add_messages(turn(0))
+    # Not cached, so the next read goes to the backend, which must have the turn already
+    assert RecordingHistory.writes == [("a", ["q0", "a0"])]
+    assert not writer.is_pending("a")
+    assert [m.content for m in CachedChatMessageHistory("a", RecordingHistory, cache, writer).messages] == ["q0", "a0"]
+    writer.close()
+
+
+def test_aclear_flushes_then_clears():
+    writer = idle_writer()
+    cache = SessionHistoryCache(is_pinned=writer.is_pending)
+    history = CachedChatMessageHistory("a", RecordingHistory, cache, writer)
+    assert history.messages == []
+    history.add_messages(turn(0))
+    asyncio.run(history.aclear())
+    assert RecordingHistory.writes == [("a", ["q0", "a0"])]
+    assert not writer.is_pending("a") and "a" not in RecordingHistory.stored
+    assert cache.get("a") is None
+    writer.close()
@@ -0,0 +1,65 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.history.buckets import BucketedMongoDBChatMessageHistory
+from app.history.migrate import migrate, migrated_collection_name
+from app.history.mongo import PooledMongoDBChatMessageHistory, get_collection
+
+
+def turn(n):
+    return [HumanMessage(f"question {n}"), AIMessage(f"answer {n}")]
+
+
+def old_session(session_id, turns):
+    history = PooledMongoDBChatMessageHistory(session_id)
+    for n in range(turns):
+        history.add_messages(turn(n))
+
+
+def contents(session_id):
+    return [m.content for m in BucketedMongoDBChatMessageHistory(session_id, bucket_size=4).messages]
+
+
+def test_copies_sessions_in_bucket_order(memory_mongo):
+    old_session("a", 5)
+    counts = migrate(bucket_size=4)
+    assert counts == {"sessions": 1, "skipped": 0, "messages": 10, "buckets": 3}
+    assert contents("a") == [text for n in range(5) for text in (f"question {n}", f"answer {n}")]
+
+
+def test_returning_session_is_still_copied_before_its_new_turns(memory_mongo):
+    old_session("a", 3)
+    # The service on buckets already took the session's next turn
+    BucketedMongoDBChatMessageHistory("a", bucket_size=4).add_messages(turn(3))
+    migrate(bucket_size=4)
+    assert contents("a") == [text for n in range(4) for text in (f"question {n}", f"answer {n}")]
+    # The copied buckets are full, so later turns go onto the service's own bucket
+    BucketedMongoDBChatMessageHistory("a", bucket_size=4).add_messages(turn(4))
+    assert contents("a")[-2:] == ["question 4", "answer 4"]
+    assert len(get_collection("history_buckets").documents) == 3
+
+
+def test_rerun_skips_finished_sessions(memory_mongo):
+    old_session("a", 2)
+    migrate(bucket_size=4)
+    old_session("b", 1)
+    assert migrate(bucket_size=4) == {"sessions": 1, "skipped": 1, "messages": 2, "buckets": 1}
+    assert contents("a") == ["question 0", "answer 0", "question 1", "answer 1"]
+
+
+def test_copying_again_after_an_interruption_does_not_duplicate(memory_mongo):
+    old_session("a", 3)
+    migrate(bucket_size=4)
+    # As if the run stopped after writing the buckets, before recording the session
+    get_collection(migrated_collection_name()).delete_many({})
+    assert migrate(bucket_size=4)["sessions"] == 1
+    assert len(get_collection("history_buckets").documents) == 2
+    assert len(contents("a")) == 6
+
+
+def test_delete_source_and_dry_run(memory_mongo):
+    old_session("a", 2)
+    assert migrate(bucket_size=4, dry_run=True)["buckets"] == 1
+    assert get_collection("history_buckets").documents == []
+    migrate(bucket_size=4, delete_source=True)
+    assert get_collection().documents == []
+    assert len(contents("a")) == 4
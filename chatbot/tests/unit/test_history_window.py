@@ -0,0 +1,75 @@
+from typing import List
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from app.history.window import SUMMARY_PREFIX, WindowedMongoDBChatMessageHistory
+
+
+class RecordingSummarizer:
+    """Joins the folded messages' text, so a summary shows exactly what was folded"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, summary: str, messages: List[BaseMessage]) -> str:
+        self.calls += 1
+        return " ".join(filter(None, [summary] + [m.content for m in messages]))
+
+
+def windowed(summarizer, **kwargs) -> WindowedMongoDBChatMessageHistory:
+    history = WindowedMongoDBChatMessageHistory(session_id="s1", summarizer=summarizer, **kwargs)
+    # Fold inline rather than on the background executor
+    history._schedule_fold = history.fold
+    return history
+
+
+def turn(history, i: int, answer: str = "") -> None:
+    history.add_messages([HumanMessage(f"q{i}"), AIMessage(answer or f"a{i}")])
+
+
+def covered(history) -> set:
+    """Texts a prompt built from the history holds, in the summary or in full"""
+    messages = history.messages
+    texts = {m.content for m in messages if not isinstance(m, SystemMessage)}
+    if messages and isinstance(messages[0], SystemMessage):
+        texts.update(messages[0].content[len(SUMMARY_PREFIX):].split())
+    return texts
+
+
+def test_every_message_stays_in_the_window_or_the_summary(memory_mongo):
+    summarizer = RecordingSummarizer()
+    history = windowed(summarizer, max_messages=6, max_tokens=1000, fold_batch=4)
+    for i in range(20):
+        turn(history, i)
+        assert covered(history) >= {f"q{j}" for j in range(i + 1)} | {f"a{j}" for j in range(i + 1)}
+    assert len(history.messages) <= 7
+    # Folds run ahead into the window, so they come about fold_batch messages apart
+    assert summarizer.calls <= 40 // 4
+
+
+def test_messages_trimmed_by_the_token_budget_are_folded(memory_mongo):
+    history = windowed(RecordingSummarizer(), max_messages=20, max_tokens=40, fold_batch=4)
+    turn(history, 0)
+    turn(history, 1, answer="long" + " answer" * 100)
+    turn(history, 2)
+    window = history.messages
+    # The long answer no longer fits the budget but was summarized before it left
+    assert [m.content for m in window[1:]] == ["q2", "a2"]
+    assert "long" in covered(history)
+    assert {"q0", "a0", "q1"} <= covered(history)
+
+
+def test_short_sessions_are_not_folded(memory_mongo):
+    summarizer = RecordingSummarizer()
+    history = windowed(summarizer, max_messages=6, max_tokens=1000, fold_batch=4)
+    for i in range(3):
+        turn(history, i)
+    assert summarizer.calls == 0
+    assert [m.content for m in history.messages] == ["q0", "a0", "q1", "a1", "q2", "a2"]
+
+
+def test_without_a_summarizer_the_window_is_only_trimmed(memory_mongo):
+    history = WindowedMongoDBChatMessageHistory(session_id="s1", summarizer=None, max_messages=4)
+    for i in range(4):
+        turn(history, i)
+    assert [m.content for m in history.messages] == ["q2", "a2", "q3", "a3"]
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import pytest
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import tool
+
+from app.llm import CircuitBreaker, CircuitOpenError, HedgePolicy, ResilientChatModel
+from app.metrics import llm_deadline_exceeded, llm_failovers, llm_hedges
+
+
+class FailingChatModel(BaseChatModel):
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "failing"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        raise ConnectionError("upstream down")
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self.calls += 1
+        raise ConnectionError("upstream down")
+
+
+class SlowChatModel(BaseChatModel):
+    """Call n waits delays[n] (the last delay for later calls) before answering "attempt n",
+    then waits `stall` before finishing"""
+
+    delays: List[float]
+    stall: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        raise NotImplementedError
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        call = self.calls
+        self.calls += 1
+        await asyncio.sleep(self.delays[min(call, len(self.delays) - 1)])
+        yield ChatGenerationChunk(message=AIMessageChunk(content=f"attempt {call}"))
+        await asyncio.sleep(self.stall)
+
+
+def primed_hedge(max_ratio: float = 0.1) -> HedgePolicy:
+    # Ten fast first chunks: hedge after min_delay from now on
+    policy = HedgePolicy(min_delay=0.05, max_ratio=max_ratio, min_samples=10, window=20)
+    for _ in range(10):
+        policy.record(0.01, hedged=False)
+    return policy
+
+
+def answering(*answers: str) -> GenericFakeChatModel:
+    return GenericFakeChatModel(messages=iter(AIMessage(answer) for answer in answers))
+
+
+def resilient(primary: BaseChatModel, fallback: Optional[BaseChatModel] = None, failures: int = 5) -> ResilientChatModel:
+    return ResilientChatModel(primary=primary, fallback=fallback, breaker=CircuitBreaker("test", failures=failures))
+
+
+def test_sync_invoke_answers():
+    assert resilient(answering("Braces cost 45000 rs")).invoke("price of braces").content == "Braces cost 45000 rs"
+
+
+def test_sync_stream_streams_chunks():
+    chunks = list(resilient(answering("Braces cost 45000 rs")).stream("price of braces"))
+    assert len(chunks) > 1
+    assert "".join(chunk.content for chunk in chunks) == "Braces cost 45000 rs"
+
+
+def test_sync_stream_falls_back_before_the_first_chunk():
+    primary = FailingChatModel()
+    model = resilient(primary, fallback=answering("from the fallback"), failures=1)
+    assert "".join(chunk.content for chunk in model.stream("hi")) == "from the fallback"
+    assert model.breaker.state == CircuitBreaker.OPEN
+    # The open circuit sends the next call straight to the fallback
+    model.fallback = answering("again")
+    assert model.invoke("hi").content == "again"
+    assert primary.calls == 1
+
+
+def test_sync_stream_without_fallback_raises():
+    model = resilient(FailingChatModel(), failures=1)
+    with pytest.raises(ConnectionError):
+        list(model.stream("hi"))
+    with pytest.raises(CircuitOpenError):
+        list(model.stream("hi"))
+
+
+def test_sync_agent_invoke():
+    @tool
+    def get_treatment_price(treatment: str) -> str:
+        """Price of a dental treatment"""
+        return "45000 rs"
+
+    prompt = ChatPromptTemplate.from_messages(
+        [("user", "{input}"), MessagesPlaceholder(variable_name="agent_scratchpad")]
+    )
+    llm = resilient(answering("Braces cost 45000 rs"))
+    agent = create_tool_calling_agent(llm, [get_treatment_price], prompt)
+    executor = AgentExecutor(agent=agent, tools=[get_treatment_price])
+    assert executor.invoke({"input": "price of braces"})["output"] == "Braces cost 45000 rs"
+
+
+def test_async_slow_attempt_is_hedged_and_the_faster_one_wins():
+    primary = SlowChatModel(delays=[1.0, 0.0])
+    model = ResilientChatModel(primary=primary, hedge=primed_hedge(), breaker=CircuitBreaker("test"))
+    started, won = llm_hedges.labels("started").value, llm_hedges.labels("won").value
+    began = time.monotonic()
+    assert asyncio.run(model.ainvoke("hi")).content == "attempt 1"
+    assert time.monotonic() - began < 0.5
+    assert primary.calls == 2
+    assert llm_hedges.labels("started").value == started + 1
+    assert llm_hedges.labels("won").value == won + 1
+    assert model.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_hedges_stay_within_the_budget():
+    policy = primed_hedge(max_ratio=0.2)
+    assert policy.delay() == 0.05
+    policy.record(0.3, hedged=True)
+    assert policy.delay() == 0.05
+    # A second hedge in 12 calls would be over 20%
+    policy.record(0.3, hedged=True)
+    assert policy.delay() is None
+    primary = SlowChatModel(delays=[0.2])
+    model = ResilientChatModel(primary=primary, hedge=policy, breaker=CircuitBreaker("test"))
+    assert asyncio.run(model.ainvoke("hi")).content == "attempt 0"
+    assert primary.calls == 1
+    for _ in range(3):
+        policy.record(0.01, hedged=False)
+    assert policy.delay() == 0.05
+
+
+@pytest.mark.parametrize("primary", [
+    SlowChatModel(delays=[1.0]),
+    # The first chunk in time, then nothing until past the deadline
+    SlowChatModel(delays=[0.0], stall=1.0),
+], ids=["first chunk", "rest of the stream"])
+def test_async_deadline_raises_and_is_counted(primary):
+    model = ResilientChatModel(primary=primary, deadline=0.1, breaker=CircuitBreaker("deadline-test"))
+    exceeded = llm_deadline_exceeded.labels("deadline-test").value
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(model.ainvoke("hi"))
+    assert llm_deadline_exceeded.labels("deadline-test").value == exceeded + 1
+
+
+def test_async_failover_opens_the_breaker():
+    primary = FailingChatModel()
+    model = resilient(primary, fallback=answering("from the fallback"), failures=1)
+    errors, open_circuit = llm_failovers.labels("error").value, llm_failovers.labels("circuit_open").value
+    assert asyncio.run(model.ainvoke("hi")).content == "from the fallback"
+    assert model.breaker.state == CircuitBreaker.OPEN
+    assert llm_failovers.labels("error").value == errors + 1
+    # The open circuit sends the next call straight to the fallback
+    model.fallback = answering("again")
+    assert asyncio.run(model.ainvoke("hi")).content == "again"
+    assert primary.calls == 1
+    assert llm_failovers.labels("circuit_open").value == open_circuit + 1
@@ -0,0 +1,25 @@
+from app.metrics import Histogram, REGISTRY, render, request_allocated_blocks
+
+
+def test_histogram_renders_one_inf_bucket():
+    histogram = Histogram("test_sizes", "Sizes", ["route"], buckets=(1, 10, float("inf")))
+    try:
+        histogram.labels("/a").observe(5)
+        histogram.labels("/a").observe(50)
+        lines = histogram.render()
+    finally:
+        REGISTRY.remove(histogram)
+    assert [line for line in lines if "_bucket" in line] == [
+        'test_sizes_bucket{route="/a",le="1"} 0',
+        'test_sizes_bucket{route="/a",le="10"} 1',
+        'test_sizes_bucket{route="/a",le="+Inf"} 2',
+    ]
+    assert 'test_sizes_count{route="/a"} 2' in lines
+
+
+def test_allocated_blocks_series_are_unique():
+    request_allocated_blocks.labels("/test").observe(2000000)
+    exposed = [line for line in render().splitlines() if line.startswith("chatbot_request_allocated_blocks_bucket")]
+    series = [line.rsplit(" ", 1)[0] for line in exposed]
+    assert len(series) == len(set(series))
+    assert 'chatbot_request_allocated_blocks_bucket{route="/test",le="+Inf"} 1' in exposed
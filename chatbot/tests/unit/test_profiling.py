@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from app.profiling import MemorySnapshots
+
+
+@pytest.fixture
+def snapshots():
+    snapshots = MemorySnapshots(frames=1)
+    yield snapshots
+    snapshots.stop()
+
+
+def test_snapshot_ids_name_the_worker(snapshots):
+    base, target = snapshots.take(), snapshots.take()
+    assert base["id"] == f"{os.getpid()}-1" and base["pid"] == os.getpid()
+    assert snapshots.diff(base["id"], target["id"])["target"] == target["id"]
+    with pytest.raises(KeyError):
+        snapshots.diff(base["id"], f"{os.getpid()}-9")
+
+
+def test_diff_across_workers_is_refused(snapshots):
+    base = snapshots.take()
+    with pytest.raises(ValueError):
+        snapshots.diff(base["id"], f"{os.getpid() + 1}-2")
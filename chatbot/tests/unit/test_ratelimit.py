@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+from starlette.testclient import TestClient
+
+from app.ratelimit import MemoryBucketStore, RateLimiter, RateLimitMiddleware
+from app.request_body import agent_calls
+
+
+class CountingStore(MemoryBucketStore):
+    def __init__(self):
+        super().__init__()
+        self.takes = 0
+
+    async def take(self, key, cost, rate, burst):
+        self.takes += 1
+        return await super().take(key, cost, rate, burst)
+
+
+def limiter(store=None, **kwargs) -> RateLimiter:
+    # One token per call and per 4 characters, a minute's rate of 60 refills 1 a second
+    settings = dict(session_tokens_per_minute=60, session_burst=10, ip_tokens_per_minute=60, ip_burst=20, base_tokens=1)
+    settings.update(kwargs)
+    return RateLimiter(store or MemoryBucketStore(), **settings)
+
+
+def check(rate_limiter, calls, ip="10.0.0.1"):
+    return asyncio.run(rate_limiter.check(calls, ip))
+
+
+def test_take_now_refills_up_to_the_burst():
+    store = MemoryBucketStore()
+    assert store.take_now("k", 8, rate=2, burst=10, now=0) == 0
+    # 2 tokens left, 4 missing at 2 a second
+    assert store.take_now("k", 6, rate=2, burst=10, now=0) == 2
+    assert store.take_now("k", 6, rate=2, burst=10, now=2) == 0
+    # A long idle time refills to the burst, not beyond
+    assert store.take_now("k", 10, rate=2, burst=10, now=1000) == 0
+    assert store.take_now("k", 1, rate=2, burst=10, now=1000) == 0.5
+
+
+def test_take_now_lets_a_cost_above_the_burst_into_debt():
+    store = MemoryBucketStore()
+    assert store.take_now("k", 14, rate=2, burst=10, now=0) == 0
+    # 4 tokens of debt, then 1 more for the next take
+    assert store.take_now("k", 1, rate=2, burst=10, now=0) == 2.5
+    assert store.take_now("k", 14, rate=2, burst=10, now=2) == 5
+    assert store.take_now("k", 14, rate=2, burst=10, now=7) == 0
+
+
+def test_take_now_evicts_idle_then_oldest_buckets():
+    store = MemoryBucketStore(max_keys=3)
+    store.take_now("idle", 1, 1, 10, now=0)
+    store.take_now("a", 1, 1, 10, now=4000)
+    store.take_now("b", 1, 1, 10, now=4001)
+    store.take_now("c", 1, 1, 10, now=4002)
+    assert set(store._buckets) == {"a", "b", "c"}
+    store.take_now("d", 1, 1, 10, now=4003)
+    assert set(store._buckets) == {"b", "c", "d"}
+
+
+def test_agent_calls_of_each_route():
+    invoke = {"input": {"input": "price of braces"}, "config": {"configurable": {"session_id": "s1"}}}
+    assert agent_calls(json.dumps(invoke).encode()) == [("s1", "price of braces")]
+    batch = {
+        "inputs": [{"input": "a"}, {"input": "b"}],
+        "config": [{"configurable": {"session_id": "s1"}}, {"configurable": {"session_id": 2}}],
+    }
+    assert agent_calls(json.dumps(batch).encode()) == [("s1", "a"), ("2", "b")]
+    shared = {"inputs": [{"input": "a"}, {"input": "b"}], "config": {"configurable": {"session_id": "s1"}}}
+    assert agent_calls(json.dumps(shared).encode()) == [("s1", "a"), ("s1", "b")]
+    assert agent_calls(b"not json") == [(None, "not json")]
+    assert agent_calls(b"[1, 2]") == [(None, "")]
+
+
+def test_a_session_rejection_does_not_charge_the_ip():
+    rate_limiter = limiter()
+    assert check(rate_limiter, [("s1", "x" * 24)]) is None
+    # Each call costs 8: s1 has 2 tokens left, the IP 12
+    scope, wait = check(rate_limiter, [("s1", "x" * 24)])
+    assert scope == "session" and wait > 0
+    assert rate_limiter.store._buckets["ip:10.0.0.1"][0] >= 12
+    assert check(rate_limiter, [("s2", "x" * 24)]) is None
+
+
+def test_a_default_sized_batch_of_fifty_is_let_through():
+    rate_limiter = RateLimiter(MemoryBucketStore())
+    calls = [(f"s{i}", "How much does a dental implant cost?") for i in range(50)]
+    assert check(rate_limiter, calls) is None
+    # Then the IP pays the debt off at the refill rate
+    scope, wait = check(rate_limiter, [("s0", "hi")])
+    assert scope == "ip" and wait > 0
+
+
+def test_requests_beyond_a_minute_of_refill_are_refused_outright():
+    # Burst plus a minute of refill: 70 for a session, 90 for the IP
+    rate_limiter = limiter(ip_burst=30)
+    scope, wait = check(rate_limiter, [("s1", "x" * 300)])
+    assert (scope, wait) == ("session", float("inf"))
+    scope, wait = check(rate_limiter, [(str(i), "x" * 60) for i in range(6)])
+    assert (scope, wait) == ("ip", float("inf"))
+    # Nothing was charged for them
+    assert not rate_limiter.store._buckets
+
+
+def test_blocked_keys_are_refused_without_the_store():
+    store = CountingStore()
+    rate_limiter = limiter(store)
+    check(rate_limiter, [("s1", "x" * 28)])
+    assert check(rate_limiter, [("s1", "x" * 28)])[0] == "session"
+    takes = store.takes
+    for _ in range(5):
+        assert check(rate_limiter, [("s1", "hi")])[0] == "session"
+    assert store.takes == takes
+    assert rate_limiter.rejected == {"session": 6, "ip": 0}
+
+
+def test_middleware_answers_429_with_retry_after_and_413():
+    async def app(scope, receive, send):
+        body = (await receive())["body"]
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": body})
+
+    client = TestClient(RateLimitMiddleware(app, limiter(), trust_forwarded=False))
+    payload = {"input": {"input": "x" * 32}, "config": {"configurable": {"session_id": "s1"}}}
+    response = client.post("/website-bot/invoke", json=payload)
+    # The body read for the check is replayed to the app
+    assert response.status_code == 200 and response.json() == payload
+    response = client.post("/website-bot/invoke", json=payload)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    payload["input"]["input"] = "x" * 400
+    assert client.post("/website-bot/invoke", json={**payload, "config": {}}).status_code == 413
+    # Outside the prefix nothing is limited
+    assert client.post("/other", json=payload).status_code == 200
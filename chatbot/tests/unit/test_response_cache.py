@@ -0,0 +1,109 @@
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.agents.response_cache import (
+    HashingEmbeddings,
+    ResponseCacheRouter,
+    SemanticResponseCache,
+    normalize_question,
+    question_intent,
+)
+from app.history.mongo import PooledMongoDBChatMessageHistory
+from app.tools.catalog import DEFAULT_CATALOG_PATH, TreatmentCatalog
+
+
+def cache():
+    return SemanticResponseCache(HashingEmbeddings(), threshold=0.9, catalog=TreatmentCatalog(DEFAULT_CATALOG_PATH))
+
+
+def answered(question, reply="the answer"):
+    responses = cache()
+    assert responses.lookup(question) is None
+    responses.store(question, reply)
+    return responses
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("price of braces", "braces cost?"),
+    ("price of braces", "how much are braces"),
+    ("What is the cost of root canal treatment?", "rct price"),
+    ("do you do implants", "Do you do implants?"),
+])
+def test_rephrasings_hit(stored, asked):
+    assert answered(stored).lookup(asked) == "the answer"
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("how much is implant", "do you do implants"),
+    ("do you do implants", "how much is implant"),
+    ("rct price", "is rct painful"),
+    ("is rct painful", "rct price"),
+    ("price of braces", "are braces painful"),
+    ("price of braces", "price of teeth whitening"),
+    ("How much would a root canal cost me?", "How much would a re root canal cost me?"),
+    ("price of root canal for my son", "price of re root canal for my son"),
+    ("price of teeth whitening for 2 teeth", "price of teeth whitening for 3 teeth"),
+])
+def test_near_misses_do_not_hit(stored, asked):
+    assert answered(stored).lookup(asked) is None
+
+
+def test_price_key_is_the_treatment_and_the_numbers():
+    responses = cache()
+    assert responses.price_key("price of re root canal for my son") == "Re Root Canal Treatment"
+    assert responses.price_key("whitening for three teeth") == "Teeth Whitening 3"
+    assert answered("price of teeth whitening for 3 teeth").lookup("how much is whitening for three teeth") == "the answer"
+
+
+def test_price_question_without_one_treatment_is_not_cached():
+    responses = cache()
+    assert responses.lookup("how much for crown") is None
+    responses.store("how much for crown", "the answer")
+    assert responses.lookup("how much for crown") is None
+    assert responses.stats()["unresolved"] == 2
+
+
+def test_intent_stays_in_the_key():
+    assert question_intent("how much is implant") == "price"
+    assert question_intent("do you do implants") == "yes_no"
+    assert question_intent("what is rct") == "open"
+    assert normalize_question("How much does a dental implant cost?") == "price dental implant"
+    assert normalize_question("do you do implants") == "do you do implant"
+
+
+def test_similar_embeddings_of_different_intents_do_not_hit():
+    embeddings = HashingEmbeddings()
+    price, yes_no = embeddings.embed_documents(["rct price", "is rct painful"])
+    responses = answered("rct price")
+    # Even below the threshold, a match of another intent would be wrong
+    responses.threshold = float(np.dot(price, yes_no)) - 0.01
+    assert responses.lookup("is rct painful") is None
+
+
+class Agent:
+    async def ainvoke(self, input, config=None, **kwargs):
+        return {"input": input["input"], "output": "from the agent"}
+
+
+class CountingHistory(PooledMongoDBChatMessageHistory):
+    loads = 0
+
+    async def aget_messages(self):
+        CountingHistory.loads += 1
+        return await super().aget_messages()
+
+
+def test_first_turn_is_checked_without_loading_the_history(memory_mongo):
+    CountingHistory.loads = 0
+    router = ResponseCacheRouter(Agent(), CountingHistory, answered("price of braces", "cached"))
+    config = {"configurable": {"session_id": "new"}}
+    assert asyncio.run(router.aroute({"input": "braces cost?"}, config)) == "cached"
+
+    CountingHistory("old").add_messages([HumanMessage("hi"), AIMessage("hello")])
+    config = {"configurable": {"session_id": "old"}}
+    assert asyncio.run(router.aroute({"input": "braces cost?"}, config)) is None
+    assert router.route({"input": "braces cost?"}, config) is None
+    assert CountingHistory.loads == 0
@@ -0,0 +1,147 @@
+import asyncio
+
+from app.scheduler import PriorityMiddleware, PriorityScheduler, current_priority, request_priority
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def queue(scheduler: PriorityScheduler, priority: str, granted: list) -> asyncio.Task:
+    async def wait():
+        await scheduler.acquire(priority)
+        granted.append(priority)
+
+    task = asyncio.create_task(wait())
+    await settle()
+    return task
+
+
+def test_free_slots_are_granted_without_waiting():
+    async def scenario():
+        scheduler = PriorityScheduler(max_concurrency=2)
+        await scheduler.acquire("batch")
+        await scheduler.acquire("interactive")
+        assert scheduler.in_flight == 2
+        assert scheduler.stats()["classes"]["batch"]["waited"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_a_class_waits_at_its_limit_while_slots_are_free():
+    async def scenario():
+        scheduler = PriorityScheduler(max_concurrency=4, limits={"batch": 2})
+        granted = []
+        for _ in range(3):
+            await queue(scheduler, "batch", granted)
+        assert granted == ["batch", "batch"]
+        await queue(scheduler, "interactive", granted)
+        assert granted == ["batch", "batch", "interactive"]
+        scheduler.release("batch")
+        await settle()
+        assert granted == ["batch", "batch", "interactive", "batch"]
+
+    asyncio.run(scenario())
+
+
+def test_waiting_classes_share_slots_by_weight():
+    async def scenario():
+        scheduler = PriorityScheduler(max_concurrency=1, weights={"interactive": 4, "invoke": 2, "batch": 1})
+        await scheduler.acquire("batch")
+        granted = []
+        for priority in ("batch", "invoke", "interactive"):
+            for _ in range(28):
+                await queue(scheduler, priority, granted)
+        for _ in range(28):
+            scheduler.release(granted[-1] if granted else "batch")
+            await settle()
+        # 28 grants at 4:2:1, give or take the batch item that held the slot first
+        counts = {p: granted.count(p) for p in ("interactive", "invoke", "batch")}
+        for priority, share in {"interactive": 16, "invoke": 8, "batch": 4}.items():
+            assert abs(counts[priority] - share) <= 1
+
+    asyncio.run(scenario())
+
+
+def test_a_saturated_batch_class_delays_a_chat_by_at_most_one_release():
+    async def scenario():
+        scheduler = PriorityScheduler(max_concurrency=2)
+        granted = []
+        for _ in range(10):
+            await queue(scheduler, "batch", granted)
+        assert granted == ["batch", "batch"]
+        await queue(scheduler, "interactive", granted)
+        scheduler.release("batch")
+        await settle()
+        assert granted[-1] == "interactive"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiters_leave_the_queue_or_give_their_slot_back():
+    async def scenario():
+        scheduler = PriorityScheduler(max_concurrency=1)
+        await scheduler.acquire("invoke")
+        waiting = await queue(scheduler, "interactive", [])
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.stats()["classes"]["interactive"]["queued"] == 0
+
+        granted = await queue(scheduler, "interactive", [])
+        # Handed the slot, then cancelled before it could run
+        scheduler.release("invoke")
+        granted.cancel()
+        await asyncio.gather(granted, return_exceptions=True)
+        assert scheduler.in_flight == 0
+        await scheduler.acquire("batch")
+        assert scheduler.running["batch"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_the_header_can_only_lower_the_route_class():
+    assert request_priority("/website-bot/stream", None) == "interactive"
+    assert request_priority("/website-bot/stream", "batch") == "batch"
+    assert request_priority("/website-bot/batch", "interactive") == "batch"
+    assert request_priority("/website-bot/invoke", "Interactive") == "invoke"
+    assert request_priority("/website-bot/invoke/", " BATCH ") == "batch"
+    assert request_priority("/website-bot/invoke", "urgent") == "invoke"
+    assert request_priority("/website-bot/other", None) == "invoke"
+
+
+def test_middleware_sets_the_class_for_the_request():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(current_priority())
+
+    middleware = PriorityMiddleware(app)
+
+    async def scenario():
+        headers = [(b"x-priority", b"batch")]
+        await middleware({"type": "http", "method": "POST", "path": "/website-bot/stream", "headers": []}, None, None)
+        await middleware({"type": "http", "method": "POST", "path": "/website-bot/stream", "headers": headers}, None, None)
+        await middleware({"type": "http", "method": "GET", "path": "/", "headers": headers}, None, None)
+
+    asyncio.run(scenario())
+    assert seen == ["interactive", "batch", "invoke"]
+
+
+def test_scheduled_step_takes_a_slot_for_async_calls_only():
+    from langchain_core.runnables import RunnableLambda
+
+    from app.agents.scheduling import ScheduledStep
+
+    scheduler = PriorityScheduler(max_concurrency=1)
+    step = ScheduledStep(RunnableLambda(lambda x: scheduler.in_flight), scheduler)
+    assert asyncio.run(step.ainvoke(0)) == 1
+
+    async def stream():
+        return [chunk async for chunk in step.astream(0)]
+
+    assert asyncio.run(stream()) == [1]
+    # Sync calls bypass the scheduler
+    assert step.invoke(0) == 0
+    assert list(step.stream(0)) == [0]
+    assert scheduler.in_flight == 0
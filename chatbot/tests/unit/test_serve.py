@@ -0,0 +1,26 @@
+import pytest
+
+from app import serve
+
+
+@pytest.fixture
+def env(monkeypatch):
+    for name in ("WEB_CONCURRENCY", "WORKERS_PER_CPU", "MAX_WORKERS", "HISTORY_CACHE"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(serve, "cpu_count", lambda: 4.0)
+    return monkeypatch
+
+
+def test_one_worker_per_cpu_up_to_the_cap(env):
+    assert serve.worker_count() == 4
+    env.setenv("WORKERS_PER_CPU", "3")
+    assert serve.worker_count() == 8
+    env.setenv("WEB_CONCURRENCY", "2")
+    assert serve.worker_count() == 2
+
+
+def test_the_history_cache_runs_a_single_worker(env):
+    env.setenv("HISTORY_CACHE", "true")
+    assert serve.worker_count() == 1
+    env.setenv("WEB_CONCURRENCY", "4")
+    assert serve.worker_count() == 1
@@ -0,0 +1,102 @@
+import asyncio
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.tools import tool
+
+from app.agents.streaming import AGENT_LLM_TAG, TokenStreamer
+from app.history.mongo import PooledMongoDBChatMessageHistory
+from app.llm import CircuitBreaker, ResilientChatModel
+
+ANSWER = "Braces cost 45000 rs at our clinic"
+
+
+@tool
+def get_treatment_price(treatment: str) -> str:
+    """Price of a dental treatment"""
+    return "45000 rs"
+
+
+class RecordingHistory(PooledMongoDBChatMessageHistory):
+    events = None
+
+    def add_messages(self, messages):
+        RecordingHistory.events.append("history")
+        super().add_messages(messages)
+
+    async def aadd_messages(self, messages):
+        RecordingHistory.events.append("history")
+        await super().aadd_messages(messages)
+
+
+class RecordingTokens(BaseCallbackHandler):
+    run_inline = True
+
+    def on_llm_new_token(self, token, *, tags=None, **kwargs):
+        if AGENT_LLM_TAG in (tags or ()):
+            RecordingHistory.events.append("token")
+
+
+def streamer():
+    """An agent like website_bot's, with an untagged model (a summarizer) run before the tagged one"""
+    prompt = ChatPromptTemplate.from_messages([
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("user", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ])
+    llm = ResilientChatModel(
+        primary=GenericFakeChatModel(messages=iter([AIMessage(ANSWER)] * 2)),
+        breaker=CircuitBreaker("test"),
+        tags=[AGENT_LLM_TAG],
+    )
+    summarizer = GenericFakeChatModel(messages=iter([AIMessage("earlier the user said hi")] * 2))
+    summarize = ChatPromptTemplate.from_messages([("user", "summarize {input}")]) | summarizer | StrOutputParser()
+    agent = RunnablePassthrough.assign(summary=summarize) | create_tool_calling_agent(llm, [get_treatment_price], prompt)
+    executor = AgentExecutor(agent=agent, tools=[get_treatment_price])
+    with_history = RunnableWithMessageHistory(
+        executor, RecordingHistory, input_messages_key="input", history_messages_key="chat_history"
+    )
+    return TokenStreamer(with_history)
+
+
+def session(session_id):
+    return {"configurable": {"session_id": session_id}, "callbacks": [RecordingTokens()]}
+
+
+async def collect(runnable, input, config):
+    return [chunk async for chunk in runnable.astream(input, config)]
+
+
+def test_tokens_of_the_agent_model_only(memory_mongo):
+    RecordingHistory.events = []
+    chunks = asyncio.run(collect(streamer(), {"input": "price of braces"}, session("s1")))
+    outputs = [chunk["output"] for chunk in chunks if "output" in chunk]
+    assert len(outputs) > 1
+    # Nothing of the summarizer got through
+    assert not any("hi" in output.split() for output in outputs)
+
+
+def test_chunks_add_up_to_the_invoke_output(memory_mongo):
+    RecordingHistory.events = []
+    runnable = streamer()
+    chunks = asyncio.run(collect(runnable, {"input": "price of braces"}, session("s1")))
+    invoked = asyncio.run(runnable.ainvoke({"input": "price of braces"}, session("s2")))
+    # The final chunk repeating the whole answer was dropped
+    assert "".join(chunk["output"] for chunk in chunks if "output" in chunk) == invoked["output"] == ANSWER
+    assert runnable.stats()["token_streams"] == 1
+
+
+def test_history_is_written_after_the_last_token(memory_mongo):
+    RecordingHistory.events = []
+    asyncio.run(collect(streamer(), {"input": "price of braces"}, session("s1")))
+    events = RecordingHistory.events
+    assert events.count("history") == 1 and events[-1] == "history"
+    assert events.count("token") > 1
+    messages = PooledMongoDBChatMessageHistory("s1").messages
+    assert [(m.type, m.content) for m in messages] == [("human", "price of braces"), ("ai", ANSWER)]
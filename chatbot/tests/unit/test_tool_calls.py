@@ -0,0 +1,100 @@
+import asyncio
+import time
+from typing import List, Union
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentFinish
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import tool
+
+from app import monkey_patch
+
+
+class ToolRuns(AsyncCallbackHandler):
+    def __init__(self):
+        self.ended = []
+        self.errors = []
+
+    async def on_tool_end(self, output, **kwargs):
+        self.ended.append(output)
+
+    async def on_tool_error(self, error, **kwargs):
+        self.errors.append(error)
+
+
+def executor(tools, calls: List[dict]) -> AgentExecutor:
+    def plan(inputs) -> Union[List[AgentAction], AgentFinish]:
+        steps = inputs["intermediate_steps"]
+        if steps:
+            return AgentFinish({"output": [observation for _, observation in steps]}, "")
+        return [AgentAction(call["tool"], call["input"], "") for call in calls]
+
+    return AgentExecutor(agent=RunnableLambda(plan), tools=tools)
+
+
+def run(agent: AgentExecutor, callbacks=None):
+    return asyncio.run(
+        agent.ainvoke({"input": "x"}, {"metadata": {"session_id": "s1"}, "callbacks": callbacks or []})
+    )["output"]
+
+
+def test_calls_run_concurrently_in_order_and_bounded(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "TOOL_MAX_CONCURRENCY", 2)
+    running = 0
+    most = 0
+
+    @tool
+    async def price(treatment: str, **kwargs) -> str:
+        """Price of a treatment"""
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        # Later calls finish first
+        await asyncio.sleep(0.05 if treatment == "braces" else 0.01)
+        running -= 1
+        return f"{treatment} price"
+
+    calls = [{"tool": "price", "input": {"treatment": t}} for t in ("braces", "cleaning", "whitening", "implant")]
+    assert run(executor([price], calls)) == ["braces price", "cleaning price", "whitening price", "implant price"]
+    assert most == 2
+    assert not monkey_patch._run_semaphores
+
+
+def test_a_timed_out_call_ends_its_tool_run(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "TOOL_TIMEOUT_SECONDS", 0.05)
+
+    @tool
+    async def slow(treatment: str, **kwargs) -> str:
+        """Never answers in time"""
+        await asyncio.sleep(10)
+        return "late"
+
+    @tool
+    async def price(treatment: str, **kwargs) -> str:
+        """Price of a treatment"""
+        return "45000 rs"
+
+    runs = ToolRuns()
+    calls = [{"tool": "slow", "input": {"treatment": "x"}}, {"tool": "price", "input": {"treatment": "braces"}}]
+    start = time.perf_counter()
+    output = run(executor([slow, price], calls), [runs])
+    assert time.perf_counter() - start < 1
+    assert output == ["slow did not answer within 0.05 seconds", "45000 rs"]
+    assert runs.ended == ["45000 rs"]
+    assert [type(e) for e in runs.errors] == [asyncio.CancelledError]
+
+
+def test_sync_tools_run_on_the_tool_pool():
+    threads = []
+
+    @tool
+    def price(treatment: str, **kwargs) -> str:
+        """Price of a treatment"""
+        import threading
+
+        threads.append(threading.current_thread().name)
+        return "45000 rs"
+
+    assert run(executor([price], [{"tool": "price", "input": {"treatment": "braces"}}])) == ["45000 rs"]
+    assert threads[0].startswith("tool")
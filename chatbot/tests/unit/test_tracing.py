@@ -0,0 +1,128 @@
+import threading
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tracers.schemas import Run
+
+from app.metrics import traces_dropped
+from app.tracing import SampledTracer, TraceExporter
+
+
+class ListExporter(TraceExporter):
+    """Keeps submitted traces instead of queueing them for LangSmith"""
+
+    def __init__(self):
+        super().__init__(client=object())
+        self.traces = []
+
+    def submit(self, run):
+        self.traces.append(run)
+
+
+class RecordingClient:
+    def __init__(self, block=False):
+        self.runs = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def batch_ingest_runs(self, create, pre_sampled):
+        self.entered.set()
+        self.release.wait(5)
+        self.runs.extend(create)
+
+
+def run(name="agent"):
+    run_id = uuid4()
+    now = datetime.now(timezone.utc)
+    return Run(
+        id=run_id, name=name, run_type="chain", inputs={}, start_time=now, end_time=now,
+        trace_id=run_id, dotted_order=now.strftime("%Y%m%dT%H%M%S%fZ") + str(run_id), serialized={},
+    )
+
+
+def turn(tracer, session_id, fail=False):
+    def answer(input):
+        if fail:
+            raise RuntimeError("upstream down")
+        return "the answer"
+
+    chain = RunnableLambda(lambda input: input) | RunnableLambda(answer)
+    config = {"callbacks": [tracer], "metadata": {"session_id": session_id}}
+    if fail:
+        with pytest.raises(RuntimeError):
+            chain.invoke("hi", config)
+    else:
+        chain.invoke("hi", config)
+
+
+def test_session_sampling_is_stable_across_turns():
+    exporter = ListExporter()
+    tracer = SampledTracer(exporter, sample_rate=0.0, session_rate=0.5)
+    sampled = {}
+    for _ in range(3):
+        for i in range(20):
+            traced = len(exporter.traces)
+            turn(tracer, f"session-{i}")
+            sampled.setdefault(i, []).append(len(exporter.traces) > traced)
+    assert all(len(set(turns)) == 1 for turns in sampled.values())
+    assert 0 < sum(turns[0] for turns in sampled.values()) < 20
+    assert tracer.stats()["open_runs"] == 0
+
+
+def test_failed_requests_are_always_traced():
+    exporter = ListExporter()
+    tracer = SampledTracer(exporter, sample_rate=0.0)
+    turn(tracer, "s1")
+    assert exporter.traces == []
+    turn(tracer, "s1", fail=True)
+    (trace,) = exporter.traces
+    assert "upstream down" in trace.error
+    # The step that failed is in the trace
+    assert [child.error for child in trace.child_runs] == [repr(RuntimeError("upstream down"))]
+    assert tracer.stats()["error_traces"] == 1
+
+
+def test_exported_fields_are_truncated(monkeypatch):
+    monkeypatch.setenv("TRACING_MAX_FIELD_CHARS", "10")
+    monkeypatch.setenv("TRACING_MAX_LIST_ITEMS", "2")
+    tracer = SampledTracer.from_env("full")
+    client = RecordingClient()
+    tracer.exporter._client = client
+    chain = RunnableLambda(lambda input: "y" * 50)
+    history = [HumanMessage(f"turn {i}") for i in range(5)]
+    chain.invoke({"input": "x" * 50, "chat_history": history}, {"callbacks": [tracer]})
+    tracer.exporter.flush()
+    tracer.exporter.close()
+    (record,) = client.runs
+    assert record["inputs"]["input"] == "x" * 10 + "... [40 chars truncated]"
+    assert record["inputs"]["chat_history"] == [
+        "[3 earlier items truncated]",
+        {"type": "human", "content": "turn 3"},
+        {"type": "human", "content": "turn 4"},
+    ]
+    assert record["outputs"]["output"] == "y" * 10 + "... [40 chars truncated]"
+
+
+def test_a_full_queue_drops_traces_without_blocking():
+    client = RecordingClient(block=True)
+    exporter = TraceExporter(client=client, max_queue=1, batch_size=1)
+    dropped = traces_dropped.labels().value
+    exporter.submit(run())
+    # The export thread is stuck sending the first trace
+    assert client.entered.wait(5)
+    exporter.submit(run())
+    started = time.monotonic()
+    exporter.submit(run())
+    assert time.monotonic() - started < 0.1
+    assert exporter.stats()["dropped"] == 1
+    assert traces_dropped.labels().value == dropped + 1
+    client.release.set()
+    exporter.flush()
+    exporter.close()
+    assert exporter.stats()["exported"] == 2
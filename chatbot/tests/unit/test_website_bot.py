@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+
+def test_window_mode_refuses_the_bucket_store():
+    env = {**os.environ, "HISTORY_MODE": "window", "HISTORY_STORE": "buckets"}
+    env.setdefault("MONGO_COLLECTION", "history")
+    env.setdefault("OPENAI_API_KEY", "sk-test")
+    # In a fresh interpreter: the module configures the chain when it is imported
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.agents.website_bot"], env=env, capture_output=True, text=True
+    )
+    assert result.returncode != 0
+    assert "can not be used with HISTORY_STORE=buckets" in result.stderr